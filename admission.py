@@ -0,0 +1,326 @@
+import base64
+import hashlib
+import hmac
+import ipaddress
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+
+# Admission control for ticket drops. Booking and payment routes take a token from a per client
+# bucket and from a global one, a 429 sends the fan to the waiting room: a FIFO that admits
+# ADMISSION_ROOM_RATE tickets per second and hands each one a signed, time-boxed entry token.
+# Requests carrying a valid entry token (X-Entry-Token) skip the global bucket. Off unless
+# ADMISSION_ENABLED=true, which needs ADMISSION_SECRET.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "false").lower() == "true"
+ADMISSION_GLOBAL_RATE = float(os.getenv("ADMISSION_GLOBAL_RATE", "50"))  # Requests per second without an entry token
+ADMISSION_GLOBAL_BURST = float(os.getenv("ADMISSION_GLOBAL_BURST", "100"))
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "2"))  # Per IP, or per entry token
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "5"))
+ADMISSION_ROOM_RATE = float(os.getenv("ADMISSION_ROOM_RATE", "20"))  # Waiting room tickets admitted per second
+ADMISSION_ENTRY_TTL = int(os.getenv("ADMISSION_ENTRY_TTL", "600"))  # Seconds an entry token is valid
+ADMISSION_TICKET_TTL = int(os.getenv("ADMISSION_TICKET_TTL", "3600"))  # Tickets older than this are void
+ADMISSION_JOIN_RATE = float(os.getenv("ADMISSION_JOIN_RATE", "0.2"))  # Waiting room joins per second per IP
+ADMISSION_JOIN_BURST = float(os.getenv("ADMISSION_JOIN_BURST", "3"))
+# Signs tickets and entry tokens, must be the same on every worker and across restarts
+ADMISSION_SECRET = os.getenv("ADMISSION_SECRET", "")
+if ADMISSION_ENABLED and not ADMISSION_SECRET:
+    # A per-process secret would void every ticket on a restart and on every other worker
+    raise RuntimeError("ADMISSION_ENABLED needs ADMISSION_SECRET, the same on every worker")
+# Buckets and the queue shared by all workers, in-process when unset
+ADMISSION_REDIS_URL = os.getenv("ADMISSION_REDIS_URL")
+ADMISSION_REDIS_TIMEOUT = float(os.getenv("ADMISSION_REDIS_TIMEOUT", "0.05"))
+ADMISSION_MAX_KEYS = int(os.getenv("ADMISSION_MAX_KEYS", "100000"))  # Client buckets kept per worker
+# Reverse proxies in front of the app (IPs or networks, comma separated). Requests coming from
+# them are keyed on the address they forwarded in X-Forwarded-For, else every fan shares the
+# proxy's bucket. Unset, X-Forwarded-For is ignored: anyone could pick their own bucket.
+ADMISSION_TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+
+ENTRY_TOKEN_HEADER = "X-Entry-Token"
+
+
+class AdmissionStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "admitted": 0,  # Passed the buckets without an entry token
+            "priority": 0,  # Passed with an entry token
+            "rejected_client": 0,
+            "rejected_global": 0,
+            "invalid_tokens": 0,
+            "joined": 0,
+            "rejected_joins": 0,
+            "entries_issued": 0,
+            "backend_errors": 0,
+        }
+
+    def add(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+
+admission_stats = AdmissionStats()
+
+
+class LocalBackend:
+    # Buckets and queue of this worker only
+
+    def __init__(self, max_keys: int = ADMISSION_MAX_KEYS):
+        self.max_keys = max_keys
+        # {bucket: (tokens, updated_at)}, least recently used first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._next_seq = 0
+        self._admitted = 0.0
+        self._admitted_at = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, bucket: str, rate: float, burst: float, now: float) -> float:
+        # 0 when a token was taken, else seconds until the next one
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(bucket, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate if rate > 0 else float("inf")
+            self._buckets[bucket] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def join(self, rate: float, now: float) -> int:
+        with self._lock:
+            # The head catches up with the time it was idle before the tail moves, or a burst
+            # joining after a quiet spell would all be let in at once
+            self._advance(rate, now)
+            self._next_seq += 1
+            return self._next_seq
+
+    def admitted(self, rate: float, now: float) -> int:
+        # Tickets up to this sequence number are in
+        with self._lock:
+            return self._advance(rate, now)
+
+    def _advance(self, rate: float, now: float) -> int:
+        # The head moves at rate but never past the tail
+        self._admitted = min(float(self._next_seq), self._admitted + max(0.0, now - self._admitted_at) * rate)
+        self._admitted_at = now
+        return int(self._admitted)
+
+
+class RedisBackend:
+    # Same state in Redis, every step is one Lua script so workers never interleave
+
+    TAKE = """
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tokens = tonumber(state[1]) or burst
+    local at = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 elseif rate > 0 then wait = (1 - tokens) / rate else wait = -1 end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / math.max(rate, 0.001)) + 1)
+    return tostring(wait)
+    """
+    # KEYS: head, tail. Moves the head, then with ARGV[3] = 1 appends a ticket and returns its number
+    ADVANCE = """
+    local state = redis.call('HMGET', KEYS[1], 'admitted', 'at')
+    local rate, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local tail = tonumber(redis.call('GET', KEYS[2]) or '0')
+    local admitted = tonumber(state[1]) or 0
+    local at = tonumber(state[2]) or now
+    admitted = math.min(tail, admitted + math.max(0, now - at) * rate)
+    redis.call('HSET', KEYS[1], 'admitted', tostring(admitted), 'at', tostring(now))
+    if ARGV[3] == '1' then return redis.call('INCR', KEYS[2]) end
+    return math.floor(admitted)
+    """
+
+    def __init__(self, url: str, timeout: float = ADMISSION_REDIS_TIMEOUT):
+        import redis  # Only needed when the shared backend is configured
+
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._take = self.client.register_script(self.TAKE)
+        self._advance = self.client.register_script(self.ADVANCE)
+
+    def take(self, bucket: str, rate: float, burst: float, now: float) -> float:
+        wait = float(self._take(keys=[f"admission:bucket:{bucket}"], args=[rate, burst, now]))
+        return float("inf") if wait < 0 else wait
+
+    def join(self, rate: float, now: float) -> int:
+        return int(self._advance(keys=["admission:room:head", "admission:room:seq"], args=[rate, now, 1]))
+
+    def admitted(self, rate: float, now: float) -> int:
+        return int(self._advance(keys=["admission:room:head", "admission:room:seq"], args=[rate, now, 0]))
+
+
+def sign(payload: str, secret: str = ADMISSION_SECRET) -> str:
+    signature = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).hexdigest()[:32]
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=") + "." + signature
+
+
+def unsign(token: str, secret: str = ADMISSION_SECRET) -> Optional[str]:
+    try:
+        encoded, signature = token.rsplit(".", 1)
+        payload = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+    except ValueError:
+        return None
+    if not hmac.compare_digest(sign(payload, secret).rsplit(".", 1)[1], signature):
+        return None
+    return payload
+
+
+class WaitingRoom:
+    # Tickets are "ticket:<seq>:<joined at>", entry tokens "entry:<seq>:<expires at>", both signed.
+    # Nothing is stored per fan, any worker can check a ticket or a token.
+
+    def __init__(self, backend, rate: float = ADMISSION_ROOM_RATE, entry_ttl: int = ADMISSION_ENTRY_TTL, ticket_ttl: int = ADMISSION_TICKET_TTL):
+        self.backend = backend
+        self.rate = rate
+        self.entry_ttl = entry_ttl
+        self.ticket_ttl = ticket_ttl
+
+    def join(self) -> dict:
+        now = time.time()
+        seq = self.backend.join(self.rate, now)
+        admission_stats.add("joined")
+        return {"ticket": sign(f"ticket:{seq}:{int(now)}"), **self._position(seq, now)}
+
+    def status(self, ticket: str) -> Optional[dict]:
+        # None for a forged or expired ticket
+        payload = unsign(ticket)
+        if payload is None or not payload.startswith("ticket:"):
+            return None
+        _, seq, joined_at = payload.split(":")
+        seq, joined_at = int(seq), int(joined_at)
+        now = time.time()
+        if now - joined_at > self.ticket_ttl:
+            return None
+        position = self._position(seq, now)
+        if position["position"] == 0:
+            # Polling again re-issues the token, it never outlives the ticket
+            expires_at = int(min(now + self.entry_ttl, joined_at + self.ticket_ttl + self.entry_ttl))
+            position["entry_token"] = sign(f"entry:{seq}:{expires_at}")
+            position["expires_at"] = expires_at
+            admission_stats.add("entries_issued")
+        return position
+
+    def _position(self, seq: int, now: float) -> dict:
+        ahead = max(0, seq - self.backend.admitted(self.rate, now))
+        return {"position": ahead, "estimated_wait": ahead / self.rate if self.rate > 0 else None}
+
+    def entry(self, token: str) -> Optional[int]:
+        # Sequence number of a valid, unexpired entry token
+        payload = unsign(token)
+        if payload is None or not payload.startswith("entry:"):
+            return None
+        _, seq, expires_at = payload.split(":")
+        if time.time() > int(expires_at):
+            return None
+        return int(seq)
+
+
+backend = RedisBackend(ADMISSION_REDIS_URL) if ADMISSION_REDIS_URL else LocalBackend()
+waiting_room = WaitingRoom(backend)
+
+
+def take(bucket: str, rate: float, burst: float) -> float:
+    # A broken shared backend lets requests through rather than closing the sale
+    try:
+        return backend.take(bucket, rate, burst, time.time())
+    except Exception as e:
+        print(f"Error taking admission token {bucket}: {e}")
+        admission_stats.add("backend_errors")
+        return 0.0
+
+
+async def take_async(bucket: str, rate: float, burst: float) -> float:
+    # The Redis client blocks, it runs on the threadpool instead of stalling the event loop
+    if isinstance(backend, RedisBackend):
+        return await run_in_threadpool(take, bucket, rate, burst)
+    return take(bucket, rate, burst)
+
+
+def trusted(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in ADMISSION_TRUSTED_PROXIES)
+
+
+def client_address(request: Request) -> str:
+    # The peer, or behind trusted proxies the first address of X-Forwarded-For, read from the
+    # right, that no trusted proxy added
+    address = request.client.host if request.client else "unknown"
+    if not ADMISSION_TRUSTED_PROXIES or not trusted(address):
+        return address
+    forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(forwarded):
+        address = hop
+        if not trusted(hop):
+            break
+    return address
+
+
+def too_many(wait: float, reason: str):
+    retry_after = max(1, int(wait + 0.999)) if wait != float("inf") else 60
+    raise HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail={"message": reason, "waiting_room": "/waiting-room"},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+async def admit(request: Request):
+    # Dependency of the booking and payment routes
+    if not ADMISSION_ENABLED:
+        return
+    token = request.headers.get(ENTRY_TOKEN_HEADER)
+    seq = waiting_room.entry(token) if token else None
+    if token and seq is None:
+        admission_stats.add("invalid_tokens")
+
+    if seq is not None:
+        # Admitted by the waiting room: only the per fan bucket applies
+        wait = await take_async(f"entry:{seq}", ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST)
+        if wait:
+            admission_stats.add("rejected_client")
+            too_many(wait, "Too many requests from this entry token")
+        admission_stats.add("priority")
+        return
+
+    wait = await take_async(f"client:{client_address(request)}", ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST)
+    if wait:
+        admission_stats.add("rejected_client")
+        too_many(wait, "Too many requests from this client")
+    wait = await take_async("global", ADMISSION_GLOBAL_RATE, ADMISSION_GLOBAL_BURST)
+    if wait:
+        admission_stats.add("rejected_global")
+        too_many(wait, "Sales are busy, join the waiting room")
+    admission_stats.add("admitted")
+
+
+async def admit_join(request: Request):
+    # Dependency of POST /waiting-room, or a single client could fill the queue ahead of everyone
+    if not ADMISSION_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Waiting room disabled")
+    wait = await take_async(f"join:{client_address(request)}", ADMISSION_JOIN_RATE, ADMISSION_JOIN_BURST)
+    if wait:
+        admission_stats.add("rejected_joins")
+        too_many(wait, "Too many waiting room tickets from this client")
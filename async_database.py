@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from typing import AsyncGenerator, Dict, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from database import engine
+
+
+# Async twin of database.engine. ASYNC_DATABASE_URL overrides the URL derived from the sync one.
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Reconnect connections older than this
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# Upper bounds in seconds of the checkout wait histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float("inf"))
+
+
+def async_url():
+    if os.getenv("ASYNC_DATABASE_URL"):
+        return make_url(os.getenv("ASYNC_DATABASE_URL"))
+    url = engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver known for {backend}, set ASYNC_DATABASE_URL")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class PoolStats:
+    # Checkout waits and saturation of the async pool, used to size it for match days
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets: List[int] = [0] * len(WAIT_BUCKETS)
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if seconds <= bound:
+                    self.wait_buckets[i] += 1
+                    break
+
+    def checked_out(self):
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def checked_in(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+            return {
+                "pool_size": DB_POOL_SIZE,
+                "max_overflow": DB_MAX_OVERFLOW,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "saturation": self.in_use / capacity if capacity else 0,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0,
+                "wait_max": self.wait_max,
+                "wait_histogram": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in zip(WAIT_BUCKETS, self.wait_buckets)},
+            }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # Times how long a request waits for a connection when the pool is exhausted
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - started)
+        return connection
+
+
+def create_engine_from_env():
+    url = async_url()
+    if url.get_backend_name() == "sqlite":
+        # SQLite has no server side pool to size
+        return create_async_engine(url)
+    return create_async_engine(
+        url,
+        poolclass=InstrumentedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+async_engine = create_engine_from_env()
+# Objects stay usable after commit, responses are serialized after the session is done
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+@event.listens_for(async_engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats.checked_out()
+
+
+@event.listens_for(async_engine.sync_engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    pool_stats.checked_in()
+
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
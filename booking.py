@@ -0,0 +1,225 @@
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from holds import seat_holds
+from sales_summary import add_reservations
+
+
+class BookingEntry:
+
+    def __init__(self, onibus_id: str, client_id: str, seats: Iterable[Tuple[int, int]], all_or_nothing: bool = False, holder: Optional[str] = None):
+        self.onibus_id = onibus_id
+        self.client_id = client_id
+        self.seats = sorted(set(seats))  # Same lock order for every buyer
+        self.all_or_nothing = all_or_nothing
+        self.holder = holder  # Payment whose seat holds this booking may use
+
+
+class BookingResult:
+
+    def __init__(self, entry: BookingEntry):
+        self.entry = entry
+        self.reserved: List[dict] = []  # Reservation rows written for this entry
+        self.conflicts: List[dict] = []
+        self.sold_out = False
+
+    @property
+    def reserved_seats(self) -> List[Tuple[int, int]]:
+        return [(reservation["seat_row"], reservation["seat_column"]) for reservation in self.reserved]
+
+    def conflict(self, seats: Iterable[Tuple[int, int]], reason: str):
+        self.conflicts.extend({"row": row, "column": column, "reason": reason} for row, column in seats)
+
+    def as_dict(self) -> dict:
+        return {
+            "reserved": [{"row": row, "column": column} for row, column in self.reserved_seats],
+            "conflicts": self.conflicts,
+        }
+
+
+def reservation_row(entry: BookingEntry, row: int, column: int) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "client_id": entry.client_id,
+        "onibus_id": entry.onibus_id,
+        "seat_row": row,
+        "seat_column": column,
+        "timestamp": datetime.utcnow(),
+        "confirmed": False,
+    }
+
+
+def take_vagas(db: Session, onibus_id: str, count: int) -> bool:
+    # Conditional decrement instead of a read-modify-write, fails when the bus is full
+    updated = db.query(models.Onibus).filter(
+        models.Onibus.id == onibus_id,
+        or_(models.Onibus.vagas == None, models.Onibus.vagas >= count),  # noqa: E711
+    ).update({models.Onibus.vagas: models.Onibus.vagas - count}, synchronize_session=False)
+    if updated:
+        add_reservations(db, onibus_id, count)
+    return bool(updated)
+
+
+def claim_seats_bulk(db: Session, entries: List[BookingEntry]) -> List[BookingResult]:
+    # Books many (onibus, client, seats) entries in the caller's transaction: one query
+    # reads the taken seats of every bus involved, one conditional UPDATE per bus takes
+    # the vagas and all reservations go in a single batched INSERT. The unique constraint
+    # on (onibus_id, seat_row, seat_column) still has the last word: if another buyer
+    # wins a seat between the check and the insert, the batch is retried seat by seat.
+    # Nothing is committed here, the caller owns the transaction.
+    results = [BookingResult(entry) for entry in entries]
+    onibus_ids = {entry.onibus_id for entry in entries}
+    booking = db.begin_nested()
+    try:
+        vagas = dict(db.query(models.Onibus.id, models.Onibus.vagas).filter(models.Onibus.id.in_(onibus_ids)).all())
+        taken = set(
+            db.query(models.Reservation.onibus_id, models.Reservation.seat_row, models.Reservation.seat_column)
+            .filter(models.Reservation.onibus_id.in_(onibus_ids))
+            .all()
+        )
+
+        wanted: Dict[str, List[BookingResult]] = {}
+        for result in results:
+            entry = result.entry
+            if entry.onibus_id not in vagas:
+                result.conflict(entry.seats, "onibus_not_found")
+                continue
+            free = [(row, column) for row, column in entry.seats if (entry.onibus_id, row, column) not in taken]
+            result.conflict([seat for seat in entry.seats if seat not in free], "seat_taken")
+            # Seats held for another buyer's pending payment are not free either
+            held = set(seat_holds.conflicts(entry.onibus_id, free, entry.holder))
+            result.conflict([seat for seat in free if seat in held], "seat_held")
+            free = [seat for seat in free if seat not in held]
+            if not free or (entry.all_or_nothing and result.conflicts):
+                continue
+            result.reserved = [reservation_row(entry, row, column) for row, column in free]
+            taken.update((entry.onibus_id, row, column) for row, column in free)
+            wanted.setdefault(entry.onibus_id, []).append(result)
+
+        for onibus_id, bus_results in wanted.items():
+            if not take_vagas(db, onibus_id, sum(len(result.reserved) for result in bus_results)):
+                for result in bus_results:
+                    result.conflict(result.reserved_seats, "sold_out")
+                    result.reserved = []
+                    result.sold_out = True
+
+        rows = [reservation for result in results for reservation in result.reserved]
+        if rows:
+            db.execute(insert(models.Reservation), rows)
+        booking.commit()
+        return results
+    except IntegrityError:
+        booking.rollback()
+        return [claim_seats_one_by_one(db, entry) for entry in entries]
+
+
+def claim_seats_one_by_one(db: Session, entry: BookingEntry) -> BookingResult:
+    # Slow path under contention: each seat is inserted in its own SAVEPOINT so the
+    # database picks a single winner per seat without a global lock
+    result = BookingResult(entry)
+    booking = db.begin_nested()
+    held = set(seat_holds.conflicts(entry.onibus_id, entry.seats, entry.holder))
+
+    for row, column in entry.seats:
+        if (row, column) in held:
+            result.conflict([(row, column)], "seat_held")
+            continue
+        reservation = reservation_row(entry, row, column)
+        try:
+            with db.begin_nested():
+                db.execute(insert(models.Reservation), [reservation])
+            result.reserved.append(reservation)
+        except IntegrityError:
+            result.conflict([(row, column)], "seat_taken")
+
+    if not result.reserved or (entry.all_or_nothing and result.conflicts):
+        booking.rollback()
+        result.reserved = []
+        return result
+
+    if not take_vagas(db, entry.onibus_id, len(result.reserved)):
+        booking.rollback()
+        result.conflicts = []
+        result.conflict(entry.seats, "sold_out")
+        result.reserved = []
+        result.sold_out = True
+        return result
+
+    booking.commit()
+    return result
+
+
+def claim_seats(
+    db: Session,
+    onibus_id: str,
+    client_id: str,
+    seats: Iterable[Tuple[int, int]],
+    all_or_nothing: bool = False,
+    holder: Optional[str] = None,
+) -> BookingResult:
+    return claim_seats_bulk(db, [BookingEntry(onibus_id, client_id, seats, all_or_nothing, holder)])[0]
+
+
+def stress(buyers: int = 50, seats_per_buyer: int = 3, rows: int = 10, columns: int = 4):
+    # Many buyers fight over random seats of one throwaway bus, then the bus is checked
+    # for double-sold seats and for a vagas counter that no longer matches the rows.
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from database import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    onibus_id = f"stress-{uuid.uuid4()}"
+    capacity = rows * columns
+    db = SessionLocal()
+    db.add(models.Onibus(id=onibus_id, evento="stress", vagas=capacity))
+    db.commit()
+
+    errors: List[str] = []
+
+    def buy(buyer: int) -> int:
+        # Seats taken by others come back as conflicts, an exception is a failed booking
+        session = SessionLocal()
+        try:
+            seats = [(random.randrange(rows), random.randrange(columns)) for _ in range(seats_per_buyer)]
+            result = claim_seats(session, onibus_id, f"stress-client-{buyer}", seats)
+            session.commit()
+            return len(result.reserved)
+        except Exception as e:
+            session.rollback()
+            errors.append(f"{type(e).__name__}: {e}")
+            return 0
+        finally:
+            session.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(buyers, 32)) as executor:
+            booked = sum(executor.map(buy, range(buyers)))
+
+        reservations = db.query(models.Reservation.seat_row, models.Reservation.seat_column).filter(
+            models.Reservation.onibus_id == onibus_id
+        ).all()
+        vagas = db.query(models.Onibus.vagas).filter(models.Onibus.id == onibus_id).scalar()
+        oversold = len(reservations) - len(set(reservations))
+        print(f"booked={booked} rows={len(reservations)} oversold={oversold} vagas={vagas} capacity={capacity} errors={len(errors)}")
+        for error in sorted(set(errors))[:5]:
+            print(f"  {error}")
+        assert not errors, f"{len(errors)} of {buyers} buyers failed with an error"
+        assert oversold == 0, "seat sold more than once"
+        assert booked == len(reservations), "reported bookings do not match reservation rows"
+        assert vagas == capacity - len(reservations), "vagas counter lost updates"
+    finally:
+        db.query(models.Reservation).filter(models.Reservation.onibus_id == onibus_id).delete()
+        db.query(models.OnibusSummary).filter(models.OnibusSummary.onibus_id == onibus_id).delete()
+        db.query(models.Onibus).filter(models.Onibus.id == onibus_id).delete()
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    stress()
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Optional
+
+from fastapi import UploadFile
+
+from metrics import outbound
+
+
+# Bytes read from the upload and written to the backend at a time
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Threads doing blocking upload I/O, and uploads allowed in flight per process
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+
+
+class StorageBackend:
+    # Blocking interface, store_upload runs it off the event loop
+
+    def save(self, path: str, file: BinaryIO, content_type: Optional[str]) -> str:
+        raise NotImplementedError
+
+
+class FirebaseStorage(StorageBackend):
+
+    def __init__(self, bucket_factory: Callable):
+        # The bucket is resolved on first use, so the app can start without credentials
+        self.bucket_factory = bucket_factory
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            with self._lock:
+                if self._bucket is None:
+                    self._bucket = self.bucket_factory()
+        return self._bucket
+
+    def save(self, path: str, file: BinaryIO, content_type: Optional[str]) -> str:
+        with outbound("firebase", "upload"):
+            blob = self.bucket.blob(path)
+            blob.chunk_size = UPLOAD_CHUNK_SIZE  # Resumable upload sent chunk by chunk, multiple of 256 KB
+            blob.upload_from_file(file, content_type=content_type)
+            blob.make_public()
+            return blob.public_url
+
+
+class LocalStorage(StorageBackend):
+
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def full_path(self, path: str) -> str:
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, full_path]) != self.root:
+            raise ValueError(f"Invalid storage path: {path}")
+        return full_path
+
+    def save(self, path: str, file: BinaryIO, content_type: Optional[str]) -> str:
+        full_path = self.full_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Copied chunk by chunk into a temp file, readers never see a half written file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as buffer:
+                shutil.copyfileobj(file, buffer, UPLOAD_CHUNK_SIZE)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return f"{self.base_url}/{path}"
+
+
+_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def safe_filename(filename: Optional[str]) -> str:
+    return os.path.basename(filename or "") or "upload"
+
+
+async def store_upload(backend: StorageBackend, path: str, file: UploadFile) -> str:
+    # Uploads run on a bounded thread pool, at most UPLOAD_CONCURRENCY at a time,
+    # so a large photo never blocks the event loop for other requests
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    async with _semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, backend.save, path, file.file, file.content_type)
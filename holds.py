@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# Seats of a PIX payment are held for this many seconds after it is created, each status poll
+# of the checkout page pushes the expiry back, up to SEAT_HOLD_MAX after the hold was placed
+SEAT_HOLD_TTL = float(os.getenv("SEAT_HOLD_TTL", "300"))
+SEAT_HOLD_MAX = float(os.getenv("SEAT_HOLD_MAX", "1800"))  # PIX codes expire after 30 minutes
+# Timing wheel resolution and size, holds expire at most one tick late
+SEAT_HOLD_TICK = float(os.getenv("SEAT_HOLD_TICK", "1"))
+SEAT_HOLD_SLOTS = int(os.getenv("SEAT_HOLD_SLOTS", "512"))
+
+Seat = Tuple[int, int]
+
+
+class TimingWheel:
+    # Hashed timing wheel: keys are dropped in the slot of their deadline tick and a slot is
+    # only looked at when the wheel passes it, so scheduling and expiring are O(1) per key
+    # whatever the number of holds. A deadline more than one turn away stays in its slot
+    # until the right turn comes.
+
+    def __init__(self, tick: float = SEAT_HOLD_TICK, slots: int = SEAT_HOLD_SLOTS, now: Optional[float] = None):
+        self.tick = tick
+        self.slots: List[Dict[str, float]] = [{} for _ in range(slots)]
+        self.current = int((time.monotonic() if now is None else now) / tick)
+
+    def schedule(self, key: str, deadline: float):
+        tick = max(int(deadline / self.tick), self.current + 1)
+        self.slots[tick % len(self.slots)][key] = deadline
+
+    def advance(self, now: float) -> List[str]:
+        # Keys whose deadline passed since the last call
+        expired = []
+        target = int(now / self.tick)
+        # After a long stall one turn visits every slot, later ticks would see the same ones
+        for tick in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    expired.append(key)
+        self.current = max(self.current, target)
+        return expired
+
+
+class Hold:
+
+    __slots__ = ("owner", "onibus_id", "seats", "placed_at", "expires_at")
+
+    def __init__(self, owner: str, onibus_id: str, seats: List[Seat], placed_at: float, expires_at: float):
+        self.owner = owner
+        self.onibus_id = onibus_id
+        self.seats = seats
+        self.placed_at = placed_at
+        self.expires_at = expires_at
+
+
+class SeatHolds:
+    # Short lived, in-memory holds on the seats of pending payments, one hold per payment.
+    # Holds live in the worker that created the payment, the unique constraint on
+    # reservations still decides between workers.
+
+    def __init__(self, ttl: float = SEAT_HOLD_TTL, max_age: float = SEAT_HOLD_MAX, wheel: Optional[TimingWheel] = None):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.wheel = wheel or TimingWheel()
+        self._holds: Dict[str, Hold] = {}
+        self._buses: Dict[str, Dict[Seat, str]] = {}  # {onibus_id: {seat: owner}}
+        self._lock = threading.Lock()
+        # Called with (onibus_id, reserved, released, resync) like the seat map listeners
+        self.listeners: List[Callable] = []
+        self.placed = 0
+        self.expired = 0
+        self.converted = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add_listener(self, listener: Callable):
+        self.listeners.append(listener)
+
+    def _notify(self, onibus_id: str, reserved: List[Seat] = (), released: List[Seat] = ()):
+        for listener in self.listeners:
+            try:
+                listener(onibus_id, reserved, released, False)
+            except Exception as e:
+                print(f"Error notifying seat hold change of {onibus_id}: {e}")
+
+    def has(self, owner: str) -> bool:
+        with self._lock:
+            return owner in self._holds
+
+    def conflicts(self, onibus_id: str, seats: Iterable[Seat], owner: Optional[str] = None) -> List[Seat]:
+        # Seats held by another payment
+        with self._lock:
+            held = self._buses.get(onibus_id, {})
+            return [seat for seat in seats if held.get(seat, owner) != owner]
+
+    def hold(self, owner: str, onibus_id: str, seats: Iterable[Seat]) -> List[Seat]:
+        # Holds every seat or none, returns the seats held by someone else. Holding again
+        # for the same owner replaces its hold.
+        seats = sorted(set(tuple(seat) for seat in seats))
+        now = time.monotonic()
+        with self._lock:
+            held = self._buses.get(onibus_id, {})
+            taken = [seat for seat in seats if held.get(seat, owner) != owner]
+            if taken:
+                return taken
+            previous = self._drop(owner)
+            hold = Hold(owner, onibus_id, seats, now, now + self.ttl)
+            self._holds[owner] = hold
+            held = self._buses.setdefault(onibus_id, {})
+            for seat in seats:
+                held[seat] = owner
+            self.wheel.schedule(owner, hold.expires_at)
+            self.placed += 1
+        if previous is not None:
+            self._notify(previous.onibus_id, released=[seat for seat in previous.seats if previous.onibus_id != onibus_id or seat not in seats])
+        self._notify(onibus_id, reserved=seats)
+        return []
+
+    def refresh(self, owner: str) -> bool:
+        # Pushes the expiry back in memory only, the wheel entry is rescheduled when it comes up
+        now = time.monotonic()
+        with self._lock:
+            hold = self._holds.get(owner)
+            if hold is None:
+                return False
+            hold.expires_at = min(now + self.ttl, hold.placed_at + self.max_age)
+            return True
+
+    def release(self, owner: str) -> Optional[Hold]:
+        with self._lock:
+            hold = self._drop(owner)
+        if hold is not None:
+            self._notify(hold.onibus_id, released=hold.seats)
+        return hold
+
+    def convert(self, owner: str) -> Optional[Hold]:
+        # The payment was approved and its reservations written, the seats stay taken
+        with self._lock:
+            hold = self._drop(owner)
+            if hold is not None:
+                self.converted += 1
+        if hold is not None:
+            # Pairs with the seat map's reserve of the same seats, the push hub nets them out
+            self._notify(hold.onibus_id, released=hold.seats)
+        return hold
+
+    def _drop(self, owner: str) -> Optional[Hold]:
+        hold = self._holds.pop(owner, None)
+        if hold is not None:
+            held = self._buses.get(hold.onibus_id, {})
+            for seat in hold.seats:
+                if held.get(seat) == owner:
+                    del held[seat]
+            if not held:
+                self._buses.pop(hold.onibus_id, None)
+        return hold
+
+    def held(self, onibus_id: str) -> List[Seat]:
+        with self._lock:
+            return sorted(self._buses.get(onibus_id, ()))
+
+    def expire(self, now: Optional[float] = None) -> List[Hold]:
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            for owner in self.wheel.advance(now):
+                hold = self._holds.get(owner)
+                if hold is None:
+                    continue  # Released or converted meanwhile
+                if hold.expires_at > now:
+                    self.wheel.schedule(owner, hold.expires_at)  # Refreshed since it was scheduled
+                    continue
+                expired.append(self._drop(owner))
+            self.expired += len(expired)
+        for hold in expired:
+            self._notify(hold.onibus_id, released=hold.seats)
+        return expired
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="seat-holds", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.wheel.tick):
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"Error expiring seat holds: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "holds": len(self._holds),
+                "seats": sum(len(held) for held in self._buses.values()),
+                "placed": self.placed,
+                "expired": self.expired,
+                "converted": self.converted,
+            }
+
+
+seat_holds = SeatHolds()
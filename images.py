@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import io
+import mimetypes
+import os
+import tempfile
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from fastapi import BackgroundTasks, UploadFile
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import models
+from file_storage import UPLOAD_CHUNK_SIZE, StorageBackend, store_upload
+from response_cache import invalidate_onibus
+
+
+# Longest side in pixels of each derivative, the bus cards only need "card"
+DERIVATIVE_SIZES = {
+    "thumbnail": int(os.getenv("IMAGE_THUMBNAIL_SIZE", "160")),
+    "card": int(os.getenv("IMAGE_CARD_SIZE", "480")),
+    "full": int(os.getenv("IMAGE_FULL_SIZE", "1280")),
+}
+DERIVATIVE_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+
+# Onibus photo kinds and the columns they fill
+PHOTO_FIELDS = {
+    "home": ("foto_casa", "foto_casa_hash", "foto_casa_variants"),
+    "visita": ("foto_visita", "foto_visita_hash", "foto_visita_variants"),
+}
+
+
+def asset_path(digest: str, name: str) -> str:
+    # Content addressed, the same image always lands on the same paths
+    return f"images/{digest[:2]}/{digest}/{name}"
+
+
+def spool_and_hash(file: UploadFile) -> Tuple[str, str]:
+    # Copies the upload to a temp file while hashing it, the copy outlives the
+    # request so the derivative stage can read it in the background
+    sha256 = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(prefix="image-")
+    with os.fdopen(fd, "wb") as buffer:
+        while True:
+            chunk = file.file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            buffer.write(chunk)
+    file.file.seek(0)
+    return sha256.hexdigest(), temp_path
+
+
+def extension(file: UploadFile) -> str:
+    guessed = mimetypes.guess_extension(file.content_type or "") or os.path.splitext(file.filename or "")[1]
+    return guessed.lstrip(".") or "bin"
+
+
+def make_derivatives(source_path: str) -> Dict[str, Dict[str, bytes]]:
+    from PIL import Image, ImageOps  # Only the background stage needs Pillow
+
+    derivatives: Dict[str, Dict[str, bytes]] = {}
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+        for size, longest_side in DERIVATIVE_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((longest_side, longest_side), Image.LANCZOS)
+            derivatives[size] = {}
+            for name, (pil_format, _) in DERIVATIVE_FORMATS.items():
+                output = io.BytesIO()
+                resized.save(output, pil_format, quality=IMAGE_QUALITY, optimize=True)
+                derivatives[size][name] = output.getvalue()
+    return derivatives
+
+
+def set_bus_variants(db: Session, digest: str, variants: Dict[str, Dict[str, str]]) -> List[str]:
+    # Every bus pointing to this image gets the URLs, also the ones that reused it meanwhile
+    onibus_ids = set()
+    for _, hash_field, variants_field in PHOTO_FIELDS.values():
+        hash_column = getattr(models.Onibus, hash_field)
+        onibus_ids.update(onibus_id for onibus_id, in db.query(models.Onibus.id).filter(hash_column == digest))
+        db.query(models.Onibus).filter(hash_column == digest).update(
+            {getattr(models.Onibus, variants_field): variants}, synchronize_session=False
+        )
+    return list(onibus_ids)
+
+
+def process_image(session_factory: Callable[[], Session], backend: StorageBackend, digest: str, source_path: str):
+    # Background stage: resize, store the derivatives next to the original and publish their URLs
+    db = session_factory()
+    try:
+        try:
+            derivatives = make_derivatives(source_path)
+        except Exception as e:
+            print(f"Error creating derivatives of image {digest}: {e}")
+            db.query(models.ImageAsset).filter(models.ImageAsset.id == digest).update({models.ImageAsset.status: "failed"})
+            db.commit()
+            return
+
+        variants: Dict[str, Dict[str, str]] = {}
+        for size, formats in derivatives.items():
+            variants[size] = {}
+            for name, data in formats.items():
+                _, content_type = DERIVATIVE_FORMATS[name]
+                variants[size][name] = backend.save(asset_path(digest, f"{size}.{name}"), io.BytesIO(data), content_type)
+
+        db.query(models.ImageAsset).filter(models.ImageAsset.id == digest).update(
+            {models.ImageAsset.status: "ready", models.ImageAsset.variants: variants}
+        )
+        onibus_ids = set_bus_variants(db, digest, variants)
+        db.commit()
+        invalidate_onibus(*onibus_ids)
+    except Exception as e:
+        print(f"Error processing image {digest}: {e}")
+        db.rollback()
+    finally:
+        db.close()
+        os.unlink(source_path)
+
+
+async def store_bus_photo(
+    db: AsyncSession,
+    session_factory: Callable[[], Session],
+    backend: StorageBackend,
+    onibus: models.Onibus,
+    kind: str,
+    file: UploadFile,
+    background_tasks: BackgroundTasks,
+) -> str:
+    url_field, hash_field, variants_field = PHOTO_FIELDS[kind]
+    loop = asyncio.get_running_loop()
+    digest, temp_path = await loop.run_in_executor(None, spool_and_hash, file)
+
+    asset = await db.get(models.ImageAsset, digest)
+    if asset and asset.status != "failed":
+        # Same image uploaded before, reuse the stored original and derivatives
+        os.unlink(temp_path)
+    else:
+        original_url = await store_upload(backend, asset_path(digest, f"original.{extension(file)}"), file)
+        if asset is None:
+            asset = models.ImageAsset(id=digest, original_url=original_url, content_type=file.content_type, status="pending", created_at=datetime.now())
+            db.add(asset)
+        else:
+            asset.original_url = original_url
+            asset.status = "pending"
+        try:
+            await db.flush()
+        except IntegrityError:
+            # Another upload of the same image won the race, its stage makes the derivatives
+            await db.rollback()
+            os.unlink(temp_path)
+            asset = await db.get(models.ImageAsset, digest)
+        else:
+            background_tasks.add_task(process_image, session_factory, backend, digest, temp_path)
+
+    setattr(onibus, url_field, asset.original_url)
+    setattr(onibus, hash_field, digest)
+    setattr(onibus, variants_field, asset.variants if asset.status == "ready" else None)
+    await db.commit()
+    return asset.original_url
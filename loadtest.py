@@ -0,0 +1,352 @@
+import asyncio
+import json
+import os
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Match-day load test. Runs the app from test.py under uvicorn against the database configured
+# in database.py (use a local one), with stand-ins for every external service:
+#   Mercado Pago     -> mercadopago_gateway.stand_in
+#   SMTP             -> SMTPStandIn below
+#   Firebase Storage -> STORAGE_BACKEND=local
+#
+#   python loadtest.py run [seconds] [users per scenario]
+#   python loadtest.py compare <before.json> <after.json>
+
+LOADTEST_PORT = int(os.getenv("LOADTEST_PORT", "8765"))
+LOADTEST_BUSES = int(os.getenv("LOADTEST_BUSES", "20"))
+LOADTEST_ROWS = int(os.getenv("LOADTEST_ROWS", "12"))
+LOADTEST_COLUMNS = int(os.getenv("LOADTEST_COLUMNS", "4"))
+LOADTEST_RESULTS_DIR = os.getenv("LOADTEST_RESULTS_DIR", "loadtest-results")
+
+# Statuses a scenario expects besides 2xx: revalidated, seat sold to somebody else, turned away by admission control
+EXPECTED_STATUSES = {304, 409, 429}
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # Accepts any mail and drops it, enough for smtplib and the outbox worker
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 loadtest ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 loadtest")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.messages += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")  # MAIL, RCPT, NOOP, RSET
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.messages = 0
+        threading.Thread(target=self.serve_forever, name="smtp-stand-in", daemon=True).start()
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, endpoint: str, status_code: Optional[int], seconds: float):
+        self.latencies[endpoint].append(seconds)
+        if status_code is None or (status_code >= 400 and status_code not in EXPECTED_STATUSES):
+            self.errors[endpoint] += 1
+
+    def report(self, duration: float) -> Dict[str, dict]:
+        report = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            report[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "throughput": len(latencies) / duration,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+        return report
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class Scenarios:
+    # Each scenario is a virtual user looping until the deadline
+
+    def __init__(self, client, recorder: Recorder, run: str, deadline: float):
+        self.client = client
+        self.recorder = recorder
+        self.run = run
+        self.deadline = deadline
+        self.buses = [f"loadtest-{run}-bus-{i}" for i in range(LOADTEST_BUSES)]
+        self.hot_bus = self.buses[0]
+        self.payments: List[str] = []
+
+    async def call(self, endpoint: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status_code = response.status_code
+        except Exception:
+            response, status_code = None, None
+        self.recorder.record(endpoint, status_code, time.perf_counter() - started)
+        return response
+
+    async def browse(self, user: int):
+        # Catalog page, then a few buses, revalidating with the ETag like a browser would
+        etags: Dict[str, str] = {}
+        while time.monotonic() < self.deadline:
+            response = await self.call("GET /onibus/", "GET", "/onibus/?limit=20")
+            for _ in range(3):
+                url = f"/onibus/{random.choice(self.buses)}"
+                headers = {"If-None-Match": etags[url]} if url in etags else {}
+                response = await self.call("GET /onibus/{id}", "GET", url, headers=headers)
+                if response is not None and response.headers.get("etag"):
+                    etags[url] = response.headers["etag"]
+
+    async def seat_maps(self, user: int):
+        while time.monotonic() < self.deadline:
+            bus = self.hot_bus if random.random() < 0.5 else random.choice(self.buses)
+            await self.call("GET /reserve/onibus/{id}/seats", "GET", f"/reserve/onibus/{bus}/seats")
+            await asyncio.sleep(0.05)
+
+    async def entry_token(self) -> dict:
+        # Queue in the waiting room like a fan on sale day, {} when it cannot be joined
+        response = await self.call("POST /waiting-room", "POST", "/waiting-room")
+        if response is None or response.status_code != 201:
+            return {}
+        ticket = response.json()["ticket"]
+        while time.monotonic() < self.deadline:
+            response = await self.call("GET /waiting-room/{ticket}", "GET", f"/waiting-room/{ticket}")
+            if response is None or response.status_code != 200:
+                return {}
+            position = response.json()
+            if "entry_token" in position:
+                return {"X-Entry-Token": position["entry_token"]}
+            await asyncio.sleep(min(1.0, max(0.1, position["estimated_wait"] or 0)))
+        return {}
+
+    async def reserve_burst(self, user: int):
+        # Everybody fights for the same bus, most attempts end in a 409
+        headers = await self.entry_token()
+        while time.monotonic() < self.deadline:
+            seats = [{"row": random.randrange(LOADTEST_ROWS), "column": random.randrange(LOADTEST_COLUMNS)} for _ in range(random.randint(1, 3))]
+            await self.call("POST /reserve/{id}", "POST", f"/reserve/{self.hot_bus}", headers=headers, json={"client_id": f"loadtest-{self.run}-client-{user}", "seats": seats})
+
+    async def payments_flow(self, user: int):
+        # Create a payment, poll its status and let Mercado Pago deliver its webhook, twice
+        i = 0
+        while time.monotonic() < self.deadline:
+            i += 1
+            # The stand-in answers by prefix: approved-* is approved, busy-* stays pending
+            payment_id = f"{'approved' if random.random() < 0.5 else 'busy'}-{self.run}-{user}-{i}"
+            bus = random.choice(self.buses[1:])
+            await self.call("POST /create_db_payment", "POST", "/create_db_payment", json={
+                "transaction_amount": 100,
+                "email": f"loadtest-{user}@example.com",
+                "client_id": f"loadtest-{self.run}-client-{user}",
+                "onibus_id": bus,
+                "payment_id": payment_id,
+                "status": "pending",
+                "timestamp": datetime.now().isoformat(),
+                "approved": "false",
+                "seats": [{"row": random.randrange(LOADTEST_ROWS), "column": random.randrange(LOADTEST_COLUMNS)}],
+            })
+            self.payments.append(payment_id)
+            for _ in range(2):
+                await self.call("GET /payments/status/{id}", "GET", f"/payments/status/{payment_id}")
+            notification = {
+                "id": f"loadtest-{self.run}-{user}-{i}",
+                "action": "payment.updated",
+                "api_version": "v1",
+                "data": {"id": payment_id},
+                "date_created": datetime.now().isoformat(),
+                "live_mode": False,
+                "type": "payment",
+                "user_id": "loadtest",
+            }
+            for _ in range(2):
+                await self.call("POST /notification", "POST", "/notification", json=notification)
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def seed(run: str, users: int):
+    from database import SessionLocal
+    import models
+
+    db = SessionLocal()
+    try:
+        for user in range(users):
+            db.add(models.Client(id=f"loadtest-{run}-client-{user}", nome=f"loadtest {user}", email=f"loadtest-{user}@example.com", role="user", confirmed=True))
+        for i in range(LOADTEST_BUSES):
+            db.add(models.Onibus(id=f"loadtest-{run}-bus-{i}", evento=f"loadtest {i % 3}", descricao="loadtest", horario="20:00", vagas=LOADTEST_ROWS * LOADTEST_COLUMNS))
+        db.commit()
+    finally:
+        db.close()
+
+
+def cleanup(run: str):
+    from database import SessionLocal
+    import models
+
+    prefix = f"loadtest-{run}-%"
+    db = SessionLocal()
+    try:
+        payment_ids = [payment_id for payment_id, in db.query(models.Payment.payment_id).filter(models.Payment.client_id.like(prefix))]
+        db.query(models.PaymentMonitorJob).filter(models.PaymentMonitorJob.payment_id.in_(payment_ids)).delete(synchronize_session=False)
+        db.query(models.WebhookEvent).filter(models.WebhookEvent.id.like(prefix)).delete(synchronize_session=False)
+        db.query(models.EmailOutbox).filter(models.EmailOutbox.to_email.like("loadtest-%@example.com")).delete(synchronize_session=False)
+        db.query(models.Payment).filter(models.Payment.client_id.like(prefix)).delete(synchronize_session=False)
+        db.query(models.Reservation).filter(models.Reservation.onibus_id.like(prefix)).delete(synchronize_session=False)
+        db.query(models.OnibusSummary).filter(models.OnibusSummary.onibus_id.like(prefix)).delete(synchronize_session=False)
+        db.query(models.Onibus).filter(models.Onibus.id.like(prefix)).delete(synchronize_session=False)
+        db.query(models.Client).filter(models.Client.id.like(prefix)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def run(duration: float = 30, users: int = 10) -> dict:
+    # Settings are read on import, so the environment is pointed at the stand-ins before
+    # mercadopago_gateway or test.py are imported
+    mercadopago_port = free_port()
+    smtp = SMTPStandIn()
+    os.environ.update({
+        "MERCADO_PAGO_API_URL": f"http://127.0.0.1:{mercadopago_port}",
+        "MERCADO_PAGO_ACCESS_TOKEN": "loadtest",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp.server_address[1]),
+        "SMTP_SSL": "false",
+        "GMAIL_USER": "",
+        "GMAIL_PASSWORD": "",
+        "STORAGE_BACKEND": "local",
+        # Admission control is off by default, the sale day scenarios go through it
+        "ADMISSION_ENABLED": "true",
+        "ADMISSION_SECRET": "loadtest",
+    })
+
+    import httpx
+    import uvicorn
+    from mercadopago_gateway import stand_in
+
+    mercadopago = stand_in(mercadopago_port)
+    import test
+
+    server = uvicorn.Server(uvicorn.Config(test.app, host="127.0.0.1", port=LOADTEST_PORT, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="loadtest-app", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    run_id = uuid.uuid4().hex[:8]
+    seed(run_id, users)
+    recorder = Recorder()
+
+    async def drive():
+        limits = httpx.Limits(max_connections=users * 4, max_keepalive_connections=users * 4)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{LOADTEST_PORT}", limits=limits, timeout=30) as client:
+            scenarios = Scenarios(client, recorder, run_id, time.monotonic() + duration)
+            await asyncio.gather(*(
+                scenario(user)
+                for scenario in (scenarios.browse, scenarios.seat_maps, scenarios.reserve_burst, scenarios.payments_flow)
+                for user in range(users)
+            ))
+
+    started = time.perf_counter()
+    try:
+        asyncio.run(drive())
+        elapsed = time.perf_counter() - started
+    finally:
+        server.should_exit = True
+        thread.join(10)
+        cleanup(run_id)
+        mercadopago.shutdown()
+        smtp.shutdown()
+
+    results = {
+        "run": run_id,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "duration": elapsed,
+        "users_per_scenario": users,
+        "endpoints": recorder.report(elapsed),
+        "mercadopago_requests": mercadopago.requests,
+        "emails_sent": smtp.messages,
+    }
+    print_report(results)
+    os.makedirs(LOADTEST_RESULTS_DIR, exist_ok=True)
+    path = os.path.join(LOADTEST_RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{run_id}.json")
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved to {path}")
+    return results
+
+
+def print_report(results: dict):
+    print(f"{'endpoint':34} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint, row in results["endpoints"].items():
+        print(f"{endpoint:34} {row['requests']:9d} {row['errors']:7d} {row['throughput']:8.1f} {row['p50_ms']:8.1f} {row['p95_ms']:8.1f} {row['p99_ms']:8.1f}")
+    print(f"mercadopago requests={results['mercadopago_requests']} emails sent={results['emails_sent']}")
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as file:
+        before = json.load(file)["endpoints"]
+    with open(after_path) as file:
+        after = json.load(file)["endpoints"]
+    print(f"{'endpoint':34} {'req/s':>16} {'p95 ms':>18} {'p99 ms':>18}")
+    for endpoint in sorted(set(before) | set(after)):
+        old, new = before.get(endpoint), after.get(endpoint)
+        if not old or not new:
+            print(f"{endpoint:34} only in {'after' if new else 'before'}")
+            continue
+        print(
+            f"{endpoint:34} {old['throughput']:7.1f} -> {new['throughput']:6.1f}"
+            f" {old['p95_ms']:8.1f} -> {new['p95_ms']:7.1f} {old['p99_ms']:8.1f} -> {new['p99_ms']:7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("run", [])
+    if command == "compare" and len(args) == 2:
+        compare(*args)
+    elif command == "run":
+        run(*(float(arg) for arg in args[:1]), *(int(arg) for arg in args[1:2]))
+    else:
+        print("usage: python loadtest.py run [seconds] [users] | compare <before.json> <after.json>")
+        sys.exit(2)
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from string import Template
+from typing import Dict, Iterable, List, Tuple
+
+
+TEMPLATE_DIR = os.getenv("TEMPLATE_DIR", os.path.dirname(os.path.abspath(__file__)))
+# Seconds between two mtime checks of the same template file
+TEMPLATE_CHECK_INTERVAL = float(os.getenv("TEMPLATE_CHECK_INTERVAL", "1"))
+
+RESERVATION_TEMPLATE = "email_template.html"
+PAYMENT_CONFIRMED_TEMPLATE = "email_payment_confirmed.html"
+
+
+class CompiledTemplate:
+    # string.Template syntax ($name, ${name}, $$) split once into literal text and
+    # placeholder names, rendering is then a single join
+
+    def __init__(self, source: str):
+        self.literals: List[str] = []
+        self.names: List[str] = []
+        literal = ""
+        position = 0
+        for match in Template.pattern.finditer(source):
+            literal += source[position:match.start()]
+            position = match.end()
+            if match.group("escaped") is not None:
+                literal += "$"
+            elif match.group("named") or match.group("braced"):
+                self.literals.append(literal)
+                self.names.append(match.group("named") or match.group("braced"))
+                literal = ""
+            else:
+                raise ValueError(f"Invalid placeholder in template at position {match.start()}")
+        self.literals.append(literal + source[position:])
+
+    def render(self, values: Dict[str, object]) -> str:
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            parts.append(str(values[name]))
+            parts.append(literal)
+        return "".join(parts)
+
+
+class TemplateCache:
+    # Templates are read and compiled once and only reloaded when the file's mtime changes
+
+    def __init__(self, directory: str = TEMPLATE_DIR, check_interval: float = TEMPLATE_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._templates: Dict[str, Tuple[int, float, CompiledTemplate]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CompiledTemplate:
+        cached = self._templates.get(name)
+        now = time.monotonic()
+        if cached and now - cached[1] < self.check_interval:
+            return cached[2]
+
+        path = os.path.join(self.directory, name)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._templates.get(name)
+            if cached and cached[0] == mtime:
+                self._templates[name] = (mtime, now, cached[2])
+                return cached[2]
+            with open(path, "r", encoding="utf-8") as file:
+                template = CompiledTemplate(file.read())
+            self._templates[name] = (mtime, now, template)
+            return template
+
+    def render(self, name: str, **values) -> str:
+        return self.get(name).render(values)
+
+    def render_many(self, name: str, recipients: Iterable[Dict[str, object]]) -> List[str]:
+        # One body per recipient for broadcast notices, the template is looked up once
+        template = self.get(name)
+        return [template.render(values) for values in recipients]
+
+
+templates = TemplateCache()
+
+
+def render_reservation_email(client_id: str, onibus_id: str, seats: Iterable[object]) -> str:
+    return templates.render(RESERVATION_TEMPLATE, client_id=client_id, onibus_id=onibus_id, seats=", ".join(str(seat) for seat in seats))
+
+
+def render_payment_confirmed_email(client_id: str, onibus_id: str, seats: Iterable[object]) -> str:
+    return templates.render(PAYMENT_CONFIRMED_TEMPLATE, client_id=client_id, onibus_id=onibus_id, seats="".join(f"<li>{seat}</li>" for seat in seats))
+
+
+def benchmark(emails: int = 10000):
+    # Per-email render cost of the old path (read and parse the file every time) and of the cache
+    seats = [{"row": 1, "column": 2}, {"row": 1, "column": 3}]
+    path = os.path.join(TEMPLATE_DIR, RESERVATION_TEMPLATE)
+
+    started = time.perf_counter()
+    for i in range(emails):
+        with open(path, "r", encoding="utf-8") as file:
+            template = Template(file.read())
+        template.substitute(client_id=f"client-{i}", onibus_id="onibus-1", seats=", ".join(str(seat) for seat in seats))
+    old = (time.perf_counter() - started) / emails
+
+    started = time.perf_counter()
+    for i in range(emails):
+        render_reservation_email(f"client-{i}", "onibus-1", seats)
+    cached = (time.perf_counter() - started) / emails
+
+    started = time.perf_counter()
+    templates.render_many(RESERVATION_TEMPLATE, ({"client_id": f"client-{i}", "onibus_id": "onibus-1", "seats": "1,2"} for i in range(emails)))
+    broadcast = (time.perf_counter() - started) / emails
+
+    print(f"load_template + substitute: {old * 1e6:8.2f} us/email")
+    print(f"cached render:              {cached * 1e6:8.2f} us/email")
+    print(f"render_many:                {broadcast * 1e6:8.2f} us/email")
+
+
+if __name__ == "__main__":
+    benchmark()
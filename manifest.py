@@ -0,0 +1,189 @@
+import csv
+import io
+import os
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+import models
+from pagination import TIMESTAMP_FORMAT, dumps
+
+
+# Rows fetched from the server-side cursor at a time
+MANIFEST_CHUNK_SIZE = int(os.getenv("MANIFEST_CHUNK_SIZE", "500"))
+# Passenger lines per PDF page (A4, 10pt)
+MANIFEST_PDF_LINES = int(os.getenv("MANIFEST_PDF_LINES", "50"))
+
+MANIFEST_FIELDS = ["seat_row", "seat_column", "nome", "telefone", "email", "client_id", "confirmed", "payment_status", "payment_id"]
+MANIFEST_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "pdf": "application/pdf",
+}
+
+
+def manifest_query(onibus_id: str):
+    # One row per reserved seat with its passenger and the payment of that passenger for the
+    # bus. A client with several payments for the bus gets the approved one, else the latest.
+    ranked = select(
+        models.Payment.client_id,
+        models.Payment.status,
+        models.Payment.payment_id,
+        func.row_number().over(
+            partition_by=models.Payment.client_id,
+            order_by=(case((models.Payment.status == "approved", 0), else_=1), models.Payment.timestamp.desc()),
+        ).label("rank"),
+    ).where(models.Payment.onibus_id == onibus_id).subquery()
+
+    return (
+        select(
+            models.Reservation.seat_row,
+            models.Reservation.seat_column,
+            models.Client.nome,
+            models.Client.telefone,
+            models.Client.email,
+            models.Reservation.client_id,
+            models.Reservation.confirmed,
+            ranked.c.status.label("payment_status"),
+            ranked.c.payment_id,
+        )
+        .select_from(models.Reservation)
+        .outerjoin(models.Client, models.Client.id == models.Reservation.client_id)
+        .outerjoin(ranked, (ranked.c.client_id == models.Reservation.client_id) & (ranked.c.rank == 1))
+        .where(models.Reservation.onibus_id == onibus_id)
+        .order_by(models.Reservation.seat_row, models.Reservation.seat_column)
+    )
+
+
+def manifest_rows(session_factory, onibus_id: str, chunk_size: int = MANIFEST_CHUNK_SIZE) -> Iterator[list]:
+    # Chunks of rows read through a server-side cursor with its own session, the request
+    # session is closed by the time a streaming body is consumed
+    db: Session = session_factory()
+    try:
+        result = db.execute(manifest_query(onibus_id).execution_options(stream_results=True, yield_per=chunk_size))
+        for rows in result.partitions():
+            yield rows
+    finally:
+        db.close()
+
+
+def manifest_row(row) -> dict:
+    return dict(zip(MANIFEST_FIELDS, row))
+
+
+def csv_chunks(chunks: Iterable[list]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    # BOM so Excel opens the accents right
+    buffer.write("\ufeff")
+    writer.writerow(MANIFEST_FIELDS)
+    yield flush()  # Sent before the query runs
+    for rows in chunks:
+        writer.writerows(["" if value is None else value for value in row] for row in rows)
+        yield flush()
+
+
+def ndjson_chunks(chunks: Iterable[list]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield b"".join(dumps(manifest_row(row)) + b"\n" for row in rows)
+
+
+class PdfWriter:
+    # Minimal text-only PDF written object by object: pages are sent as soon as they are
+    # full, only the byte offsets of the objects are kept until the cross-reference table.
+    # Object 1 is the catalog, 2 the page tree and 3 the font, all written at the end.
+
+    PAGE_WIDTH = 595
+    PAGE_HEIGHT = 842
+    MARGIN = 40
+    LEADING = 13
+
+    def __init__(self):
+        self.offsets = {}
+        self.position = 0
+        self.pages: List[int] = []
+        self.next_id = 4
+
+    def _object(self, object_id: int, body: bytes) -> bytes:
+        data = b"%d 0 obj\n" % object_id + body + b"\nendobj\n"
+        self.offsets[object_id] = self.position
+        self.position += len(data)
+        return data
+
+    def start(self) -> bytes:
+        data = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        self.position += len(data)
+        return data
+
+    def page(self, lines: Sequence[str]) -> bytes:
+        text = [b"BT /F1 10 Tf %d TL %d %d Td" % (self.LEADING, self.MARGIN, self.PAGE_HEIGHT - self.MARGIN)]
+        for line in lines:
+            text.append(b"(" + escape(line) + b") Tj T*")
+        text.append(b"ET")
+        stream = b"\n".join(text)
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self.pages.append(page_id)
+        return self._object(content_id, b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream") + self._object(
+            page_id,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (self.PAGE_WIDTH, self.PAGE_HEIGHT, content_id),
+        )
+
+    def finish(self) -> bytes:
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.pages)
+        data = self._object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+        data += self._object(2, b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(self.pages))
+        data += self._object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = [b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id]
+        for object_id in range(1, self.next_id):
+            xref.append(b"%010d 00000 n \n" % self.offsets[object_id])
+        xref.append(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_id, self.position))
+        return data + b"".join(xref)
+
+
+def escape(text: str) -> bytes:
+    # Helvetica with WinAnsiEncoding covers the accents of Portuguese names
+    data = text.encode("cp1252", errors="replace")
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def pdf_line(row) -> str:
+    seat_row, seat_column, nome, telefone, email, client_id, confirmed, payment_status, payment_id = row
+    seat = f"{seat_row},{seat_column}"
+    return f"{seat:>7}  {(nome or client_id or '')[:32]:32}  {(telefone or '')[:16]:16}  {payment_status or 'sem pagamento'}"
+
+
+def pdf_chunks(chunks: Iterable[list], title: str, lines_per_page: int = MANIFEST_PDF_LINES) -> Iterator[bytes]:
+    writer = PdfWriter()
+    yield writer.start()
+    header = [title, f"Gerado em {datetime.now().strftime(TIMESTAMP_FORMAT)}", "", f"{'Assento':>7}  {'Nome':32}  {'Telefone':16}  Pagamento", ""]
+    lines: List[str] = []
+    passengers = 0
+    for rows in chunks:
+        for row in rows:
+            if len(lines) == lines_per_page:
+                yield writer.page(header + lines)
+                lines = []
+            lines.append(pdf_line(row))
+            passengers += 1
+    yield writer.page(header + lines + ["", f"Total: {passengers} passageiros"])
+    yield writer.finish()
+
+
+def manifest_chunks(session_factory, onibus_id: str, format: str, title: Optional[str] = None) -> Iterator[bytes]:
+    chunks = manifest_rows(session_factory, onibus_id)
+    if format == "csv":
+        return csv_chunks(chunks)
+    if format == "ndjson":
+        return ndjson_chunks(chunks)
+    return pdf_chunks(chunks, title or f"Lista de embarque {onibus_id}")
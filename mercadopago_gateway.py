@@ -0,0 +1,401 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from metrics import outbound
+from singleflight import AsyncSingleFlight, FlightStats, SingleFlight
+
+
+# Point MERCADO_PAGO_API_URL at the stand-in (`python mercadopago_gateway.py standin`) to work offline
+MERCADO_PAGO_API_URL = os.getenv("MERCADO_PAGO_API_URL", "https://api.mercadopago.com")
+MP_CONNECT_TIMEOUT = float(os.getenv("MP_CONNECT_TIMEOUT", "3"))
+MP_READ_TIMEOUT = float(os.getenv("MP_READ_TIMEOUT", "10"))
+# Connections kept open to Mercado Pago per client, a status check then skips the TLS handshake
+MP_MAX_CONNECTIONS = int(os.getenv("MP_MAX_CONNECTIONS", "20"))
+MP_KEEPALIVE_CONNECTIONS = int(os.getenv("MP_KEEPALIVE_CONNECTIONS", "10"))
+# Consecutive failures that open the breaker, and seconds before a trial call is let through
+MP_BREAKER_FAILURES = int(os.getenv("MP_BREAKER_FAILURES", "5"))
+MP_BREAKER_RESET = float(os.getenv("MP_BREAKER_RESET", "30"))
+# Final statuses are reused this long, a refund or chargeback shows up after it expires
+MP_STATUS_CACHE_TTL = float(os.getenv("MP_STATUS_CACHE_TTL", "300"))
+MP_STATUS_CACHE_SIZE = int(os.getenv("MP_STATUS_CACHE_SIZE", "10000"))
+
+TERMINAL_STATUSES = {"approved", "rejected", "cancelled", "refunded", "charged_back"}
+
+
+class GatewayError(Exception):
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GatewayUnavailable(GatewayError):
+    # Mercado Pago is timing out or failing, or the breaker is open
+    pass
+
+
+class CircuitBreaker:
+    # closed -> open after `failures` consecutive failures -> half open after `reset` seconds,
+    # where one trial call decides between closed and open again
+
+    def __init__(self, failures: int = MP_BREAKER_FAILURES, reset: float = MP_BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset:
+                self.state = "half_open"
+            if self.state == "open" or (self.state == "half_open" and self._trial_running):
+                self.rejected += 1
+                raise GatewayUnavailable("Mercado Pago circuit breaker is open", 503)
+            if self.state == "half_open":
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failures:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        # The call ended without telling anything about Mercado Pago (cancelled), the next
+        # call may try again
+        with self._lock:
+            self._trial_running = False
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures, "rejected": self.rejected}
+
+
+class StatusCache:
+
+    def __init__(self, ttl: float = MP_STATUS_CACHE_TTL, size: int = MP_STATUS_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._statuses: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, payment_id: str) -> Optional[str]:
+        with self._lock:
+            cached = self._statuses.get(payment_id)
+            if cached and cached[1] > time.monotonic():
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+            return None
+
+    def put(self, payment_id: str, status: str):
+        if status not in TERMINAL_STATUSES:
+            return
+        with self._lock:
+            self._statuses[payment_id] = (status, time.monotonic() + self.ttl)
+            self._statuses.move_to_end(payment_id)
+            while len(self._statuses) > self.size:
+                self._statuses.popitem(last=False)
+
+
+def operation_name(method: str, path: str) -> str:
+    # "GET /v1/payments/123" -> "GET /v1/payments", ids would make one series per payment
+    return f"{method} {'/'.join(path.split('/')[:3])}"
+
+
+class MercadoPagoGateway:
+    # The only place that talks to Mercado Pago. Routes use the async client, the monitor and
+    # webhook threads the sync one; both keep connections alive and share the breaker and cache.
+
+    def __init__(self, base_url: str = MERCADO_PAGO_API_URL, access_token: Optional[str] = None):
+        self.base_url = base_url.rstrip("/")
+        self.access_token = access_token or os.getenv("MERCADO_PAGO_ACCESS_TOKEN")
+        self.timeout = httpx.Timeout(MP_READ_TIMEOUT, connect=MP_CONNECT_TIMEOUT)
+        self.limits = httpx.Limits(max_connections=MP_MAX_CONNECTIONS, max_keepalive_connections=MP_KEEPALIVE_CONNECTIONS)
+        self.breaker = CircuitBreaker()
+        self.statuses = StatusCache()
+        # Polls of the same payment that overlap share one upstream call, the stats cover both clients
+        self.flight_stats = FlightStats()
+        self._status_flights = SingleFlight(self.flight_stats)
+        self._async_status_flights = AsyncSingleFlight(self.flight_stats)
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.access_token}", "Content-Type": "application/json"}
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(base_url=self.base_url, headers=self.headers(), timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers(), timeout=self.timeout, limits=self.limits)
+        return self._async_client
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def _result(self, response: httpx.Response) -> dict:
+        # 5xx and 429 mean Mercado Pago is struggling, other errors are about the request
+        if response.status_code >= 500 or response.status_code == 429:
+            self.breaker.record_failure()
+            raise GatewayUnavailable(f"Mercado Pago answered {response.status_code}", response.status_code)
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            raise GatewayError(f"Mercado Pago answered {response.status_code}: {response.text[:200]}", response.status_code)
+        return response.json()
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        self.breaker.before_call()
+        # Answers that raise (5xx, 4xx) count as errors of the call too
+        with outbound("mercadopago", operation_name(method, path)):
+            try:
+                response = self.client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                self.breaker.record_failure()
+                raise GatewayUnavailable(f"Mercado Pago request failed: {e!r}", 503)
+            except Exception:
+                # Anything unexpected is a failure too, a half open trial must always settle
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled, e.g. the client went away
+                self.breaker.release_trial()
+                raise
+            return self._result(response)
+
+    async def request_async(self, method: str, path: str, **kwargs) -> dict:
+        self.breaker.before_call()
+        # Answers that raise (5xx, 4xx) count as errors of the call too
+        with outbound("mercadopago", operation_name(method, path)):
+            try:
+                response = await self.async_client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                self.breaker.record_failure()
+                raise GatewayUnavailable(f"Mercado Pago request failed: {e!r}", 503)
+            except Exception:
+                # Anything unexpected is a failure too, a half open trial must always settle
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled, e.g. the client went away
+                self.breaker.release_trial()
+                raise
+            return self._result(response)
+
+    def payment_status(self, payment_id: str) -> str:
+        status = self.statuses.get(payment_id)
+        if status is None:
+            status = self._status_flights.do(payment_id, lambda: self.request("GET", f"/v1/payments/{payment_id}")["status"])
+            self.statuses.put(payment_id, status)
+        return status
+
+    async def payment_status_async(self, payment_id: str) -> str:
+        status = self.statuses.get(payment_id)
+        if status is None:
+            async def fetch():
+                return (await self.request_async("GET", f"/v1/payments/{payment_id}"))["status"]
+
+            status = await self._async_status_flights.do(payment_id, fetch)
+            self.statuses.put(payment_id, status)
+        return status
+
+    async def create_payment_async(self, payment_request: dict, idempotency_key: Optional[str] = None) -> dict:
+        # The key makes a retried create return the first payment instead of charging twice
+        headers = {"X-Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        return await self.request_async("POST", "/v1/payments", json=payment_request, headers=headers)
+
+    def stats(self) -> Dict:
+        return {
+            "breaker": self.breaker.snapshot(),
+            "status_cache": {"hits": self.statuses.hits, "misses": self.statuses.misses},
+            "single_flight": self.flight_stats.snapshot(),
+        }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Just enough of the payments API. Ids starting with "slow" hang past the read timeout,
+    # "busy" answer after a short delay, "error" answers 500, "approved"/"rejected" are final,
+    # anything else is pending.
+    protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse can be observed
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send_json(self, status_code: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests += 1
+        payment_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        if payment_id.startswith("slow"):
+            time.sleep(self.server.slow_seconds)
+        elif payment_id.startswith("busy"):
+            time.sleep(0.05)
+        if payment_id.startswith("error"):
+            return self.send_json(500, {"message": "internal_error"})
+        status = self.server.payments.get(payment_id)
+        if status is None:
+            status = next((name for name in ("approved", "rejected") if payment_id.startswith(name)), "pending")
+        self.send_json(200, {"id": payment_id, "status": status})
+
+    def do_POST(self):
+        self.server.requests += 1
+        length = int(self.headers.get("Content-Length", 0))
+        payment_request = json.loads(self.rfile.read(length) or b"{}")
+        key = self.headers.get("X-Idempotency-Key")
+        payment_id = self.server.idempotency.setdefault(key, str(len(self.server.payments) + 1)) if key else str(len(self.server.payments) + 1)
+        self.server.payments.setdefault(payment_id, "pending")
+        self.send_json(201, {
+            "id": payment_id,
+            "status": "pending",
+            "transaction_amount": payment_request.get("transaction_amount"),
+            "point_of_interaction": {"transaction_data": {"ticket_url": f"http://stand-in/pix/{payment_id}"}},
+        })
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, slow_seconds: float):
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.payments: Dict[str, str] = {}
+        self.idempotency: Dict[str, str] = {}
+        self.connections = 0
+        self.requests = 0
+        self.slow_seconds = slow_seconds
+
+    def handle_error(self, request, client_address):
+        # The client giving up on a slow answer is expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def stand_in(port: int = 0, slow_seconds: float = MP_READ_TIMEOUT + 1) -> StandInServer:
+    server = StandInServer(port, slow_seconds)
+    threading.Thread(target=server.serve_forever, name="mercadopago-stand-in", daemon=True).start()
+    return server
+
+
+def check():
+    # Runs the gateway against the stand-in: connection reuse, final status cache,
+    # timeouts opening the breaker and a half open trial closing it again
+    import asyncio
+
+    server = stand_in(slow_seconds=0.5)
+    gateway = MercadoPagoGateway(f"http://127.0.0.1:{server.server_port}", access_token="TEST")
+    gateway.timeout = httpx.Timeout(0.2, connect=0.2)
+    gateway.breaker = CircuitBreaker(failures=3, reset=0.5)
+    try:
+        for i in range(20):
+            assert gateway.payment_status(f"pending-{i}") == "pending"
+        assert server.connections == 1, f"expected one kept-alive connection, got {server.connections}"
+
+        requests_before = server.requests
+        for _ in range(10):
+            assert gateway.payment_status("approved-1") == "approved"
+        assert server.requests == requests_before + 1, "final status was not cached"
+
+        for _ in range(3):
+            try:
+                gateway.payment_status("slow-1")
+            except GatewayUnavailable:
+                pass
+        assert gateway.breaker.state == "open", "timeouts did not open the breaker"
+        requests_before = server.requests
+        try:
+            gateway.payment_status("pending-1")
+            raise AssertionError("open breaker let a call through")
+        except GatewayUnavailable:
+            pass
+        assert server.requests == requests_before, "open breaker reached the server"
+
+        time.sleep(0.6)
+        assert gateway.payment_status("pending-1") == "pending"
+        assert gateway.breaker.state == "closed", "successful trial did not close the breaker"
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        requests_before = server.requests
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            statuses = list(executor.map(lambda _: gateway.payment_status("busy-sync"), range(20)))
+        assert set(statuses) == {"pending"} and server.requests <= requests_before + 2, "threaded polls were not coalesced"
+
+        async def create():
+            first = await gateway.create_payment_async({"transaction_amount": 10}, idempotency_key="order-1")
+            again = await gateway.create_payment_async({"transaction_amount": 10}, idempotency_key="order-1")
+            assert first["id"] == again["id"], "idempotency key was not sent"
+            statuses = await asyncio.gather(*(gateway.payment_status_async(f"pending-async-{i}") for i in range(10)))
+            assert set(statuses) == {"pending"}
+
+            # 50 overlapping polls of one pending payment make a single upstream call
+            requests_before = server.requests
+            statuses = await asyncio.gather(*(gateway.payment_status_async("busy-async") for _ in range(50)))
+            assert set(statuses) == {"pending"} and server.requests == requests_before + 1, "async polls were not coalesced"
+            await gateway.aclose()
+
+        asyncio.run(create())
+        print(f"ok: requests={server.requests} connections={server.connections} {gateway.stats()}")
+    finally:
+        gateway.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # python mercadopago_gateway.py check | standin [port]
+    if len(sys.argv) > 1 and sys.argv[1] == "standin":
+        server = stand_in(int(sys.argv[2]) if len(sys.argv) > 2 else 8081)
+        print(f"Mercado Pago stand-in on http://127.0.0.1:{server.server_port}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        check()
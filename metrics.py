@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+
+# Prometheus text format metrics, scraped from /metrics. METRICS_ENABLED=false turns off the
+# middleware, the SQL hooks and the endpoint, leaving no per request cost.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Upper bounds of the histograms, in seconds and in queries
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float("inf"))
+
+# SQL run outside a request (workers, startup) is labelled with this route
+BACKGROUND_ROUTE = "background"
+# Requests no route matched, one label instead of one per scanned URL
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # {label values: [bucket counts..., sum, count]}
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values: Tuple[str, ...], amount: float):
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += amount
+            series[-1] += 1
+
+    def exposition(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {values: list(counts) for values, counts in self._series.items()}
+        for values, counts in sorted(series.items()):
+            labels = format_labels(self.labels, values)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}'
+            yield f"{self.name}_sum{{{labels}}} {counts[-2]}"
+            yield f"{self.name}_count{{{labels}}} {int(counts[-1])}"
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, values: Tuple[str, ...], amount: float = 1):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+    def exposition(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            series = dict(self._series)
+        for values, value in sorted(series.items()):
+            yield f"{self.name}{{{format_labels(self.labels, values)}}} {value}"
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+request_duration = Histogram("http_request_duration_seconds", "Request latency per route", ("method", "route", "status"), LATENCY_BUCKETS)
+request_queries = Histogram("http_request_db_queries", "SQL queries run by one request", ("method", "route"), QUERY_COUNT_BUCKETS)
+db_queries = Counter("db_queries_total", "SQL queries per route", ("route",))
+db_query_seconds = Counter("db_query_seconds_total", "Time spent in SQL queries per route", ("route",))
+outbound_duration = Histogram("outbound_request_duration_seconds", "Latency of calls to external services", ("service", "operation"), LATENCY_BUCKETS)
+outbound_errors = Counter("outbound_errors_total", "Failed calls to external services", ("service", "operation"))
+# outcome is "partial" when some of the seats were reserved, "none" when all were sold
+payment_seat_conflicts = Counter("payment_seat_conflicts_total", "Approved payments flagged for review, their seats were sold to somebody else", ("outcome",))
+
+REGISTRY = [request_duration, request_queries, db_queries, db_query_seconds, outbound_duration, outbound_errors, payment_seat_conflicts]
+
+
+class RequestMetrics:
+    # Shared by everything a request runs, including run_sync and threadpool code
+
+    __slots__ = ("queries", "query_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+current_request: ContextVar[Optional[RequestMetrics]] = ContextVar("current_request", default=None)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, no extra task or body buffering per request
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request = RequestMetrics()
+        token = current_request.set(request)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request.reset(token)
+            # The router leaves the matched route in the scope, its path is the template
+            route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            method = scope["method"]
+            request_duration.observe((method, route, str(status_code)), time.perf_counter() - started)
+            request_queries.observe((method, route), request.queries)
+            if request.queries:
+                db_queries.inc((route,), request.queries)
+                db_query_seconds.inc((route,), request.query_seconds)
+
+
+def instrument_engine(engine):
+    # Counts and times every statement sent on the engine's connections
+    if not METRICS_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        request = current_request.get()
+        if request is None:
+            db_queries.inc((BACKGROUND_ROUTE,))
+            db_query_seconds.inc((BACKGROUND_ROUTE,), seconds)
+        else:
+            # Added to the route's totals when the request ends and its route is known
+            request.queries += 1
+            request.query_seconds += seconds
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+@contextmanager
+def outbound(service: str, operation: str):
+    # Times a call to Mercado Pago, Firebase or SMTP, an exception counts as an error
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        outbound_errors.inc((service, operation))
+        raise
+    finally:
+        outbound_duration.observe((service, operation), time.perf_counter() - started)
+
+
+def exposition() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.exposition())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,145 @@
+import sys
+from typing import List, Tuple
+
+from sqlalchemy import Column, Index, MetaData, UniqueConstraint, exists, func, inspect, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn
+
+import models
+from database import engine
+from sales_summary import seed as seed_summary
+
+
+# create_all only creates missing tables, it never adds columns or indexes to a
+# table that already exists. This brings an existing database up to the columns,
+# indexes and unique constraints declared in models.py:
+#
+#     python migrations.py
+
+
+def wanted_indexes(table) -> List[Index]:
+    # Works on a copy of the table so the extra Index objects do not end up in models' metadata
+    table = table.to_metadata(MetaData())
+    indexes = list(table.indexes)
+    for constraint in list(table.constraints):
+        # Unique constraints are added to existing tables as unique indexes
+        if isinstance(constraint, UniqueConstraint) and constraint.name:
+            indexes.append(Index(constraint.name, *constraint.columns, unique=True))
+    return indexes
+
+
+def missing_indexes(bind: Engine = engine) -> List[Tuple[str, Index]]:
+    inspector = inspect(bind)
+    missing = []
+    for table in models.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue  # create_all creates it with every index
+        existing = inspector.get_indexes(table.name) + [
+            dict(constraint, unique=True) for constraint in inspector.get_unique_constraints(table.name)
+        ]
+        names = {index["name"] for index in existing}
+        shapes = {(tuple(index["column_names"]), bool(index.get("unique"))) for index in existing}
+        for index in wanted_indexes(table):
+            columns = tuple(column.name for column in index.columns)
+            if index.name in names or (columns, bool(index.unique)) in shapes:
+                continue
+            missing.append((table.name, index))
+    return missing
+
+
+def missing_columns(bind: Engine = engine) -> List[Tuple[str, Column]]:
+    inspector = inspect(bind)
+    missing = []
+    for table in models.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend((table.name, column) for column in table.columns if column.name not in existing)
+    return missing
+
+
+def add_column(bind: Engine, table_name: str, column: Column):
+    # New columns are added nullable, existing rows have no value for them
+    spec = CreateColumn(column).compile(dialect=bind.dialect)
+    with bind.begin() as connection:
+        connection.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {spec}")
+
+
+def duplicates(bind: Engine, index: Index) -> int:
+    # Rows that would make a unique index fail
+    columns = list(index.columns)
+    with bind.connect() as connection:
+        groups = connection.execute(
+            index.table.select().with_only_columns(*columns, func.count())
+            .group_by(*columns)
+            .having(func.count() > 1)
+        ).fetchall()
+    return len(groups)
+
+
+def backfill_reservations_created(bind: Engine) -> int:
+    # Payments approved before the column existed whose reservations are there were confirmed
+    # already, only the ones without reservations (approved by hand) are left to confirm
+    Payment, Reservation = models.Payment, models.Reservation
+    with bind.begin() as connection:
+        return connection.execute(
+            update(Payment)
+            .where(
+                Payment.reservations_created.is_(None),
+                Payment.status == "approved",
+                exists().where(Reservation.client_id == Payment.client_id, Reservation.onibus_id == Payment.onibus_id),
+            )
+            .values(reservations_created=True)
+        ).rowcount
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+def upgrade(bind: Engine = engine) -> List[str]:
+    models.Base.metadata.create_all(bind=bind)
+    created = []
+    for table_name, column in missing_columns(bind):
+        try:
+            add_column(bind, table_name, column)
+            created.append(f"{table_name}.{column.name}")
+            print(f"Added column {column.name} to {table_name}")
+        except DBAPIError as e:
+            print(f"Error adding column {column.name} to {table_name}: {e}")
+    backfilled = backfill_reservations_created(bind)
+    if backfilled:
+        print(f"Marked {backfilled} confirmed payments with reservations_created")
+    with Session(bind) as db:
+        seeded = seed_summary(db)
+    if seeded:
+        print(f"Filled the sales summary of {seeded} buses")
+    # Unique indexes are what keeps a seat from being sold twice, the app must not run without them
+    missing_unique = []
+    for table_name, index in missing_indexes(bind):
+        if index.unique:
+            duplicated = duplicates(bind, index)
+            if duplicated:
+                print(f"Cannot create {index.name}: {duplicated} duplicated values in {table_name}, fix them and run again")
+                missing_unique.append(index.name)
+                continue
+        try:
+            index.create(bind=bind)
+            created.append(index.name)
+            print(f"Created {index.name} on {table_name}")
+        except DBAPIError as e:
+            print(f"Error creating {index.name} on {table_name}: {e}")
+            if index.unique:
+                missing_unique.append(index.name)
+    if missing_unique:
+        raise MigrationError(f"Unique indexes missing: {', '.join(missing_unique)}")
+    return created
+
+
+if __name__ == "__main__":
+    try:
+        upgrade()
+    except MigrationError as e:
+        sys.exit(str(e))
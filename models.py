@@ -1,5 +1,5 @@
 
-from sqlalchemy import Boolean, Column, String, TIMESTAMP, Integer, ForeignKey, DateTime, JSON
+from sqlalchemy import Boolean, Column, String, TIMESTAMP, Integer, ForeignKey, DateTime, JSON, Index, UniqueConstraint, Text
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -9,7 +9,7 @@ class Client(Base):
     id = Column(String(50), primary_key=True, index=True)
     nome = Column(String(50))
     telefone = Column(String(20), nullable=True)
-    email = Column(String(50))
+    email = Column(String(50), index=True)  # get_reservation_status looks clients up by email
     viagens = Column(String(100))
     comprovante = Column(String(200))
     passagens = Column(String(200))
@@ -34,6 +34,10 @@ class Onibus(Base):
     descricao = Column(String(255))
     horario = Column(String(50))
     vagas = Column(Integer)
+    foto_casa_hash = Column(String(64), nullable=True, index=True)  # ImageAsset behind foto_casa
+    foto_visita_hash = Column(String(64), nullable=True, index=True)  # ImageAsset behind foto_visita
+    foto_casa_variants = Column(JSON, nullable=True)  # Resized copies of foto_casa {size: {format: url}}
+    foto_visita_variants = Column(JSON, nullable=True)  # Resized copies of foto_visita {size: {format: url}}
 
     reservations = relationship("Reservation", back_populates="onibus")  # Corrected back_populates
     payments = relationship("Payment", back_populates="onibus")  # Add relationship
@@ -57,6 +61,11 @@ class Reservation(Base):
     client = relationship("Client", back_populates="reservations")  # Corrected back_populates
     onibus = relationship("Onibus", back_populates="reservations")  # Corrected back_populates
 
+    __table_args__ = (
+        UniqueConstraint('onibus_id', 'seat_row', 'seat_column', name='uq_reservations_onibus_seat'),  # A seat can only be sold once, also serves lookups by onibus_id
+        Index('ix_reservations_client_id_onibus_id', 'client_id', 'onibus_id'),
+    )
+
     class Config:
         orm_mode = True
 
@@ -67,18 +76,115 @@ class Payment(Base):
     id = Column(String(50), primary_key=True, index=True)
     client_id = Column(String(50), ForeignKey('clients.id'))
     onibus_id = Column(String(50), ForeignKey('onibus.id'))
-    payment_id = Column(String(50))  # Payment ID from Mercado Pago NEEDS TO BE UNIQUE SO WE CANT HAVE 2 of THE SAME PAYMENT
+    payment_id = Column(String(50), unique=True, index=True)  # Payment ID from Mercado Pago NEEDS TO BE UNIQUE SO WE CANT HAVE 2 of THE SAME PAYMENT
     status = Column(String(50))  # Payment status
-    timestamp = Column(DateTime)
+    timestamp = Column(DateTime, index=True)  # get_recent_payments filters on it
     transaction_amount = Column(Integer)
     email = Column(String(100))
     approved = Column(Boolean(), default=False)
+    reservations_created = Column(Boolean(), default=False)  # Set by the confirmation that created the reservations, it runs once
+    needs_review = Column(Boolean(), default=False)  # Approved but seats were sold to somebody else, refund or rebook by hand
     seats = Column(JSON)  # Store seats information as JSON row:[0,1,2,3,4,5],column:[0,1,2,3,4,5]
 
 
     client = relationship("Client", back_populates="payments")
     onibus = relationship("Onibus", back_populates="payments")
 
+    __table_args__ = (
+        Index('ix_payments_client_id_timestamp', 'client_id', 'timestamp'),  # Payments of a client in page order
+    )
+
     class Config:
         orm_mode = True
 
+
+class PaymentMonitorJob(Base):
+    __tablename__ = 'payment_monitor_jobs'
+
+    id = Column(String(50), primary_key=True, index=True)
+    payment_id = Column(String(50), unique=True)  # Mercado Pago payment ID, only one monitor per payment
+    status = Column(String(20), default='pending')  # pending, running, done, expired
+    attempts = Column(Integer, default=0)  # Status checks already made
+    max_attempts = Column(Integer, default=30)
+    next_run_at = Column(DateTime)  # When the next status check is due
+    locked_by = Column(String(100), nullable=True)  # Worker that claimed the job
+    locked_until = Column(DateTime, nullable=True)  # Claim expires here so a dead worker's job is picked up again
+    last_status = Column(String(50), nullable=True)  # Last status returned by Mercado Pago
+    last_error = Column(String(255), nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_payment_monitor_jobs_status_next_run_at', 'status', 'next_run_at'),
+    )
+
+
+class EmailOutbox(Base):
+    __tablename__ = 'email_outbox'
+
+    id = Column(String(50), primary_key=True, index=True)
+    to_email = Column(String(100))
+    subject = Column(String(200))
+    body = Column(Text)  # Rendered HTML
+    status = Column(String(20), default='pending')  # pending, sending, sent, failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    next_attempt_at = Column(DateTime)  # Backoff, the email is not sent before this
+    locked_by = Column(String(100), nullable=True)  # Worker sending it
+    locked_until = Column(DateTime, nullable=True)  # Claim expires here so a dead worker's email is picked up again
+    last_error = Column(String(255), nullable=True)
+    created_at = Column(DateTime)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+
+class ImageAsset(Base):
+    __tablename__ = 'image_assets'
+
+    id = Column(String(64), primary_key=True, index=True)  # sha256 of the original file, same image is stored once
+    original_url = Column(String(300))
+    content_type = Column(String(100), nullable=True)
+    status = Column(String(20), default='pending')  # pending, ready, failed
+    variants = Column(JSON, nullable=True)  # {size: {format: url}}
+    created_at = Column(DateTime)
+
+
+class WebhookEvent(Base):
+    __tablename__ = 'webhook_events'
+
+    id = Column(String(64), primary_key=True, index=True)  # Mercado Pago notification id, duplicate deliveries hit the key
+    topic = Column(String(50))  # payment, merchant_order...
+    action = Column(String(50), nullable=True)
+    resource_id = Column(String(50), index=True, nullable=True)  # Payment.payment_id for payment events
+    payload = Column(Text)  # Raw body as received, kept for replays
+    status = Column(String(20), default='pending')  # pending, processing, done, ignored, failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime)
+    locked_by = Column(String(100), nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+    last_status = Column(String(20), nullable=True)  # Payment status it resolved to
+    last_error = Column(String(255), nullable=True)
+    received_at = Column(DateTime)
+    processed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_webhook_events_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+
+class OnibusSummary(Base):
+    __tablename__ = 'onibus_summary'
+
+    # One row per bus, kept up to date in the same transaction as the reservation or
+    # payment write it counts, so reports read O(buses) rows
+    onibus_id = Column(String(50), ForeignKey('onibus.id', ondelete='CASCADE'), primary_key=True)
+    reserved_seats = Column(Integer, default=0)
+    payments_pending = Column(Integer, default=0)
+    payments_approved = Column(Integer, default=0)
+    payments_denied = Column(Integer, default=0)  # denied, rejected, cancelled
+    payments_other = Column(Integer, default=0)  # refunded, charged_back...
+    revenue_approved = Column(Integer, default=0)  # Sum of transaction_amount of approved payments
+    updated_at = Column(DateTime)
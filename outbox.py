@@ -0,0 +1,268 @@
+import os
+import queue
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Callable, List, Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+import models
+from metrics import outbound
+
+
+# SMTP server, defaults to Gmail. Point it at a local stand-in such as
+# `python -m aiosmtpd -n -l localhost:8025` with SMTP_HOST=localhost SMTP_PORT=8025 SMTP_SSL=false
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+# Authenticated connections kept open, also the number of emails sent in parallel
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+# Connections idle longer than this are checked with NOOP before reuse
+SMTP_IDLE_CHECK = float(os.getenv("SMTP_IDLE_CHECK", "30"))
+
+# Emails claimed per worker tick
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+# First retry after OUTBOX_BACKOFF seconds, doubling up to OUTBOX_MAX_BACKOFF
+OUTBOX_BACKOFF = int(os.getenv("OUTBOX_BACKOFF", "30"))
+OUTBOX_MAX_BACKOFF = int(os.getenv("OUTBOX_MAX_BACKOFF", "1800"))
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", "300"))
+OUTBOX_IDLE_POLL = int(os.getenv("OUTBOX_IDLE_POLL", "10"))
+
+
+def enqueue_email(db: Session, to_email: str, subject: str, body: str, commit: bool = True) -> models.EmailOutbox:
+    # Request handlers only write the email to the outbox, the worker sends it
+    now = datetime.now()
+    email = models.EmailOutbox(
+        id=str(uuid.uuid4()),
+        to_email=to_email,
+        subject=subject,
+        body=body,
+        status="pending",
+        attempts=0,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        next_attempt_at=now,
+        created_at=now,
+    )
+    db.add(email)
+    if commit:
+        db.commit()
+    return email
+
+
+def build_message(sender: str, to_email: str, subject: str, body: str) -> str:
+    msg = MIMEMultipart()
+    msg["From"] = sender
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    msg.attach(MIMEText(body, "html"))
+    return msg.as_string()
+
+
+class SMTPPool:
+    # Small pool of logged-in SMTP connections, so a burst of emails pays for the
+    # TLS handshake and login once per connection instead of once per message
+
+    def __init__(self, size: int = SMTP_POOL_SIZE, host: str = SMTP_HOST, port: int = SMTP_PORT, use_ssl: bool = SMTP_SSL, user: Optional[str] = None, password: Optional[str] = None):
+        self.size = size
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.user = user if user is not None else os.getenv("GMAIL_USER")
+        self.password = password if password is not None else os.getenv("GMAIL_PASSWORD")
+        self._idle: "queue.LifoQueue" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> smtplib.SMTP:
+        with outbound("smtp", "connect"):
+            if self.use_ssl:
+                server = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT)
+            else:
+                server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if self.user and self.password:
+                server.login(self.user, self.password)
+            return server
+
+    def _checkout(self) -> smtplib.SMTP:
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    server, released_at = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - released_at < SMTP_IDLE_CHECK:
+                    return server
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except smtplib.SMTPException:
+                    pass
+                except OSError:
+                    pass
+                self._discard(server)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, server: Optional[smtplib.SMTP]):
+        if server is not None:
+            self._idle.put((server, time.monotonic()))
+        self._slots.release()
+
+    def _discard(self, server: smtplib.SMTP):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def send(self, to_email: str, subject: str, body: str):
+        server = self._checkout()
+        try:
+            with outbound("smtp", "send"):
+                server.sendmail(self.user, to_email, build_message(self.user, to_email, subject, body))
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # Server dropped the connection, do not give it back
+            self._discard(server)
+            server = None
+            raise
+        finally:
+            self._checkin(server)
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(server)
+
+
+class OutboxWorker:
+    # Same claiming scheme as the payment monitor: rows of email_outbox are claimed
+    # with row locks and a lease, so any number of workers can drain the outbox
+
+    def __init__(self, session_factory: Callable[[], Session], pool: Optional[SMTPPool] = None):
+        self.session_factory = session_factory
+        self.pool = pool or SMTPPool()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.pool.size, thread_name_prefix="outbox")
+        self._thread = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self.pool.close()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                email_ids = self.claim_batch()
+                if email_ids:
+                    list(self._executor.map(self.deliver, email_ids))
+                    continue
+                delay = self.seconds_until_next_email()
+            except Exception as e:
+                print(f"Error in outbox worker: {e}")
+                delay = OUTBOX_IDLE_POLL
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def seconds_until_next_email(self) -> float:
+        db = self.session_factory()
+        try:
+            next_attempt_at = db.query(func.min(models.EmailOutbox.next_attempt_at)).filter(
+                models.EmailOutbox.status == "pending"
+            ).scalar()
+        finally:
+            db.close()
+        if next_attempt_at is None:
+            return OUTBOX_IDLE_POLL
+        return min(max((next_attempt_at - datetime.now()).total_seconds(), 0), OUTBOX_IDLE_POLL)
+
+    def claim_batch(self) -> List[str]:
+        db = self.session_factory()
+        try:
+            now = datetime.now()
+            Email = models.EmailOutbox
+            emails = (
+                db.query(Email)
+                .filter(
+                    or_(
+                        (Email.status == "pending") & (Email.next_attempt_at <= now),
+                        (Email.status == "sending") & (Email.locked_until < now),
+                    )
+                )
+                .order_by(Email.next_attempt_at)
+                .limit(OUTBOX_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            for email in emails:
+                email.status = "sending"
+                email.locked_by = self.worker_id
+                email.locked_until = now + timedelta(seconds=OUTBOX_LEASE)
+            db.commit()
+            return [email.id for email in emails]
+        finally:
+            db.close()
+
+    def deliver(self, email_id: str):
+        db = self.session_factory()
+        try:
+            email = db.query(models.EmailOutbox).filter(
+                models.EmailOutbox.id == email_id,
+                models.EmailOutbox.locked_by == self.worker_id,
+            ).first()
+            if not email:
+                return
+
+            email.attempts += 1
+            try:
+                self.pool.send(email.to_email, email.subject, email.body)
+            except Exception as e:
+                print(f"Error sending email {email.id} to {email.to_email}: {e}")
+                email.last_error = str(e)[:255]
+                if email.attempts >= email.max_attempts:
+                    email.status = "failed"
+                else:
+                    backoff = min(OUTBOX_BACKOFF * 2 ** (email.attempts - 1), OUTBOX_MAX_BACKOFF)
+                    email.status = "pending"
+                    email.next_attempt_at = datetime.now() + timedelta(seconds=backoff)
+            else:
+                email.status = "sent"
+                email.sent_at = datetime.now()
+            email.locked_by = None
+            email.locked_until = None
+            db.commit()
+        except Exception as e:
+            print(f"Error in outbox delivery {email_id}: {e}")
+            db.rollback()
+        finally:
+            db.close()
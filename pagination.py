@@ -0,0 +1,238 @@
+import base64
+import json
+import os
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import DateTime, and_, func, or_
+from sqlalchemy.orm import Query, Session
+
+try:
+    import orjson
+except ImportError:  # Optional, the stdlib encoder is used without it
+    orjson = None
+
+
+# Page size of a ?cursor without ?limit, listings asked for neither return every row
+DEFAULT_PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+# Rows read from the database per query when streaming NDJSON
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "500"))
+# Format of datetimes in listings, what the reservation endpoints always returned
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Sort key of rows without a timestamp, valid on every backend
+NULL_TIMESTAMP = datetime(1970, 1, 1)
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    # Opaque token with the sort key of the last row of a page
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: Sequence) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("cursor does not match the ordering")
+        decoded = []
+        for column, value in zip(columns, values):
+            # Only what encode_cursor writes: a string per datetime, scalars for the rest
+            if isinstance(column.type, DateTime):
+                if not isinstance(value, str):
+                    raise ValueError("datetime expected")
+                value = datetime.fromisoformat(value)
+            elif value is not None and not isinstance(value, (str, int, float)):
+                raise ValueError("scalar expected")
+            decoded.append(value)
+        return decoded
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def after(columns: Sequence, values: Sequence[Any]):
+    # (a, b) > (x, y) written out as a > x OR (a = x AND b > y), works on every backend
+    clauses = []
+    for i, column in enumerate(columns):
+        clauses.append(and_(*[columns[j] == values[j] for j in range(i)], column > values[i]))
+    return or_(*clauses)
+
+
+def not_null(column, default: Any = NULL_TIMESTAMP):
+    # Sort column for a nullable column, NULL never compares in the keyset filter so those
+    # rows would be skipped. The query selects it too, the cursor reads it from the rows.
+    return func.coalesce(column, default).label(f"{column.key}_sort")
+
+
+def sort_key(row: Any, columns: Sequence) -> List[Any]:
+    return [getattr(row, column.key) for column in columns]
+
+
+def fetch_page(query: Query, columns: Sequence, limit: Optional[int], cursor: Optional[str] = None) -> Tuple[list, Optional[str]]:
+    # Reads one page plus one row to know if there is a next page, the ordering
+    # columns must be unique together so the order is stable between pages.
+    # Without limit nor cursor every row is returned, as the listings did before paging.
+    if limit is None and not cursor:
+        return query.order_by(*columns).all(), None
+    limit = limit or DEFAULT_PAGE_SIZE
+    if cursor:
+        query = query.filter(after(columns, decode_cursor(cursor, columns)))
+    rows = query.order_by(*columns).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(sort_key(rows[-1], columns))
+
+
+def next_cursor_headers(request: Request, next_cursor: Optional[str]) -> Dict[str, str]:
+    # The body stays a plain list, the next page is announced in the headers
+    if not next_cursor:
+        return {}
+    return {
+        "X-Next-Cursor": next_cursor,
+        "Link": f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"',
+    }
+
+
+def set_next_cursor(request: Request, response: Response, next_cursor: Optional[str]):
+    response.headers.update(next_cursor_headers(request, next_cursor))
+
+
+def iter_chunks(
+    session_factory: Callable[[], Session],
+    build_query: Callable[[Session], Query],
+    columns: Sequence,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> Iterator[list]:
+    # Keyset-chunked scan with its own session, the request session is closed
+    # by the time a streaming body is consumed
+    db = session_factory()
+    try:
+        values = None
+        while True:
+            query = build_query(db)
+            if values is not None:
+                query = query.filter(after(columns, values))
+            rows = query.order_by(*columns).limit(chunk_size).all()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < chunk_size:
+                return
+            values = sort_key(rows[-1], columns)
+            db.expunge_all()  # Keep the identity map from growing with the table
+    finally:
+        db.close()
+
+
+def ndjson_response(
+    session_factory: Callable[[], Session],
+    build_query: Callable[[Session], Query],
+    columns: Sequence,
+    serialize: Callable[[Any], dict],
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> StreamingResponse:
+    def body():
+        for rows in iter_chunks(session_factory, build_query, columns, chunk_size):
+            yield b"".join(dumps(serialize(row)) + b"\n" for row in rows)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+def model_row(model) -> Callable[[Any], dict]:
+    # Serializer that copies the response model's fields from an ORM row
+    fields = list(model.model_fields)
+    return lambda row: {field: getattr(row, field, None) for field in fields}
+
+
+def table_row(orm_model) -> Callable[[Any], dict]:
+    # Serializer that copies every column of the table
+    keys = [column.key for column in orm_model.__table__.columns]
+    return lambda row: {key: getattr(row, key) for key in keys}
+
+
+def encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    return str(value)
+
+
+def dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        # Datetimes go through encode_value to keep the listings' format, orjson's is ISO with a T
+        return orjson.dumps(payload, default=encode_value, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=encode_value, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(Response):
+    # Rows already shaped like the response model, returned as is: FastAPI skips
+    # response_model validation for a Response and the body is encoded in one call
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def column_rows(columns: Sequence, rows: Sequence) -> List[dict]:
+    # Tuples from a query on columns, keyed by column name
+    keys = [column.key for column in columns]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def benchmark(rows: int = 5000, rounds: int = 5) -> Dict[str, float]:
+    # Old and new path of GET /reserve/ on an in-memory SQLite table, seconds per page
+    import time
+    import uuid
+    from fastapi.encoders import jsonable_encoder
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    import models
+    from pydanticmodels import ReservationResponse
+
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine, tables=[models.Client.__table__, models.Onibus.__table__, models.Reservation.__table__])
+    db = sessionmaker(engine)()
+    now = datetime.now()
+    db.add_all(models.Reservation(id=str(uuid.uuid4()), client_id="c", onibus_id="o", seat_row=i // 4, seat_column=i % 4, timestamp=now) for i in range(rows))
+    db.commit()
+    columns = [models.Reservation.id, models.Reservation.client_id, models.Reservation.onibus_id, models.Reservation.seat_row, models.Reservation.seat_column, models.Reservation.timestamp]
+
+    def old():
+        # ORM objects, __dict__ copies and strftime, then FastAPI validates and encodes the models again
+        db.expunge_all()
+        response = []
+        for reservation in db.query(models.Reservation).order_by(models.Reservation.id).limit(rows).all():
+            reservation_dict = reservation.__dict__.copy()
+            reservation_dict['timestamp'] = reservation.timestamp.strftime(TIMESTAMP_FORMAT)
+            response.append(ReservationResponse(**reservation_dict))
+        validated = [ReservationResponse.model_validate(item.model_dump()) for item in response]
+        return json.dumps(jsonable_encoder(validated)).encode()
+
+    def new():
+        return FastJSONResponse(column_rows(columns, db.query(*columns).order_by(models.Reservation.id).limit(rows).all())).body
+
+    results = {}
+    for name, path in (("old", old), ("new", new)):
+        path()  # Warm up
+        started = time.perf_counter()
+        for _ in range(rounds):
+            path()
+        results[name] = (time.perf_counter() - started) / rounds
+    db.close()
+    return results
+
+
+if __name__ == "__main__":
+    # python pagination.py [rows]: benchmark of the reservation listing serialization
+    import sys
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    results = benchmark(rows)
+    print(f"{rows} rows, encoder: {'orjson' if orjson is not None else 'json'}")
+    for name, seconds in results.items():
+        print(f"  {name}: {seconds * 1000:.1f}ms")
+    print(f"  speedup: {results['old'] / results['new']:.1f}x")
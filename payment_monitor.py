@@ -0,0 +1,267 @@
+import os
+import socket
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from holds import seat_holds
+from webhooks import FAILED_STATUSES
+
+
+# Seconds between two status checks of the same payment
+CHECK_INTERVAL = int(os.getenv("PAYMENT_MONITOR_INTERVAL", "60"))
+# Status checks before a pending payment is given up
+MAX_CHECKS = int(os.getenv("PAYMENT_MONITOR_MAX_CHECKS", "30"))
+# Jobs claimed per scheduler tick and threads used to check them
+BATCH_SIZE = int(os.getenv("PAYMENT_MONITOR_BATCH_SIZE", "50"))
+WORKERS = int(os.getenv("PAYMENT_MONITOR_WORKERS", "4"))
+# How long a claim is valid before another worker may take the job over
+LEASE_SECONDS = int(os.getenv("PAYMENT_MONITOR_LEASE", "120"))
+# Longest the scheduler sleeps without looking at the table (jobs enqueued by other nodes)
+IDLE_POLL = int(os.getenv("PAYMENT_MONITOR_IDLE_POLL", "15"))
+# Payment ids this process remembers as already monitored
+GUARD_SIZE = int(os.getenv("PAYMENT_MONITOR_GUARD_SIZE", "10000"))
+
+
+class MonitorGuard:
+    # At most one enqueue per payment and process, status polls of a payment that is already
+    # monitored skip the job table. The unique payment_id of the jobs covers other processes.
+
+    def __init__(self, size: int = GUARD_SIZE):
+        self.size = size
+        self._payment_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.claimed = 0
+        self.skipped = 0
+
+    def claim(self, payment_id: str) -> bool:
+        with self._lock:
+            if payment_id in self._payment_ids:
+                self._payment_ids.move_to_end(payment_id)
+                self.skipped += 1
+                return False
+            self._payment_ids[payment_id] = None
+            while len(self._payment_ids) > self.size:
+                self._payment_ids.popitem(last=False)
+            self.claimed += 1
+            return True
+
+    def release(self, payment_id: str):
+        # The enqueue failed, the next poll tries again
+        with self._lock:
+            self._payment_ids.pop(payment_id, None)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"monitored": len(self._payment_ids), "claimed": self.claimed, "skipped": self.skipped}
+
+
+monitor_guard = MonitorGuard()
+
+
+def enqueue_payment_monitor(db: Session, payment_id: str) -> models.PaymentMonitorJob:
+    # Jobs are unique per payment_id, polling the status again never starts a second monitor
+    job = db.query(models.PaymentMonitorJob).filter(models.PaymentMonitorJob.payment_id == payment_id).first()
+    if job:
+        return job
+
+    now = datetime.now()
+    job = models.PaymentMonitorJob(
+        id=str(uuid.uuid4()),
+        payment_id=payment_id,
+        status="pending",
+        attempts=0,
+        max_attempts=MAX_CHECKS,
+        next_run_at=now + timedelta(seconds=CHECK_INTERVAL),
+        created_at=now,
+        updated_at=now,
+    )
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another request or worker enqueued the same payment first
+        db.rollback()
+        job = db.query(models.PaymentMonitorJob).filter(models.PaymentMonitorJob.payment_id == payment_id).first()
+    return job
+
+
+class PaymentMonitorScheduler:
+    # One scheduler thread per process. It sleeps until the earliest next_run_at in the
+    # job table, claims the due jobs with row locks and checks them on a small thread pool.
+    # Any number of processes or nodes can run it against the same database.
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        fetch_status: Callable[[str], Optional[str]],
+        on_approved: Callable[[models.Payment, Session], None],
+    ):
+        self.session_factory = session_factory
+        self.fetch_status = fetch_status
+        self.on_approved = on_approved
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="payment-monitor")
+        self._thread = threading.Thread(target=self._run, name="payment-monitor-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def wake(self):
+        # Recompute the next deadline, used after a job is enqueued in this process
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                job_ids = self.claim_due_jobs()
+                if job_ids:
+                    list(self._executor.map(self.run_job, job_ids))
+                    continue
+                delay = self.seconds_until_next_job()
+            except Exception as e:
+                print(f"Error in payment monitor scheduler: {e}")
+                delay = IDLE_POLL
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def seconds_until_next_job(self) -> float:
+        db = self.session_factory()
+        try:
+            next_run_at = db.query(func.min(models.PaymentMonitorJob.next_run_at)).filter(
+                models.PaymentMonitorJob.status == "pending"
+            ).scalar()
+        finally:
+            db.close()
+        if next_run_at is None:
+            return IDLE_POLL
+        return min(max((next_run_at - datetime.now()).total_seconds(), 0), IDLE_POLL)
+
+    def claim_due_jobs(self) -> List[str]:
+        db = self.session_factory()
+        try:
+            now = datetime.now()
+            Job = models.PaymentMonitorJob
+            jobs = (
+                db.query(Job)
+                .filter(
+                    or_(
+                        (Job.status == "pending") & (Job.next_run_at <= now),
+                        # Claim of a worker that died mid-check
+                        (Job.status == "running") & (Job.locked_until < now),
+                    )
+                )
+                .order_by(Job.next_run_at)
+                .limit(BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            for job in jobs:
+                job.status = "running"
+                job.locked_by = self.worker_id
+                job.locked_until = now + timedelta(seconds=LEASE_SECONDS)
+                job.updated_at = now
+            db.commit()
+            return [job.id for job in jobs]
+        finally:
+            db.close()
+
+    def run_job(self, job_id: str):
+        db = self.session_factory()
+        try:
+            job = db.query(models.PaymentMonitorJob).filter(
+                models.PaymentMonitorJob.id == job_id,
+                models.PaymentMonitorJob.locked_by == self.worker_id,
+            ).first()
+            if not job:
+                return
+
+            payment = db.query(models.Payment).filter(models.Payment.payment_id == job.payment_id).first()
+            if not payment:
+                self._finish(job, "done", error="Payment not found")
+                db.commit()
+                return
+
+            try:
+                payment_status = self.fetch_status(job.payment_id)
+            except Exception as e:
+                payment_status = None
+                job.last_error = str(e)[:255]
+
+            job.attempts += 1
+            job.last_status = payment_status
+
+            if payment_status == "approved":
+                self.on_approved(payment, db)
+                self._finish(job, "done")
+            elif payment_status is not None and payment_status != "pending":
+                # rejected, cancelled, refunded... nothing left to watch
+                if payment_status in FAILED_STATUSES:
+                    seat_holds.release(job.payment_id)
+                self._finish(job, "done")
+            elif job.attempts >= job.max_attempts:
+                self._finish(job, "expired")
+            else:
+                self._reschedule(job)
+            db.commit()
+        except Exception as e:
+            print(f"Error monitoring payment job {job_id}: {e}")
+            db.rollback()
+            self._release_after_error(db, job_id, e)
+        finally:
+            db.close()
+
+    def _finish(self, job: models.PaymentMonitorJob, status: str, error: Optional[str] = None):
+        job.status = status
+        job.locked_by = None
+        job.locked_until = None
+        job.updated_at = datetime.now()
+        if error:
+            job.last_error = error
+
+    def _reschedule(self, job: models.PaymentMonitorJob):
+        now = datetime.now()
+        job.status = "pending"
+        job.next_run_at = now + timedelta(seconds=CHECK_INTERVAL)
+        job.locked_by = None
+        job.locked_until = None
+        job.updated_at = now
+
+    def _release_after_error(self, db: Session, job_id: str, error: Exception):
+        try:
+            job = db.query(models.PaymentMonitorJob).filter(models.PaymentMonitorJob.id == job_id).first()
+            if not job:
+                return
+            job.attempts += 1
+            job.last_error = str(error)[:255]
+            if job.attempts >= job.max_attempts:
+                self._finish(job, "expired")
+            else:
+                self._reschedule(job)
+            db.commit()
+        except Exception as e:
+            print(f"Error releasing payment job {job_id}: {e}")
+            db.rollback()
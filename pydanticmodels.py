@@ -1,7 +1,12 @@
 
+import os
 from pydantic import BaseModel, Field, EmailStr, Json
 from typing import List, Optional, Dict
 
+# Largest seat row and column a bus can have, seat maps keep a bit per column
+MAX_ROW = int(os.getenv("SEAT_MAX_ROW", "100"))
+MAX_COLUMN = int(os.getenv("SEAT_MAX_COLUMN", "10"))
+
 class ReservationDetails(BaseModel):
     client_id: str
     onibus_id: str
@@ -10,8 +15,8 @@ class ReservationDetails(BaseModel):
 
 
 class Seat(BaseModel):
-    row: int
-    column: int
+    row: int = Field(ge=0, le=MAX_ROW)
+    column: int = Field(ge=0, le=MAX_COLUMN)
 
 class ClientBase(BaseModel):
     id: Optional[str] = Field(None, alias="id")
@@ -32,15 +37,48 @@ class OnibusBase(BaseModel):
     descricao: Optional[str]
     vagas: Optional[int]
     horario: Optional[str]
+    foto_casa_variants: Optional[Dict[str, Dict[str, str]]] = None  # thumbnail/card/full in webp and jpeg
+    foto_visita_variants: Optional[Dict[str, Dict[str, str]]] = None
 
 # Example usage of the models
 class Seat(BaseModel):
+    row: int = Field(ge=0, le=MAX_ROW)
+    column: int = Field(ge=0, le=MAX_COLUMN)
+
+class ReserveRequest(BaseModel):
+    client_id: str
+    seats: List[Seat]
+    all_or_nothing: Optional[bool] = False  # Reserve nothing if any seat is taken
+
+
+class SeatConflict(BaseModel):
     row: int
     column: int
+    reason: str  # seat_taken, seat_held or sold_out
 
-class ReserveRequest(BaseModel):
+class ReserveResponse(BaseModel):
+    message: str
+    reserved: List[Seat]
+    conflicts: List[SeatConflict]
+
+class BulkReserveEntry(BaseModel):
+    onibus_id: str
     client_id: str
     seats: List[Seat]
+    all_or_nothing: Optional[bool] = False
+
+class BulkReserveRequest(BaseModel):
+    entries: List[BulkReserveEntry]
+
+class BulkReserveResult(BaseModel):
+    onibus_id: str
+    client_id: str
+    reserved: List[Seat]
+    conflicts: List[SeatConflict]
+
+class BulkReserveResponse(BaseModel):
+    message: str
+    results: List[BulkReserveResult]
 
 
 class PaymentData(BaseModel):
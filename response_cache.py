@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import Request, Response, status
+from starlette.concurrency import run_in_threadpool
+
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))  # Bodies kept per worker
+# Shared tier so all workers agree on versions and reuse each other's bodies, off when unset
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL")
+# Upper bound, writes invalidate before that. Without the shared tier a worker never hears of
+# the other workers' writes (vagas, bus edits), the TTL is all that bounds how stale it gets.
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300" if RESPONSE_CACHE_REDIS_URL else "5"))
+RESPONSE_CACHE_REDIS_TIMEOUT = float(os.getenv("RESPONSE_CACHE_REDIS_TIMEOUT", "0.05"))
+# Seconds a worker trusts its copy of a version before asking the shared tier again
+RESPONSE_CACHE_SYNC_INTERVAL = float(os.getenv("RESPONSE_CACHE_SYNC_INTERVAL", "1"))
+
+ONIBUS_LIST = "onibus:list"
+
+
+def onibus_scope(onibus_id: str) -> str:
+    return f"onibus:{onibus_id}"
+
+
+class CachedResponse:
+
+    def __init__(self, body: bytes, etag: str, headers: Dict[str, str]):
+        self.body = body
+        self.etag = etag
+        self.headers = headers
+
+
+class RedisTier:
+    # Versions are counters in Redis, bodies are stored under their version and expire on their own
+
+    def __init__(self, url: str, timeout: float = RESPONSE_CACHE_REDIS_TIMEOUT, ttl: float = RESPONSE_CACHE_TTL):
+        import redis  # Only needed when the shared tier is configured
+
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.ttl = int(ttl)
+
+    def version_key(self, scope: str) -> str:
+        return f"response_cache:version:{scope}"
+
+    def body_key(self, scope: str, key: str, version: int) -> str:
+        return f"response_cache:body:{scope}:{version}:{key}"
+
+    def version(self, scope: str) -> int:
+        value = self.client.get(self.version_key(scope))
+        if value is None:
+            # Counters start at the clock so a flushed Redis never hands out an old ETag again
+            self.client.set(self.version_key(scope), time.time_ns(), nx=True)
+            value = self.client.get(self.version_key(scope))
+        return int(value)
+
+    def bump(self, scopes: Tuple[str, ...]) -> Dict[str, int]:
+        pipeline = self.client.pipeline()
+        for scope in scopes:
+            pipeline.set(self.version_key(scope), time.time_ns(), nx=True)
+            pipeline.incr(self.version_key(scope))
+        return dict(zip(scopes, pipeline.execute()[1::2]))
+
+    def get(self, scope: str, key: str, version: int) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        value = self.client.get(self.body_key(scope, key, version))
+        if value is None:
+            return None
+        headers, body = value.split(b"\n", 1)
+        return body, json.loads(headers)
+
+    def put(self, scope: str, key: str, version: int, body: bytes, headers: Dict[str, str]):
+        self.client.set(self.body_key(scope, key, version), json.dumps(headers).encode() + b"\n" + body, ex=self.ttl)
+
+
+class ResponseCache:
+    # Serialized JSON bodies keyed by (scope, key). Every scope has a version that writes bump,
+    # a body is only served for the version it was built under. With the shared tier versions
+    # are the same on every worker, the ETag is derived from the version and a matching
+    # If-None-Match is answered without building or even having the body. Without it a worker
+    # never sees the other workers' writes, its version says nothing about the data and the
+    # ETag is a hash of the body.
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL,
+        shared: Optional[RedisTier] = None,
+        sync_interval: float = RESPONSE_CACHE_SYNC_INTERVAL,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[int, float, CachedResponse]]" = OrderedDict()
+        self._versions: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        self.shared_errors = 0
+
+    def version(self, scope: str) -> int:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(scope)
+            if cached and (self.shared is None or now - cached[1] < self.sync_interval):
+                return cached[0]
+            if self.shared is None:
+                self._versions[scope] = (time.time_ns(), now)
+                return self._versions[scope][0]
+        try:
+            version = self.shared.version(scope)
+        except Exception as e:
+            # Keep serving from this worker, other workers may lag until Redis is back
+            print(f"Error reading response cache version of {scope}: {e}")
+            self.shared_errors += 1
+            version = cached[0] if cached else time.time_ns()
+        with self._lock:
+            self._versions[scope] = (version, now)
+        return version
+
+    def etag(self, scope: str, key: str, version: int) -> str:
+        digest = hashlib.sha1(f"{scope}|{key}|{version}".encode()).hexdigest()[:20]
+        return f'"{digest}"'
+
+    def body_etag(self, body: bytes) -> str:
+        return f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+    def get(self, scope: str, key: str, version: int) -> Optional[CachedResponse]:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get((scope, key))
+            if cached and cached[0] == version and cached[1] > now:
+                self._entries.move_to_end((scope, key))
+                self.hits += 1
+                return cached[2]
+        if self.shared is not None:
+            try:
+                shared = self.shared.get(scope, key, version)
+            except Exception as e:
+                print(f"Error reading response cache entry {scope} {key}: {e}")
+                self.shared_errors += 1
+                shared = None
+            if shared is not None:
+                self.shared_hits += 1
+                return self._store(scope, key, version, CachedResponse(shared[0], self.etag(scope, key, version), shared[1]))
+        self.misses += 1
+        return None
+
+    def put(self, scope: str, key: str, version: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> CachedResponse:
+        # The version must be read before the data is, a write landing in between then
+        # only leaves a body behind under the version it already replaced
+        body = json.dumps(payload, default=str).encode()
+        etag = self.etag(scope, key, version) if self.shared is not None else self.body_etag(body)
+        cached = CachedResponse(body, etag, headers or {})
+        if self.shared is not None:
+            try:
+                self.shared.put(scope, key, version, body, cached.headers)
+            except Exception as e:
+                print(f"Error writing response cache entry {scope} {key}: {e}")
+                self.shared_errors += 1
+        return self._store(scope, key, version, cached)
+
+    def _store(self, scope: str, key: str, version: int, cached: CachedResponse) -> CachedResponse:
+        with self._lock:
+            self._entries[(scope, key)] = (version, time.monotonic() + self.ttl, cached)
+            self._entries.move_to_end((scope, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return cached
+
+    def invalidate(self, *scopes: str):
+        # Called after the write is committed
+        now = time.monotonic()
+        versions = None
+        if self.shared is not None:
+            try:
+                versions = self.shared.bump(scopes)
+            except Exception as e:
+                print(f"Error invalidating response cache {scopes}: {e}")
+                self.shared_errors += 1
+        with self._lock:
+            for scope in scopes:
+                if versions:
+                    self._versions[scope] = (versions[scope], now)
+                else:
+                    current = self._versions.get(scope)
+                    self._versions[scope] = ((current[0] if current else time.time_ns()) + 1, now)
+            self.invalidations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "shared": self.shared is not None,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+                "invalidations": self.invalidations,
+                "shared_errors": self.shared_errors,
+            }
+
+
+async def off_loop(cache: ResponseCache, fn: Callable, *args):
+    # The Redis client blocks, with the shared tier the calls run on the threadpool instead of
+    # stalling the event loop
+    if cache.shared is not None:
+        return await run_in_threadpool(fn, *args)
+    return fn(*args)
+
+
+def etag_matches(request: Request, etag: str, exists: bool = True) -> bool:
+    # "*" matches any current representation, only pass exists when there is one
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return ("*" in tags and exists) or etag in tags or f"W/{etag}" in tags
+
+
+async def cached_json(
+    request: Request,
+    cache: ResponseCache,
+    scope: str,
+    key: str,
+    build: Callable[[], Awaitable[Tuple[Any, Dict[str, str]]]],
+) -> Response:
+    # build returns the JSON payload and extra headers, it is only awaited on a miss
+    version = await off_loop(cache, cache.version, scope)
+    if cache.shared is not None:
+        # The ETag is known before the body, whether the resource exists is not
+        headers = {"ETag": cache.etag(scope, key, version), "Cache-Control": "no-cache"}
+        if etag_matches(request, headers["ETag"], exists=False):
+            cache.not_modified += 1
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    cached = await off_loop(cache, cache.get, scope, key, version)
+    if cached is None:
+        # Raises for a missing resource, so past this point a representation exists
+        payload, extra_headers = await build()
+        cached = await off_loop(cache, cache.put, scope, key, version, payload, extra_headers)
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, cached.etag):
+        cache.not_modified += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers={**cached.headers, **headers})
+
+
+onibus_cache = ResponseCache(shared=RedisTier(RESPONSE_CACHE_REDIS_URL) if RESPONSE_CACHE_REDIS_URL else None)
+
+
+def invalidate_onibus(*onibus_ids: str):
+    # Any bus change shows up in the catalog pages and in that bus' own response
+    onibus_cache.invalidate(ONIBUS_LIST, *(onibus_scope(onibus_id) for onibus_id in onibus_ids))
+
+
+async def invalidate_onibus_async(*onibus_ids: str):
+    # Same from async routes
+    await off_loop(onibus_cache, invalidate_onibus, *onibus_ids)
@@ -0,0 +1,202 @@
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+
+Summary = models.OnibusSummary
+
+# Payment.status -> counter it is counted in
+PAYMENT_BUCKETS = {
+    "pending": Summary.payments_pending,
+    "in_process": Summary.payments_pending,
+    "approved": Summary.payments_approved,
+    "denied": Summary.payments_denied,
+    "rejected": Summary.payments_denied,
+    "cancelled": Summary.payments_denied,
+}
+COUNTERS = [
+    Summary.reserved_seats,
+    Summary.payments_pending,
+    Summary.payments_approved,
+    Summary.payments_denied,
+    Summary.payments_other,
+    Summary.revenue_approved,
+]
+
+
+def payment_bucket(status: Optional[str]):
+    if status is None:
+        return None
+    return PAYMENT_BUCKETS.get(status, Summary.payments_other)
+
+
+def apply_deltas(db: Session, onibus_id: str, deltas: Dict):
+    # counter = counter + delta in the caller's transaction, the row is created on first use
+    deltas = {column: delta for column, delta in deltas.items() if delta}
+    if not deltas or onibus_id is None:
+        return
+    values = {column: column + delta for column, delta in deltas.items()}
+    values[Summary.updated_at] = datetime.now()
+    statement = update(Summary).where(Summary.onibus_id == onibus_id).values(values)
+    if db.execute(statement).rowcount:
+        return
+    try:
+        with db.begin_nested():
+            db.add(Summary(onibus_id=onibus_id, **{column.key: 0 for column in COUNTERS}, updated_at=datetime.now()))
+    except IntegrityError:
+        pass  # Created by a concurrent write
+    db.execute(statement)
+
+
+def add_reservations(db: Session, onibus_id: str, count: int):
+    # Negative count for released seats
+    apply_deltas(db, onibus_id, {Summary.reserved_seats: count})
+
+
+def record_payment(db: Session, onibus_id: str, amount: Optional[int], old_status: Optional[str], new_status: Optional[str]):
+    # A payment moving between statuses, old_status None for a new payment, new_status None for a deleted one
+    if old_status == new_status:
+        return
+    deltas: Dict = {}
+    old_bucket, new_bucket = payment_bucket(old_status), payment_bucket(new_status)
+    if old_bucket is not None:
+        deltas[old_bucket] = deltas.get(old_bucket, 0) - 1
+    if new_bucket is not None:
+        deltas[new_bucket] = deltas.get(new_bucket, 0) + 1
+    revenue = int(amount or 0)
+    deltas[Summary.revenue_approved] = (revenue if new_status == "approved" else 0) - (revenue if old_status == "approved" else 0)
+    apply_deltas(db, onibus_id, deltas)
+
+
+def remove_onibus(db: Session, onibus_id: str):
+    db.query(Summary).filter(Summary.onibus_id == onibus_id).delete(synchronize_session=False)
+
+
+def computed_rows(db: Session) -> Dict[str, Dict[str, int]]:
+    # The summary recomputed from the source tables, O(rows), only used to repair drift
+    rows = {onibus_id: {column.key: 0 for column in COUNTERS} for onibus_id, in db.query(models.Onibus.id)}
+    for onibus_id, count in db.query(models.Reservation.onibus_id, func.count()).group_by(models.Reservation.onibus_id):
+        if onibus_id in rows:
+            rows[onibus_id]["reserved_seats"] = count
+    payments = db.query(
+        models.Payment.onibus_id, models.Payment.status, func.count(), func.coalesce(func.sum(models.Payment.transaction_amount), 0)
+    ).group_by(models.Payment.onibus_id, models.Payment.status)
+    for onibus_id, status, count, amount in payments:
+        if onibus_id not in rows:
+            continue
+        rows[onibus_id][payment_bucket(status).key] += count
+        if status == "approved":
+            rows[onibus_id]["revenue_approved"] += int(amount)
+    return rows
+
+
+def drift(db: Session) -> Dict[str, Dict[str, tuple]]:
+    # {onibus_id: {counter: (stored, computed)}} for every counter that is off
+    stored = {row.onibus_id: row for row in db.query(Summary)}
+    computed_all = computed_rows(db)
+    differences = {}
+    for onibus_id, computed in computed_all.items():
+        row = stored.get(onibus_id)
+        off = {
+            key: (getattr(row, key) if row else None, value)
+            for key, value in computed.items()
+            if (getattr(row, key) if row else None) != value
+        }
+        if off:
+            differences[onibus_id] = off
+    for onibus_id in set(stored) - set(computed_all):
+        differences[onibus_id] = {"onibus": ("present", "deleted")}
+    return differences
+
+
+def rebuild(db: Session) -> int:
+    # Locks the summary rows first so increments made meanwhile wait for the rebuilt values
+    db.query(Summary).with_for_update().all()
+    computed = computed_rows(db)
+    db.query(Summary).filter(Summary.onibus_id.notin_(list(computed))).delete(synchronize_session=False)
+    stored = {row.onibus_id: row for row in db.query(Summary)}
+    now = datetime.now()
+    for onibus_id, counters in computed.items():
+        row = stored.get(onibus_id)
+        if row is None:
+            db.add(Summary(onibus_id=onibus_id, updated_at=now, **counters))
+        else:
+            for key, value in counters.items():
+                setattr(row, key, value)
+            row.updated_at = now
+    db.commit()
+    return len(computed)
+
+
+def seed(db: Session) -> int:
+    # Counters are only ever incremented, an empty summary next to existing buses (the table
+    # was just created on an existing database) must be filled before the first write
+    if db.query(Summary.onibus_id).first() is None and db.query(models.Onibus.id).first() is not None:
+        return rebuild(db)
+    return 0
+
+
+def occupancy(db: Session) -> List[dict]:
+    rows = db.query(models.Onibus.id, models.Onibus.evento, models.Onibus.vagas, Summary.reserved_seats).outerjoin(
+        Summary, Summary.onibus_id == models.Onibus.id
+    ).order_by(models.Onibus.id)
+    report = []
+    for onibus_id, evento, vagas, reserved in rows:
+        reserved = reserved or 0
+        # vagas counts the seats still free, so the capacity is both together
+        capacity = reserved + vagas if vagas is not None else None
+        report.append({
+            "onibus_id": onibus_id,
+            "evento": evento,
+            "reserved_seats": reserved,
+            "vagas": vagas,
+            "occupancy": reserved / capacity if capacity else None,
+        })
+    return report
+
+
+def revenue(db: Session, group_by: str = "onibus") -> List[dict]:
+    key = models.Onibus.evento if group_by == "evento" else models.Onibus.id
+    rows = db.query(
+        key,
+        func.coalesce(func.sum(Summary.revenue_approved), 0),
+        func.coalesce(func.sum(Summary.payments_approved), 0),
+    ).join(Summary, Summary.onibus_id == models.Onibus.id).group_by(key).order_by(key)
+    return [{group_by: value, "revenue_approved": int(amount), "payments_approved": int(count)} for value, amount, count in rows]
+
+
+def payment_counts(db: Session) -> dict:
+    totals = db.query(*(func.coalesce(func.sum(column), 0) for column in COUNTERS[1:5])).one()
+    return {
+        "pending": int(totals[0]),
+        "approved": int(totals[1]),
+        "denied": int(totals[2]),
+        "other": int(totals[3]),
+    }
+
+
+if __name__ == "__main__":
+    # python sales_summary.py check | rebuild
+    from database import SessionLocal
+    from migrations import upgrade
+
+    # The app creates the schema when it starts, this may run before it ever did
+    upgrade()
+    session = SessionLocal()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+            print(f"Rebuilt the summary of {rebuild(session)} buses")
+        else:
+            differences = drift(session)
+            for onibus_id, off in differences.items():
+                print(onibus_id, off)
+            print(f"{len(differences)} buses drifted")
+            sys.exit(1 if differences else 0)
+    finally:
+        session.close()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+
+# Changes to a bus within this many seconds go out as one message
+SEAT_PUSH_COALESCE = float(os.getenv("SEAT_PUSH_COALESCE", "0.1"))
+# Messages a slow subscriber may have queued before it is sent a fresh snapshot instead
+SEAT_PUSH_BACKLOG = int(os.getenv("SEAT_PUSH_BACKLOG", "32"))
+# Seconds between keepalives on an idle subscription, proxies close silent connections
+SEAT_PUSH_KEEPALIVE = float(os.getenv("SEAT_PUSH_KEEPALIVE", "15"))
+# Seconds between refreshes of the seat maps of watched buses, picks up other workers' bookings
+SEAT_PUSH_REFRESH = float(os.getenv("SEAT_PUSH_REFRESH", os.getenv("SEAT_MAP_TTL", "30")))
+
+
+class Subscription:
+    # One open SSE or WebSocket connection
+
+    __slots__ = ("messages", "ready", "resync")
+
+    def __init__(self):
+        self.messages: deque = deque()
+        self.ready = asyncio.Event()
+        self.resync = False
+
+
+class SeatHub:
+    # Fans seat changes out to the subscribers of each bus. Changes may be published from any
+    # thread, they are handed to the event loop, merged per bus for SEAT_PUSH_COALESCE seconds
+    # and serialized once per message whatever the number of subscribers.
+
+    def __init__(self, coalesce: float = SEAT_PUSH_COALESCE, backlog: int = SEAT_PUSH_BACKLOG):
+        self.coalesce = coalesce
+        self.backlog = backlog
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        # {onibus_id: {(row, column): +1 reserved / -1 released}} waiting to be flushed
+        self._pending: Dict[str, Dict[Tuple[int, int], int]] = {}
+        self._resync: Set[str] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.published = 0
+        self.messages = 0
+        self.resyncs = 0
+
+    def subscribe(self, onibus_id: str) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription()
+        self._subscribers.setdefault(onibus_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, onibus_id: str, subscription: Subscription):
+        subscribers = self._subscribers.get(onibus_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[onibus_id]
+
+    def watched(self) -> List[str]:
+        return list(self._subscribers)
+
+    def publish(self, onibus_id: Optional[str], reserved=(), released=(), resync: bool = False):
+        # SeatMapCache listener, onibus_id None means every bus
+        if self._loop is None or (onibus_id is not None and onibus_id not in self._subscribers):
+            return  # Nobody watching, nothing to do
+        self.published += 1
+        self._loop.call_soon_threadsafe(self._collect, onibus_id, list(reserved), list(released), resync)
+
+    def _collect(self, onibus_id: Optional[str], reserved: List[Tuple[int, int]], released: List[Tuple[int, int]], resync: bool):
+        for bus in ([onibus_id] if onibus_id is not None else list(self._subscribers)):
+            if bus not in self._subscribers:
+                continue
+            schedule = bus not in self._pending and bus not in self._resync
+            if resync:
+                self._resync.add(bus)
+            changes = self._pending.setdefault(bus, {})
+            for seat in reserved:
+                changes[tuple(seat)] = changes.get(tuple(seat), 0) + 1
+            for seat in released:
+                changes[tuple(seat)] = changes.get(tuple(seat), 0) - 1
+            if schedule:
+                self._loop.call_later(self.coalesce, self._flush, bus)
+
+    def _flush(self, onibus_id: str):
+        changes = self._pending.pop(onibus_id, {})
+        resync = onibus_id in self._resync
+        self._resync.discard(onibus_id)
+        subscribers = self._subscribers.get(onibus_id, ())
+        if resync:
+            self.resyncs += 1
+            for subscription in subscribers:
+                subscription.resync = True
+                subscription.ready.set()
+            return
+
+        # A seat reserved and released within the window cancels out
+        reserved = [{"row": row, "column": column} for (row, column), net in sorted(changes.items()) if net > 0]
+        released = [{"row": row, "column": column} for (row, column), net in sorted(changes.items()) if net < 0]
+        if not reserved and not released:
+            return
+        message = ("delta", json.dumps({"type": "delta", "onibus_id": onibus_id, "reserved": reserved, "released": released}))
+        self.messages += 1
+        for subscription in subscribers:
+            if len(subscription.messages) >= self.backlog:
+                # Too far behind, a snapshot replaces what it missed
+                subscription.messages.clear()
+                subscription.resync = True
+            else:
+                subscription.messages.append(message)
+            subscription.ready.set()
+
+    async def stream(self, onibus_id: str, snapshot: Callable[[], Awaitable[list]], keepalive: float = SEAT_PUSH_KEEPALIVE) -> AsyncIterator[Optional[Tuple[str, str]]]:
+        # (event type, JSON) messages for one subscriber, None for a keepalive. Subscribed before
+        # the snapshot is read, so a change landing in between is sent after it instead of lost;
+        # deltas are idempotent, a seat already reserved in the snapshot stays reserved.
+        subscription = self.subscribe(onibus_id)
+        try:
+            yield snapshot_message(onibus_id, await snapshot())
+            while True:
+                try:
+                    await asyncio.wait_for(subscription.ready.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                subscription.ready.clear()
+                if subscription.resync:
+                    subscription.resync = False
+                    subscription.messages.clear()
+                    yield snapshot_message(onibus_id, await snapshot())
+                    continue
+                while subscription.messages:
+                    yield subscription.messages.popleft()
+        finally:
+            self.unsubscribe(onibus_id, subscription)
+
+    def stats(self) -> Dict:
+        return {
+            "buses": len(self._subscribers),
+            "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+            "published": self.published,
+            "messages": self.messages,
+            "resyncs": self.resyncs,
+        }
+
+
+def snapshot_message(onibus_id: str, seats: list) -> Tuple[str, str]:
+    return "snapshot", json.dumps({"type": "snapshot", "onibus_id": onibus_id, "seats": seats})
+
+
+def sse_event(message: Optional[Tuple[str, str]]) -> str:
+    if message is None:
+        return ": keepalive\n\n"
+    event, data = message
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+class SeatMapRefresher:
+    # Rebuilds the seat maps of watched buses once they are older than their TTL, the rebuild
+    # publishes what other workers changed
+
+    def __init__(self, hub: SeatHub, refresh: Callable[[str], None], interval: float = SEAT_PUSH_REFRESH):
+        self.hub = hub
+        self.refresh = refresh
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for onibus_id in self.hub.watched():
+                try:
+                    await run_in_threadpool(self.refresh, onibus_id)
+                except Exception as e:
+                    print(f"Error refreshing seat map of {onibus_id}: {e}")
+
+
+seat_hub = SeatHub()
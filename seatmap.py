@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import models
+from pydanticmodels import MAX_COLUMN, MAX_ROW
+
+
+# Seconds a bus seat map is trusted before it is rebuilt from the database.
+# Other workers update their own copy, so this bounds how stale a worker can get.
+SEAT_MAP_TTL = float(os.getenv("SEAT_MAP_TTL", "30"))
+
+
+def in_range(row, column) -> bool:
+    return isinstance(row, int) and isinstance(column, int) and 0 <= row <= MAX_ROW and 0 <= column <= MAX_COLUMN
+
+
+class SeatMap:
+    # Occupied seats of one bus: one int bitmask per row, bit N set means column N is taken.
+    # A seat reserved more than once is counted in `extra` so releasing one copy keeps the bit.
+
+    def __init__(self, seats: Iterable[Tuple[int, int]] = ()):
+        self.rows: Dict[int, int] = {}
+        self.extra: Counter = Counter()
+        self.count = 0
+        self.built_at = time.monotonic()
+        self._seats: Optional[List[dict]] = None
+        for row, column in seats:
+            self.add(row, column)
+
+    def is_taken(self, row: int, column: int) -> bool:
+        return in_range(row, column) and bool(self.rows.get(row, 0) >> column & 1)
+
+    def add(self, row: int, column: int):
+        if not in_range(row, column):
+            # Never shifted: a negative column raises, a huge one allocates a huge int
+            print(f"Ignoring seat out of range: {row},{column}")
+            return
+        if self.is_taken(row, column):
+            self.extra[(row, column)] += 1
+        else:
+            self.rows[row] = self.rows.get(row, 0) | (1 << column)
+        self.count += 1
+        self._seats = None
+
+    def remove(self, row: int, column: int):
+        if self.extra[(row, column)]:
+            self.extra[(row, column)] -= 1
+        elif self.is_taken(row, column):
+            mask = self.rows[row] & ~(1 << column)
+            if mask:
+                self.rows[row] = mask
+            else:
+                del self.rows[row]
+        else:
+            return
+        self.count -= 1
+        self._seats = None
+
+    def occupied(self) -> set:
+        seats = set()
+        for row, mask in self.rows.items():
+            column = 0
+            while mask:
+                if mask & 1:
+                    seats.add((row, column))
+                mask >>= 1
+                column += 1
+        return seats
+
+    def seats(self) -> List[dict]:
+        # Serialized once per change, polls in between get the same list
+        if self._seats is None:
+            self._seats = [{"row": row, "column": column} for row, column in sorted(self.occupied())]
+            for (row, column), copies in sorted(self.extra.items()):
+                self._seats.extend({"row": row, "column": column} for _ in range(copies))
+        return self._seats
+
+
+class SeatMapCache:
+
+    def __init__(self, ttl: float = SEAT_MAP_TTL):
+        self.ttl = ttl
+        self._maps: Dict[str, SeatMap] = {}
+        self._lock = threading.RLock()
+        # Called with (onibus_id, reserved, released) after a change, and with resync=True when
+        # the changes are unknown. The seat map push hub is one of them.
+        self.listeners: List[Callable] = []
+
+    def add_listener(self, listener: Callable):
+        self.listeners.append(listener)
+
+    def _notify(self, onibus_id: Optional[str], reserved: List[Tuple[int, int]] = (), released: List[Tuple[int, int]] = (), resync: bool = False):
+        for listener in self.listeners:
+            try:
+                listener(onibus_id, reserved, released, resync)
+            except Exception as e:
+                print(f"Error notifying seat map change of {onibus_id}: {e}")
+
+    def load(self, db: Session, onibus_id: str) -> SeatMap:
+        rows = db.query(models.Reservation.seat_row, models.Reservation.seat_column).filter(
+            models.Reservation.onibus_id == onibus_id
+        ).all()
+        return SeatMap(rows)
+
+    def rebuild(self, db: Session, onibus_id: str) -> SeatMap:
+        seat_map = self.load(db, onibus_id)
+        with self._lock:
+            old = self._maps.get(onibus_id)
+            self._maps[onibus_id] = seat_map
+        if old is not None and self.listeners:
+            # Seats changed by other workers show up here, passed on as a change
+            before, after = Counter(old.occupied()), Counter(seat_map.occupied())
+            if before != after:
+                self._notify(onibus_id, list((after - before).elements()), list((before - after).elements()))
+        return seat_map
+
+    def get(self, db: Session, onibus_id: str) -> SeatMap:
+        with self._lock:
+            seat_map = self._maps.get(onibus_id)
+        if seat_map is None or time.monotonic() - seat_map.built_at > self.ttl:
+            seat_map = self.rebuild(db, onibus_id)
+        return seat_map
+
+    def seats(self, db: Session, onibus_id: str) -> List[dict]:
+        return self.get(db, onibus_id).seats()
+
+    # The write paths call these after their commit. A bus that is not cached yet
+    # is left alone, it will be loaded with the committed rows on the next read.
+
+    def reserve(self, onibus_id: str, seats: Iterable[Tuple[int, int]]):
+        seats = list(seats)
+        with self._lock:
+            seat_map = self._maps.get(onibus_id)
+            if seat_map is not None:
+                for row, column in seats:
+                    seat_map.add(row, column)
+        if seats:
+            self._notify(onibus_id, reserved=seats)
+
+    def release(self, onibus_id: str, seats: Iterable[Tuple[int, int]]):
+        seats = list(seats)
+        with self._lock:
+            seat_map = self._maps.get(onibus_id)
+            if seat_map is not None:
+                for row, column in seats:
+                    seat_map.remove(row, column)
+        if seats:
+            self._notify(onibus_id, released=seats)
+
+    def move(self, onibus_id: str, old_seat: Tuple[int, int], new_seat: Tuple[int, int]):
+        with self._lock:
+            seat_map = self._maps.get(onibus_id)
+            if seat_map is not None:
+                seat_map.remove(*old_seat)
+                seat_map.add(*new_seat)
+        if old_seat != new_seat:
+            self._notify(onibus_id, reserved=[new_seat], released=[old_seat])
+
+    def invalidate(self, onibus_id: Optional[str] = None):
+        with self._lock:
+            if onibus_id is None:
+                self._maps.clear()
+            else:
+                self._maps.pop(onibus_id, None)
+        self._notify(onibus_id, resync=True)
+
+    def check_consistency(self, db: Session, onibus_id: str, repair: bool = True) -> dict:
+        # Compares the cached map with the reservations table and optionally rebuilds it
+        fresh = self.load(db, onibus_id)
+        with self._lock:
+            cached = self._maps.get(onibus_id)
+            if cached is None:
+                if repair:
+                    self._maps[onibus_id] = fresh
+                return {"onibus_id": onibus_id, "cached": False, "consistent": True, "missing": [], "unexpected": []}
+
+            cached_seats = Counter((seat["row"], seat["column"]) for seat in cached.seats())
+            fresh_seats = Counter((seat["row"], seat["column"]) for seat in fresh.seats())
+            missing = fresh_seats - cached_seats
+            unexpected = cached_seats - fresh_seats
+            consistent = not missing and not unexpected
+            if repair and not consistent:
+                self._maps[onibus_id] = fresh
+        if repair and not consistent:
+            self._notify(onibus_id, resync=True)
+
+        return {
+            "onibus_id": onibus_id,
+            "cached": True,
+            "consistent": consistent,
+            "missing": [{"row": row, "column": column} for row, column in sorted(missing.elements())],
+            "unexpected": [{"row": row, "column": column} for row, column in sorted(unexpected.elements())],
+        }
+
+
+seat_maps = SeatMapCache()
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class FlightStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.upstream = 0  # Calls that actually ran
+        self.coalesced = 0  # Calls that waited for another one's result
+        self._lock = threading.Lock()
+
+    def record(self, leader: bool):
+        with self._lock:
+            self.calls += 1
+            if leader:
+                self.upstream += 1
+            else:
+                self.coalesced += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "upstream": self.upstream,
+                "coalesced": self.coalesced,
+                "coalescing_ratio": self.coalesced / self.calls if self.calls else 0,
+            }
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of fn, for threads
+
+    def __init__(self, stats: Optional[FlightStats] = None):
+        self.stats = stats or FlightStats()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self.stats.record(leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    # Same for coroutines on one event loop, callers get the shared call's result or exception.
+    # The call runs in its own task and every caller awaits it shielded, so one caller being
+    # cancelled (its client went away) neither cancels the call nor fails the others.
+
+    def __init__(self, stats: Optional[FlightStats] = None):
+        self.stats = stats or FlightStats()
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        self.stats.record(task is None)
+        if task is None:
+            task = self._calls[key] = asyncio.get_running_loop().create_task(fn())
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Every caller may be gone, mark the outcome as retrieved so it is not logged
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,92 @@
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Import first in test.py, the import phase is measured from here
+IMPORT_STARTED = time.perf_counter()
+
+# Creating missing tables on startup costs a round trip per table on every worker boot.
+# Deploys that run `python migrations.py` first can turn it off.
+CREATE_SCHEMA_ON_STARTUP = os.getenv("CREATE_SCHEMA_ON_STARTUP", "true").lower() == "true"
+
+
+class StartupReport:
+    # Seconds spent in each phase of a worker's boot, in order
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def imported(self, module: str):
+        self.record(f"import {module}", time.perf_counter() - IMPORT_STARTED)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            phases = list(self.phases)
+        return {
+            "phases": [{"name": name, "seconds": seconds} for name, seconds in phases],
+            "total": sum(seconds for _, seconds in phases),
+        }
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        phases = ", ".join(f"{phase['name']} {phase['seconds'] * 1000:.0f}ms" for phase in snapshot["phases"])
+        return f"Started in {snapshot['total'] * 1000:.0f}ms ({phases})"
+
+
+startup_report = StartupReport()
+
+
+def import_times(module: str = "test") -> List[Tuple[str, float]]:
+    # Cumulative import time of each package the module imports directly, read from a fresh
+    # interpreter's -X importtime. Children are listed before the module that imported them.
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+    children: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)", line)
+        if not match:
+            continue
+        seconds, depth, name = int(match.group(1)) / 1e6, (len(match.group(2)) - 1) // 2, match.group(3)
+        if depth == 1:
+            package = name.split(".")[0]
+            children[package] = children.get(package, 0) + seconds
+        elif depth == 0:
+            if name == module:
+                children[f"{module} itself"] = seconds - sum(children.values())
+                return sorted(children.items(), key=lambda item: item[1], reverse=True)
+            children = {}  # Imported by the interpreter (site...), not by the module
+    return []
+
+
+if __name__ == "__main__":
+    # python startup.py [top N]: what a cold worker spends importing and starting the app
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    print("Import time by package:")
+    for name, seconds in import_times()[:top]:
+        print(f"  {name:30} {seconds * 1000:8.1f}ms")
+
+    from fastapi.testclient import TestClient
+    import test
+
+    # Runs the startup hooks the way uvicorn would, the last one prints the report
+    with TestClient(test.app):
+        pass
@@ -1,47 +1,68 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Request, BackgroundTasks
+from startup import CREATE_SCHEMA_ON_STARTUP, startup_report  # First, times the rest of the imports
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Request, Response, Query, BackgroundTasks, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
+from sqlalchemy import and_, or_, select, update
 from sqlalchemy.orm import Session
-from pydanticmodels import ClientBase,OnibusBase,ReserveRequest, PaymentData, NotificationData, ReservationResponse, Seat, ReservationDetails, PaymentResponse, DBPaymentData, PaymentResponse, PaymentUpdate
-from typing import Generator, List, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
+from pydanticmodels import ClientBase,OnibusBase,ReserveRequest, PaymentData, ReservationResponse, Seat, ReservationDetails, PaymentResponse, DBPaymentData, PaymentUpdate, ReserveResponse, BulkReserveRequest, BulkReserveResponse
+from typing import Generator, List, Optional, Tuple
 import models
 from fastapi.middleware.cors import CORSMiddleware
 from database import engine, SessionLocal
+from async_database import async_engine, get_async_db, pool_stats
 from datetime import datetime, timedelta
 import os
 import uuid
-import mercadopago
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import storage
-from string import Template  # Import Template from string module
-from fastapi.responses import JSONResponse
-from email.mime.multipart import MIMEMultipart  # Import MIMEMultipart
-from email.mime.text import MIMEText  # Import MIMEText
-import smtplib
-from requests.exceptions import RequestException
-import requests
-import time
-from threading import Thread
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from fastapi.staticfiles import StaticFiles
+from payment_monitor import PaymentMonitorScheduler, enqueue_payment_monitor, monitor_guard
+from seatmap import seat_maps
+from holds import seat_holds
+from booking import BookingEntry, claim_seats, claim_seats_bulk
+from outbox import OutboxWorker, enqueue_email
+from webhooks import FAILED_STATUSES, WebhookConsumer, ingest_notification, webhook_stats
+from mercadopago_gateway import GatewayError, MercadoPagoGateway
+from file_storage import FirebaseStorage, LocalStorage, safe_filename, store_upload
+from images import store_bus_photo
+from mail_templates import render_reservation_email, render_payment_confirmed_email
+from pagination import MAX_PAGE_SIZE, FastJSONResponse, column_rows, fetch_page, set_next_cursor, next_cursor_headers, ndjson_response, model_row, not_null
+from sales_summary import add_reservations, record_payment, remove_onibus, occupancy, revenue, payment_counts, seed as seed_summary
+from response_cache import ONIBUS_LIST, onibus_cache, onibus_scope, cached_json, invalidate_onibus, invalidate_onibus_async
+from trips import TRIPS_MAX_IDS, trips_of
+from manifest import MANIFEST_FORMATS, manifest_chunks
+from admission import ADMISSION_ENABLED, admission_stats, admit, admit_join, waiting_room
+from seat_push import SeatMapRefresher, seat_hub, sse_event
+from metrics import METRICS_ENABLED, MetricsMiddleware, exposition, instrument_engine, payment_seat_conflicts
 
 
 
 load_dotenv()
 
-cred = credentials.Certificate('./firebasekey.json')
-firebase_admin.initialize_app(cred, {
-    'storageBucket': 'flamengoexcursao.appspot.com'
-})
-
-bucket = storage.bucket()
-
-
 app = FastAPI(ssl_keyfile="./private.key", ssl_certfile="./certificate.crt")
 
-models.Base.metadata.create_all(bind=engine)
+# Missing tables are created when the worker starts, not when test.py is imported
+@app.on_event("startup")
+def create_schema():
+    if CREATE_SCHEMA_ON_STARTUP:
+        with startup_report.phase("create schema"):
+            models.Base.metadata.create_all(bind=engine)
+            # The sales summary table may have just been created next to existing buses
+            db = SessionLocal()
+            try:
+                seed_summary(db)
+            finally:
+                db.close()
+
+# Shared Mercado Pago client: kept-alive connections, timeouts, circuit breaker and final status cache
+gateway = MercadoPagoGateway()
 
-access_token = os.getenv("MERCADO_PAGO_ACCESS_TOKEN")
-sdk = mercadopago.SDK(access_token)
+@app.on_event("shutdown")
+async def close_gateway():
+    gateway.close()
+    await gateway.aclose()
 
 
 def get_db() -> Generator[Session, None, None]:
@@ -69,6 +90,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latency per route, SQL queries per request and outbound calls, scraped from /metrics
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    instrument_engine(engine)
+    instrument_engine(async_engine.sync_engine)
+
 
 
 
@@ -78,56 +105,52 @@ UPLOAD_DIR = "./uploads"
 # Ensure the upload directory exists, create it if necessary
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+local_storage = LocalStorage(UPLOAD_DIR, os.getenv("LOCAL_STORAGE_URL", "/uploads"))
 
+# Uploads go to Firebase Storage, STORAGE_BACKEND=local keeps them in UPLOAD_DIR (offline/dev)
+if os.getenv("STORAGE_BACKEND", "firebase") == "local":
+    storage_backend = local_storage
+    app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+else:
+    def firebase_bucket():
+        # Imported on the first upload, the SDK is slow to import and needs the key file
+        import firebase_admin
+        from firebase_admin import credentials, storage
 
-# Load the email template
-def load_template():
-    with open("email_template.html", "r", encoding="utf-8") as file:
-        template = Template(file.read())
-    return template
+        cred = credentials.Certificate('./firebasekey.json')
+        firebase_admin.initialize_app(cred, {
+            'storageBucket': 'flamengoexcursao.appspot.com'
+        })
+        return storage.bucket()
 
-# Send email function
-def send_email(to_email: str, subject: str, body: str):
-    try:
-        # Email account credentials
-        gmail_user = os.getenv("GMAIL_USER")
-        gmail_password = os.getenv("GMAIL_PASSWORD")
+    storage_backend = FirebaseStorage(firebase_bucket)
 
-        # Create the email
-        msg = MIMEMultipart()
-        msg["From"] = gmail_user
-        msg["To"] = to_email
-        msg["Subject"] = subject
 
-        # Attach the HTML body
-        msg.attach(MIMEText(body, "html"))
 
-        # Send the email
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(gmail_user, gmail_password)
-            server.sendmail(gmail_user, to_email, msg.as_string())
+# Emails are written to the outbox table and sent by the outbox worker over pooled SMTP connections
+outbox_worker = OutboxWorker(SessionLocal)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@app.on_event("startup")
+def start_outbox_worker():
+    with startup_report.phase("start outbox worker"):
+        outbox_worker.start()
 
-@app.post("/send-confirmation-email/")
-async def send_confirmation_email(details: ReservationDetails, background_tasks: BackgroundTasks):
-    try:
-        # Load the email template
-        template = load_template()
+@app.on_event("shutdown")
+def stop_outbox_worker():
+    outbox_worker.stop()
 
-        # Ensure seats are converted to strings
-        seats_str = [str(seat) for seat in details.seats]
+def send_email(db: Session, to_email: str, subject: str, body: str):
+    enqueue_email(db, to_email, subject, body)
+    outbox_worker.wake()
 
-        # Render the email content
-        email_content = template.substitute(
-            client_id=details.client_id,
-            onibus_id=details.onibus_id,
-            seats=", ".join(seats_str),
-        )
+@app.post("/send-confirmation-email/")
+async def send_confirmation_email(details: ReservationDetails, db: AsyncSession = Depends(get_async_db)):
+    try:
+        # Render the email content, the template is compiled once and cached
+        email_content = render_reservation_email(details.client_id, details.onibus_id, details.seats)
 
-        # Send the email in the background
-        background_tasks.add_task(send_email, details.email, "Confirmação de Reserva", email_content)
+        # Queue the email, the outbox worker sends it
+        await db.run_sync(send_email, details.email, "Confirmação de Reserva", email_content)
 
         return JSONResponse(status_code=200, content={"message": "Email de confirmação enviado com sucesso"})
 
@@ -135,129 +158,123 @@ async def send_confirmation_email(details: ReservationDetails, background_tasks:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def save_file_locally(file: UploadFile, category: str, client_id: str, db: Session):
+def save_file_locally(file: UploadFile, category: str, client_id: str):
     # Generate a unique filename
     file_extension = file.filename.split(".")[-1]
     unique_filename = f"{uuid.uuid4()}.{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    # Open a file in write-binary mode and write the file contents
-    with open(file_path, "wb") as buffer:
-        buffer.write(file.file.read())
-    # Save file metadata to the database
-    db_file = models.File(category=category, client_id=client_id, file_path=file_path)
-    db.add(db_file)
-    db.commit()
-    db.refresh(db_file)
-    return db_file
+    # Streamed to disk in chunks instead of reading the whole file into memory
+    file_url = local_storage.save(f"{category}/{client_id}/{unique_filename}", file.file, file.content_type)
+    return {"file_url": file_url}
 
 @app.post("/upload/")
-async def upload_file(client_id: str, category: str, file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_file(client_id: str, category: str, file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
     # Check if the client exists
-    client = db.query(models.Client).filter(models.Client.id == client_id).first()
+    client = await db.get(models.Client, client_id)
     if not client:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
 
-    # Upload the file to Firebase Storage
-    blob = bucket.blob(f"{category}/{client_id}/{file.filename}")
-    blob.upload_from_file(file.file, content_type=file.content_type)
-
-    # Optionally, make the file publicly accessible
-    blob.make_public()
+    # Upload the file to the storage backend, off the event loop
+    file_url = await store_upload(storage_backend, f"{category}/{client_id}/{safe_filename(file.filename)}", file)
 
-    return {"file_url": blob.public_url}
+    return {"file_url": file_url}
 
 @app.post("/upload/home/")
-async def upload_foto_home(onibus_id: str, file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_foto_home(onibus_id: str, background_tasks: BackgroundTasks, file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
     # Check if the onibus exists
-    onibus = db.query(models.Onibus).filter(models.Onibus.id == onibus_id).first()
+    onibus = await db.get(models.Onibus, onibus_id)
     if not onibus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
 
-    # Upload the file to Firebase Storage
-    blob = bucket.blob(f"onibus/{onibus_id}/home/{file.filename}")
-    blob.upload_from_file(file.file, content_type=file.content_type)
-    blob.make_public()  # Optionally make the file publicly accessible
-
-    # Update the Onibus record with the new foto_home URL
-    onibus.foto_casa = blob.public_url
-    db.commit()
+    # Stored once per image content, thumbnail/card/full copies are made in the background
+    file_url = await store_bus_photo(db, SessionLocal, storage_backend, onibus, "home", file, background_tasks)
+    await invalidate_onibus_async(onibus_id)
 
-    return {"file_url": blob.public_url}
+    return {"file_url": file_url}
 
 @app.post("/upload/visita/")
-async def upload_foto_visita(onibus_id: str, file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_foto_visita(onibus_id: str, background_tasks: BackgroundTasks, file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
     # Check if the onibus exists
-    onibus = db.query(models.Onibus).filter(models.Onibus.id == onibus_id).first()
+    onibus = await db.get(models.Onibus, onibus_id)
     if not onibus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
 
-    # Upload the file to Firebase Storage
-    blob = bucket.blob(f"onibus/{onibus_id}/visita/{file.filename}")
-    blob.upload_from_file(file.file, content_type=file.content_type)
-    blob.make_public()  # Optionally make the file publicly accessible
+    # Stored once per image content, thumbnail/card/full copies are made in the background
+    file_url = await store_bus_photo(db, SessionLocal, storage_backend, onibus, "visita", file, background_tasks)
+    await invalidate_onibus_async(onibus_id)
 
-    # Update the Onibus record with the new foto_visita URL
-    onibus.foto_visita = blob.public_url
-    db.commit()
+    return {"file_url": file_url}
 
-    return {"file_url": blob.public_url}
 
+# Only the columns PaymentResponse needs, read as tuples
+payment_columns = [
+    models.Payment.id, models.Payment.client_id, models.Payment.onibus_id, models.Payment.payment_id, models.Payment.status,
+    models.Payment.timestamp, models.Payment.seats, models.Payment.transaction_amount, models.Payment.approved,
+]
+
+def payment_row(row) -> dict:
+    # PaymentResponse shape, the seat is the payment's first one
+    seat = row.seats[0] if row.seats else {}
+    return {
+        "id": row.id,
+        "client_id": row.client_id,
+        "onibus_id": row.onibus_id,
+        "payment_id": row.payment_id,
+        "status": row.status,
+        "timestamp": row.timestamp,
+        "seat_row": seat.get("row"),
+        "seat_column": seat.get("column"),
+        "amount": row.transaction_amount,
+        "approved": bool(row.approved),
+    }
 
 @app.get("/payments/recent", response_model=List[PaymentResponse])
-def get_recent_payments(db: Session = Depends(get_db)):
+async def get_recent_payments(db: AsyncSession = Depends(get_async_db)):
     # Calculate timestamp 30 minutes ago
     thirty_minutes_ago = datetime.now() - timedelta(minutes=30)
 
     # Query payments within the last 30 minutes
-    recent_payments = db.query(models.Payment).filter(models.Payment.timestamp >= thirty_minutes_ago).all()
-
-    # Convert datetime fields to string format
-    for payment in recent_payments:
-        payment.timestamp = str(payment.timestamp)
+    recent_payments = await db.execute(select(*payment_columns).where(models.Payment.timestamp >= thirty_minutes_ago))
+    return FastJSONResponse([payment_row(payment) for payment in recent_payments])
 
-    return recent_payments
+@app.get("/payments/review", response_model=List[PaymentResponse])
+async def get_payments_to_review(db: AsyncSession = Depends(get_async_db)):
+    # Approved payments whose seats were sold to somebody else before the confirmation
+    payments = await db.execute(select(*payment_columns).where(models.Payment.needs_review == True).order_by(models.Payment.timestamp))
+    return FastJSONResponse([payment_row(payment) for payment in payments])
 
 @app.get("/payments/status/{payment_id}")
-async def get_payment_status(payment_id: str, db: Session = Depends(get_db)):
+async def get_payment_status(payment_id: str, db: AsyncSession = Depends(get_async_db)):
     try:
         # Fetch payment details from your database
-        payment = db.query(models.Payment).filter(models.Payment.payment_id == payment_id).first()
+        payment = await db.scalar(select(models.Payment).where(models.Payment.payment_id == payment_id))
         if not payment:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment not found")
 
-        # Construct the URL for Mercado Pago API endpoint
-        url = f"https://api.mercadopago.com/v1/payments/{payment_id}"
-
-        # Prepare headers with Authorization token
-        headers = {
-            'Authorization': f'Bearer {os.getenv("MERCADO_PAGO_ACCESS_TOKEN")}',
-            'Content-Type': 'application/json',
-        }
-
-        # Make GET request to Mercado Pago API using requests library
-        response = requests.get(url, headers=headers)
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            payment_status = response.json()['status']
-
-            # Handle payment confirmation
-            if payment_status == 'approved':
-                # Perform actions upon payment confirmation
-                process_payment_confirmation(payment, db)
-                return {"message": "Payment confirmed and processed"}
-
-            elif payment_status == 'pending':
-                # Schedule monitoring for payment confirmation
-                monitor_payment(payment, db)
-                return {"message": "Payment is pending confirmation. Monitoring initiated."}
-
-            else:
-                # Payment is not yet confirmed or failed
-                return {"message": f"Payment status: {payment_status}"}
+        # Ask Mercado Pago through the shared client, final statuses come from its cache
+        try:
+            payment_status = await gateway.payment_status_async(payment_id)
+        except GatewayError as e:
+            print(f"Error fetching payment status from Mercado Pago: {e}")
+            raise HTTPException(status_code=e.status_code or 502, detail="Failed to fetch payment status")
+
+        # Handle payment confirmation
+        if payment_status == 'approved':
+            # Perform actions upon payment confirmation
+            await db.run_sync(lambda session: process_payment_confirmation(payment, session))
+            return {"message": "Payment confirmed and processed"}
+
+        elif payment_status == 'pending':
+            # The checkout page is still open, keep its seats held
+            seat_holds.refresh(payment_id)
+            # Schedule monitoring for payment confirmation
+            await db.run_sync(lambda session: monitor_payment(payment, session))
+            return {"message": "Payment is pending confirmation. Monitoring initiated."}
 
         else:
-            raise HTTPException(status_code=response.status_code, detail="Failed to fetch payment status")
+            # Payment is not yet confirmed or failed
+            if payment_status in FAILED_STATUSES:
+                seat_holds.release(payment_id)
+            return {"message": f"Payment status: {payment_status}"}
 
     except HTTPException as he:
         raise he
@@ -270,95 +287,103 @@ def monitor_payment(payment: models.Payment, db: Session):
         if not isinstance(payment, models.Payment):
             raise TypeError("Expected 'payment' to be an instance of models.Payment")
 
-        # Schedule a background task to monitor payment status every minute for 30 minutes
-        monitor_thread = Thread(target=monitor_task, args=(payment, db))
-        monitor_thread.start()
+        # Persist a monitor job, the scheduler checks its status every minute for 30 minutes
+        if not monitor_guard.claim(payment.payment_id):
+            return
+        try:
+            enqueue_payment_monitor(db, payment.payment_id)
+        except Exception:
+            monitor_guard.release(payment.payment_id)
+            raise
+        payment_monitor.wake()
 
     except Exception as e:
         print(f"Error in monitor_payment: {e}")
 
-def monitor_task(payment: models.Payment, db: Session):
-    try:
-        for _ in range(30):  # 30 checks, 1 minute apart
-            # Check payment status using the same logic as get_payment_status
-            try:
-                if not isinstance(payment, models.Payment):
-                    raise TypeError("Expected 'payment' to be an instance of models.Payment")
-
-                url = f"https://api.mercadopago.com/v1/payments/{payment.payment_id}"
-                headers = {
-                    'Authorization': f'Bearer {os.getenv("MERCADO_PAGO_ACCESS_TOKEN")}',
-                    'Content-Type': 'application/json',
-                }
-                response = requests.get(url, headers=headers)
-                if response.status_code == 200:
-                    payment_status = response.json()['status']
-                    if payment_status == 'approved':
-                        # Perform actions upon payment confirmation
-                        process_payment_confirmation(payment, db)
-                        break  # Exit loop if payment is confirmed
-                    elif payment_status != 'pending':
-                        break  # Exit loop if payment status is not pending or approved
-                else:
-                    break  # Exit loop on error fetching status
-            except Exception as e:
-                print(f"Error monitoring payment {payment.payment_id}: {e}")
-            time.sleep(60)  # Wait for 60 seconds before next check
-    except Exception as e:
-        print(f"Error in monitor_task: {e}")
+def fetch_mercadopago_status(payment_id: str):
+    # Raises GatewayError when the status can't be read, the callers retry later
+    return gateway.payment_status(payment_id)
 
 def process_payment_confirmation(payment: models.Payment, db: Session):
     try:
-        # Update payment status to 'approved' in your database
-        payment.status = 'approved'
-        db.commit()
-
-        reservations = []
-        for seat in payment.seats:
-            new_reservation = models.Reservation(
-                id=str(uuid.uuid4()),  # Convert UUID to string for ORM compatibility
-                client_id=payment.client_id,
-                onibus_id=payment.onibus_id,
-                seat_row=seat['row'],
-                seat_column=seat['column'],
-                timestamp=datetime.now()
-            )
-            # Create reservations in your database
-            db.add(new_reservation)
-            reservations.append(new_reservation)
-
+        # Set the marker only if nobody did it before us, so the reservations are created exactly
+        # once even if the monitor and a status poll race. The status is no guard, /approve_payment
+        # may already have written 'approved' without creating anything.
+        updated = db.query(models.Payment).filter(
+            models.Payment.id == payment.id,
+            or_(models.Payment.reservations_created.is_(None), models.Payment.reservations_created == False),
+        ).update({models.Payment.reservations_created: True}, synchronize_session=False)
+        if not updated:
+            db.rollback()
+            return
+        # The row is ours until the commit, its status can't move under us
+        old_status = db.query(models.Payment.status).filter(models.Payment.id == payment.id).scalar()
+        db.query(models.Payment).filter(models.Payment.id == payment.id).update({models.Payment.status: 'approved'}, synchronize_session=False)
+        record_payment(db, payment.onibus_id, payment.transaction_amount, old_status, 'approved')
+
+        # Create reservations in your database, seats sold in the meantime come back as conflicts
+        # The payment's own seat hold doesn't count against it
+        booking = claim_seats(db, payment.onibus_id, payment.client_id, [(seat['row'], seat['column']) for seat in payment.seats], holder=payment.payment_id)
+        if booking.conflicts:
+            # Paid for seats somebody else got, listed by /payments/review for a refund or a rebooking
+            db.query(models.Payment).filter(models.Payment.id == payment.id).update({models.Payment.needs_review: True}, synchronize_session=False)
+
+        # Confirmation email into the outbox, none when no seat could be reserved
+        if booking.reserved:
+            seats = [f"{row},{column}" for row, column in booking.reserved_seats]
+            send_confirmation_email_monitor(db, payment.client_id, payment.onibus_id, payment.email, seats)
+
+        # Status change, flag, reservations and email go in the same transaction
         db.commit()
-
-        # Send confirmation email
-        seats = [f"{seat['row']},{seat['column']}" for seat in payment.seats]
-        send_confirmation_email_monitor(payment.client_id, payment.onibus_id, payment.email, seats)
+        if booking.conflicts:
+            payment_seat_conflicts.inc(("partial" if booking.reserved else "none",))
+        outbox_worker.wake()
+        db.refresh(payment)
+        seat_maps.reserve(payment.onibus_id, booking.reserved_seats)
+        seat_holds.convert(payment.payment_id)
+        invalidate_onibus(payment.onibus_id)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing payment confirmation: {str(e)}")
 
-def send_confirmation_email_monitor(client_id: str, onibus_id: str, email: str, seats: list):
+def send_confirmation_email_monitor(db: Session, client_id: str, onibus_id: str, email: str, seats: list):
+    # Only added to the caller's transaction, the caller commits and wakes the outbox worker
     try:
         subject = "Sua Reserva foi Confirmada"
-        body = f"""
-        <h1>Excursões Flamengo - Reserva Confirmada</h1>
-        <p>ID do Cliente: {client_id},</p>
-        <p>Por favor, traga este e-mail impresso, em PDF ou captura de tela com você.</p>
-        <p>Sua reserva para o ônibus com ID {onibus_id} foi confirmada.</p>
-        <p>Assentos:</p>
-        <ul>
-        {"".join([f"<li>{seat}</li>" for seat in seats])}
-        </ul>
-        <p>Obrigado por escolher nosso serviço!</p>
-        """
-
-        send_email(email, subject, body)
+        body = render_payment_confirmed_email(client_id, onibus_id, seats)
+
+        enqueue_email(db, email, subject, body, commit=False)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao enviar e-mail de confirmação: {str(e)}")
         
 
+# Pending PIX payments are watched by a DB-backed job queue instead of a thread per payment
+payment_monitor = PaymentMonitorScheduler(SessionLocal, fetch_mercadopago_status, process_payment_confirmation)
+# Webhook events stored by /notification are applied by the consumer
+webhook_consumer = WebhookConsumer(SessionLocal, fetch_mercadopago_status, process_payment_confirmation)
+
+@app.on_event("startup")
+def start_payment_monitor():
+    with startup_report.phase("start payment monitor"):
+        payment_monitor.start()
+
+@app.on_event("shutdown")
+def stop_payment_monitor():
+    payment_monitor.stop()
+
+@app.on_event("startup")
+def start_webhook_consumer():
+    with startup_report.phase("start webhook consumer"):
+        webhook_consumer.start()
+
+@app.on_event("shutdown")
+def stop_webhook_consumer():
+    webhook_consumer.stop()
+
+
 # Create Database Payment
 @app.post("/create_db_payment", response_model=DBPaymentData, status_code=status.HTTP_201_CREATED)
-def create_db_payment(payment_data: DBPaymentData, db: Session = Depends(get_db)):
+async def create_db_payment(payment_data: DBPaymentData, db: AsyncSession = Depends(get_async_db)):
     # Convert approved to boolean
     approved = True if payment_data.approved == "true" else False
 
@@ -374,9 +399,31 @@ def create_db_payment(payment_data: DBPaymentData, db: Session = Depends(get_db)
         approved=approved,
         timestamp=datetime.now()  # No need to convert to string explicitly
     )
+    # A duplicate must not touch the hold of the payment it duplicates
+    exists = await db.scalar(select(models.Payment.id).where(models.Payment.payment_id == new_payment.payment_id))
+    if exists or seat_holds.has(new_payment.payment_id):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Payment already exists")
+    # Hold the seats until the PIX is paid, other buyers see them as taken meanwhile
+    held = seat_holds.hold(new_payment.payment_id, new_payment.onibus_id, [(seat.row, seat.column) for seat in payment_data.seats])
+    if held:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={
+            "message": "Seats are held for another payment",
+            "conflicts": [{"row": row, "column": column, "reason": "seat_held"} for row, column in held],
+        })
     db.add(new_payment)
-    db.commit()
-    db.refresh(new_payment)
+    try:
+        await db.run_sync(record_payment, new_payment.onibus_id, new_payment.transaction_amount, None, new_payment.status)
+        await db.commit()
+    except IntegrityError:
+        # payment_id is unique, Mercado Pago payments can only be stored once. Another worker
+        # stored it meanwhile, the hold placed above is for nothing.
+        await db.rollback()
+        seat_holds.release(new_payment.payment_id)
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Payment already exists")
+    except Exception:
+        seat_holds.release(new_payment.payment_id)
+        raise
+    await db.refresh(new_payment)
 
     # Convert fields to strings before returning
     new_payment.email = str(payment_data.email) if payment_data.email else None
@@ -386,65 +433,78 @@ def create_db_payment(payment_data: DBPaymentData, db: Session = Depends(get_db)
     return new_payment
 
 @app.put("/edit_payment/{payment_id}", response_model=PaymentResponse)
-def edit_payment(payment_id: str, payment_update: PaymentUpdate, db: Session = Depends(get_db)):
-    payment = db.query(models.Payment).filter(models.Payment.payment_id == payment_id).first()
+async def edit_payment(payment_id: str, payment_update: PaymentUpdate, db: AsyncSession = Depends(get_async_db)):
+    payment = await db.scalar(select(models.Payment).where(models.Payment.payment_id == payment_id))
     if not payment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment not found")
 
     if payment_update.status:
+        await db.run_sync(record_payment, payment.onibus_id, payment.transaction_amount, payment.status, payment_update.status)
         payment.status = payment_update.status
     if payment_update.amount:
         payment.amount = payment_update.amount
 
-    db.commit()
-    db.refresh(payment)
+    await db.commit()
+    await db.refresh(payment)
     return payment
 
 @app.delete("/delete_payment/{payment_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = db.query(models.Payment).filter(models.Payment.payment_id == payment_id).first()
+async def delete_payment(payment_id: str, db: AsyncSession = Depends(get_async_db)):
+    payment = await db.scalar(select(models.Payment).where(models.Payment.payment_id == payment_id))
     if not payment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment not found")
 
-    db.delete(payment)
-    db.commit()
+    await db.run_sync(record_payment, payment.onibus_id, payment.transaction_amount, payment.status, None)
+    await db.delete(payment)
+    await db.commit()
+    seat_holds.release(payment_id)
     return {"message": "Payment deleted successfully"}
 
 @app.post("/approve_payment/{payment_id}", status_code=status.HTTP_200_OK)
-def approve_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = db.query(models.Payment).filter(models.Payment.payment_id == payment_id).first()
+async def approve_payment(payment_id: str, db: AsyncSession = Depends(get_async_db)):
+    payment = await db.scalar(select(models.Payment).where(models.Payment.payment_id == payment_id))
 
     if not payment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment not found")
 
     if payment.status == 'pending':  # Check if payment status is pending
+        await db.run_sync(record_payment, payment.onibus_id, payment.transaction_amount, payment.status, 'approved')
         payment.status = 'approved'  # Change status to approved
-        db.commit()  # Commit the change to the database
+        await db.commit()  # Commit the change to the database
         return {"message": "Payment approved"}
     else:
         raise HTTPException(status_code=400, detail="Payment not pending or already processed")
 
 @app.get("/get_payment_by_client/{client_id}", response_model=List[PaymentResponse])
-def get_payment_by_client(client_id: str, db: Session = Depends(get_db)):
-    payments = db.query(models.Payment).filter(models.Payment.client_id == client_id).all()
-    if not payments:
+async def get_payment_by_client(client_id: str, request: Request, response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False, db: AsyncSession = Depends(get_async_db)):
+    # Payments without a timestamp sort first instead of falling out of the keyset
+    timestamp = not_null(models.Payment.timestamp)
+    order = [timestamp, models.Payment.id]
+    if stream:
+        # Same rows and shape as the pages
+        return ndjson_response(SessionLocal, lambda session: session.query(*payment_columns, timestamp).filter(models.Payment.client_id == client_id), order, payment_row)
+
+    payments, next_cursor = await db.run_sync(lambda session: fetch_page(session.query(*payment_columns, timestamp).filter(models.Payment.client_id == client_id), order, limit, cursor))
+    if not payments and not cursor:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No payments found for this client")
 
-    return payments
+    return FastJSONResponse([payment_row(payment) for payment in payments], headers=next_cursor_headers(request, next_cursor))
 
 @app.post("/deny_payment/{payment_id}", status_code=status.HTTP_200_OK)
-def deny_payment(payment_id: str, db: Session = Depends(get_db)):
-    payment = db.query(models.Payment).filter(models.Payment.payment_id == payment_id).first()
+async def deny_payment(payment_id: str, db: AsyncSession = Depends(get_async_db)):
+    payment = await db.scalar(select(models.Payment).where(models.Payment.payment_id == payment_id))
     if not payment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment not found")
 
+    await db.run_sync(record_payment, payment.onibus_id, payment.transaction_amount, payment.status, 'denied')
     payment.status = 'denied'
-    db.commit()
+    await db.commit()
+    seat_holds.release(payment_id)
     return {"message": "Payment denied"}
 
 #########################################
-@app.post("/create_payment", status_code=status.HTTP_201_CREATED)
-def create_pix_payment(payment_data: PaymentData, db: Session = Depends(get_db)):
+@app.post("/create_payment", status_code=status.HTTP_201_CREATED, dependencies=[Depends(admit)])
+async def create_pix_payment(payment_data: PaymentData):
     try:
         payment_request = {
             "transaction_amount": payment_data.transaction_amount,
@@ -456,8 +516,7 @@ def create_pix_payment(payment_data: PaymentData, db: Session = Depends(get_db))
             "notification_url": "https://api.flamengoexcurcoesvrmaracana.online:8000/notification"
         }
 
-        payment_response = sdk.payment().create(payment_request)
-        response = payment_response["response"]
+        response = await gateway.create_payment_async(payment_request)
 
         if response["status"] == "pending":
             return {"message": "PIX Payment created", "pix_link": response["point_of_interaction"]["transaction_data"]["ticket_url"]}
@@ -467,35 +526,34 @@ def create_pix_payment(payment_data: PaymentData, db: Session = Depends(get_db))
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/notification")
-async def receive_notification(notification: NotificationData, db: Session = Depends(get_db)):
-    payment_id = notification.data['id']
-
-    # Here we would typically call Mercado Libre's API to verify the payment status
-    # For the sake of this example, we assume the payment is confirmed if action is `payment.updated`
-
-    if notification.action == 'payment.updated':
-        # Find the corresponding reservation and update its status
-        reservation = db.query(models.Reservation).filter(models.Reservation.id == payment_id).first()
-        if reservation:
-            reservation.confirmed = True
-            db.commit()
-        else:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
+async def receive_notification(request: Request, db: AsyncSession = Depends(get_async_db)):
+    # Mercado Pago only needs a 200: the raw event is stored (once per notification id) and
+    # the webhook consumer resolves it against Payment.payment_id in the background
+    if await ingest_notification(db, await request.body(), request.query_params):
+        webhook_consumer.wake()
+    return {"message": "Notification received"}
 
-    return {"message": "Notification processed"}
+@app.get("/notification/stats")
+def get_notification_stats():
+    return webhook_stats.snapshot()
 
 # Example endpoint to check reservation status
 @app.get("/reservation_status")
-def get_reservation_status(onibus_id: str, email: str, db: Session = Depends(get_db)):
-    client = db.query(models.Client).filter(models.Client.email == email).first()
-    if not client:
+async def get_reservation_status(onibus_id: str, email: str, db: AsyncSession = Depends(get_async_db)):
+    # One query: the client by email, outer joined to its reservation on the bus
+    row = (await db.execute(
+        select(models.Client.id, models.Reservation.id, models.Reservation.confirmed)
+        .outerjoin(models.Reservation, and_(models.Reservation.client_id == models.Client.id, models.Reservation.onibus_id == onibus_id))
+        .where(models.Client.email == email)
+        .order_by(models.Reservation.id.is_(None))
+        .limit(1)
+    )).first()
+    if not row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
-
-    reservation = db.query(models.Reservation).filter(models.Reservation.onibus_id == onibus_id, models.Reservation.client_id == client.id).first()
-    if not reservation:
+    if row[1] is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
 
-    return {"confirmed": reservation.confirmed}
+    return {"confirmed": row[2]}
 
 
 ########## if reservation is confirmed, call endpoint too send email with confirmation##################
@@ -505,53 +563,81 @@ def get_reservation_status(onibus_id: str, email: str, db: Session = Depends(get
 
 ##################### CREATE CLIENTE #####
 @app.post("/clients/", response_model=ClientBase)
-def create_client(client: ClientBase, db: Session = Depends(get_db)):
+async def create_client(client: ClientBase, db: AsyncSession = Depends(get_async_db)):
     db_client = models.Client(**client.model_dump())
     db.add(db_client)
-    db.commit()
-    db.refresh(db_client)
+    await db.commit()
+    await db.refresh(db_client)
     return db_client
 
 
 ########### ATUALIZAR CLIENTE###############
 @app.put("/clients/{client_id}", response_model=ClientBase)
-def update_client(client_id: str, client: ClientBase, db: Session = Depends(get_db)):
-    db_client = db.query(models.Client).filter(models.Client.id == client_id).first()
+async def update_client(client_id: str, client: ClientBase, db: AsyncSession = Depends(get_async_db)):
+    db_client = await db.get(models.Client, client_id)
     if not db_client:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
 
     for field, value in client.dict(exclude_unset=True).items():
         setattr(db_client, field, value)
 
-    db.commit()
-    db.refresh(db_client)
+    await db.commit()
+    await db.refresh(db_client)
     return db_client
 
 ####### APAGAR CLIENTE #######
 @app.delete("/clients/{client_id}")
-def delete_client(client_id: str, db: Session = Depends(get_db)):
-    db_client = db.query(models.Client).filter(models.Client.id == client_id).first()
+async def delete_client(client_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_client = await db.get(models.Client, client_id)
     if not db_client:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
 
-    db.delete(db_client)
-    db.commit()
+    await db.delete(db_client)
+    await db.commit()
     return {"message": "Client deleted successfully"}
 
 
 
 ####### PEGAR TODOS OS CLIENTES #####
 @app.get("/clients/", response_model=List[ClientBase])
-def get_all_clients(db: Session = Depends(get_db)):
-    return db.query(models.Client).all()
+async def get_all_clients(request: Request, response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False, db: AsyncSession = Depends(get_async_db)):
+    # Every client as before, keyset pages ordered by id with ?limit or ?cursor, ?stream=true returns NDJSON read in chunks
+    order = [models.Client.id]
+    if stream:
+        return ndjson_response(SessionLocal, lambda session: session.query(models.Client), order, model_row(ClientBase))
+
+    clients, next_cursor = await db.run_sync(lambda session: fetch_page(session.query(models.Client), order, limit, cursor))
+    set_next_cursor(request, response, next_cursor)
+    return clients
+
+
 
+##### VIAGENS DE UM OU VARIOS CLIENTES
+# Client, trips per bus with seats and payments, loaded in three queries whatever the number of trips
+@app.get("/clients/{client_id}/trips")
+async def get_client_trips(client_id: str, db: AsyncSession = Depends(get_async_db)):
+    result = await db.run_sync(trips_of, [client_id])
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
+    return FastJSONResponse(result[0])
+
+@app.get("/clients")
+async def get_clients_trips(request: Request, ids: Optional[List[str]] = Query(None), db: AsyncSession = Depends(get_async_db)):
+    # ?ids=a,b or ?ids=a&ids=b, unknown ids are left out
+    if ids is None:
+        # Without ids this is still the client listing, as before the route existed
+        return RedirectResponse(request.url.replace(path="/clients/"), status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+    client_ids = [client_id for value in ids for client_id in value.split(",") if client_id]
+    if len(client_ids) > TRIPS_MAX_IDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {TRIPS_MAX_IDS} ids")
+    return FastJSONResponse(await db.run_sync(trips_of, client_ids))
 
 
 ##### PEGAR CLIENTE POR ID
 
 @app.get("/clients/{client_id}", response_model=ClientBase)
-def get_client_by_id(client_id: str, db: Session = Depends(get_db)):
-    db_client = db.query(models.Client).filter(models.Client.id == client_id).first()
+async def get_client_by_id(client_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_client = await db.get(models.Client, client_id)
     if not db_client:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
 
@@ -561,139 +647,361 @@ def get_client_by_id(client_id: str, db: Session = Depends(get_db)):
 
 ##########CREATE ONIBUS############################
 @app.post("/onibus/", response_model=OnibusBase)
-def create_onibus(onibus: OnibusBase, db: Session = Depends(get_db)):
+async def create_onibus(onibus: OnibusBase, db: AsyncSession = Depends(get_async_db)):
     db_onibus = models.Onibus(**onibus.model_dump())
     db.add(db_onibus)
-    db.commit()
-    db.refresh(db_onibus)
+    await db.commit()
+    await db.refresh(db_onibus)
+    await invalidate_onibus_async(db_onibus.id)
     return db_onibus
 
 ############UPDATE ONIBUS ####################
 @app.put("/onibus/{onibus_id}", response_model=OnibusBase)
-def update_onibus(onibus_id: str, onibus: OnibusBase, db: Session = Depends(get_db)):
-    db_onibus = db.query(models.Onibus).filter(models.Onibus.id == onibus_id).first()
+async def update_onibus(onibus_id: str, onibus: OnibusBase, db: AsyncSession = Depends(get_async_db)):
+    db_onibus = await db.get(models.Onibus, onibus_id)
     if not db_onibus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
 
     for field, value in onibus.model_dump(exclude_unset=True).items():
         setattr(db_onibus, field, value)
 
-    db.commit()
-    db.refresh(db_onibus)
+    await db.commit()
+    await db.refresh(db_onibus)
+    await invalidate_onibus_async(onibus_id)
     return db_onibus
 
 ##############DELETE ONIBUS ############################
 @app.delete("/onibus/{onibus_id}")
-def delete_onibus(onibus_id: str, db: Session = Depends(get_db)):
-    db_onibus = db.query(models.Onibus).filter(models.Onibus.id == onibus_id).first()
+async def delete_onibus(onibus_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_onibus = await db.get(models.Onibus, onibus_id)
     if not db_onibus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
 
-    db.delete(db_onibus)
-    db.commit()
+    await db.run_sync(remove_onibus, onibus_id)
+    await db.delete(db_onibus)
+    await db.commit()
+    seat_maps.invalidate(onibus_id)
+    await invalidate_onibus_async(onibus_id)
     return {"message": "Onibus deleted successfully"}
 
 
 ################ GET ALL ONIBUS ################
+onibus_row = model_row(OnibusBase)
+
 @app.get("/onibus/", response_model=List[OnibusBase])
-def get_all_onibus(db: Session = Depends(get_db)):
-    return db.query(models.Onibus).all()
+async def get_all_onibus(request: Request, response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False, db: AsyncSession = Depends(get_async_db)):
+    order = [models.Onibus.id]
+    if stream:
+        return ndjson_response(SessionLocal, lambda session: session.query(models.Onibus), order, model_row(OnibusBase))
+
+    async def build():
+        onibus, next_cursor = await db.run_sync(lambda session: fetch_page(session.query(models.Onibus), order, limit, cursor))
+        return [onibus_row(bus) for bus in onibus], next_cursor_headers(request, next_cursor)
+
+    # Served from the response cache, writes to any bus invalidate the pages
+    return await cached_json(request, onibus_cache, ONIBUS_LIST, f"{limit or ''}:{cursor or ''}", build)
 
 
 ################## GET ONIBUS BY ID
 @app.get("/onibus/{onibus_id}", response_model=OnibusBase)
-def get_onibus_by_id(onibus_id: str, db: Session = Depends(get_db)):
-    db_onibus = db.query(models.Onibus).filter(models.Onibus.id == onibus_id).first()
-    if not db_onibus:
+async def get_onibus_by_id(onibus_id: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+    async def build():
+        db_onibus = await db.get(models.Onibus, onibus_id)
+        if not db_onibus:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
+        return onibus_row(db_onibus), {}
+
+    return await cached_json(request, onibus_cache, onibus_scope(onibus_id), "", build)
+
+################ PASSENGER MANIFEST #####################
+@app.get("/onibus/{onibus_id}/manifest")
+async def get_onibus_manifest(onibus_id: str, format: str = Query("csv", pattern="^(csv|ndjson|pdf)$"), db: AsyncSession = Depends(get_async_db)):
+    # Boarding list streamed from one server-side cursor, rows go out as they are read
+    onibus = await db.get(models.Onibus, onibus_id)
+    if not onibus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
 
-    return db_onibus
+    title = f"Lista de embarque - {onibus.evento or onibus_id} {onibus.horario or ''}".strip()
+    filename = "manifest-" + "".join(c for c in onibus_id if c.isalnum() or c in "-_") + "." + format
+    return StreamingResponse(
+        manifest_chunks(SessionLocal, onibus_id, format, title),
+        media_type=MANIFEST_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"},
+    )
+
+###############WAITING ROOM##############################
+# Booking and payment routes answer 429 past their limits, fans then queue here for an entry
+# token sent back as X-Entry-Token. Tickets and tokens are signed, any worker can check them.
+@app.post("/waiting-room", status_code=status.HTTP_201_CREATED, dependencies=[Depends(admit_join)])
+def join_waiting_room():
+    return waiting_room.join()
+
+@app.get("/waiting-room/{ticket}")
+def get_waiting_room_position(ticket: str):
+    # Position in the queue, with the entry token once it is 0
+    position = waiting_room.status(ticket) if ADMISSION_ENABLED else None
+    if position is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ticket not found or expired")
+    return position
+
+@app.get("/admission/stats")
+def get_admission_stats():
+    return admission_stats.snapshot()
 
 ###############RESERVE SYSTEM##############################
-@app.post("/reserve/{onibus_id}", status_code=status.HTTP_201_CREATED)
-def create_reserve(onibus_id: str, request: ReserveRequest, db: Session = Depends(get_db)):
-    onibus = db.query(models.Onibus).filter(models.Onibus.id == onibus_id).first()
+@app.post("/reserve/bulk", response_model=BulkReserveResponse, status_code=status.HTTP_201_CREATED, dependencies=[Depends(admit)])
+async def create_bulk_reserve(request: BulkReserveRequest, db: AsyncSession = Depends(get_async_db)):
+    # Group bookings across one or more buses, written in a single transaction
+    entries = [BookingEntry(entry.onibus_id, entry.client_id, [(seat.row, seat.column) for seat in entry.seats], entry.all_or_nothing) for entry in request.entries]
+    results = await db.run_sync(claim_seats_bulk, entries)
+    await db.commit()
+    for result in results:
+        seat_maps.reserve(result.entry.onibus_id, result.reserved_seats)
+    await invalidate_onibus_async(*{result.entry.onibus_id for result in results if result.reserved})
+
+    reserved = sum(len(result.reserved) for result in results)
+    conflicts = sum(len(result.conflicts) for result in results)
+    content = {
+        "message": "Reservations created successfully" if not conflicts else "Reservations partially created",
+        "results": [{"onibus_id": result.entry.onibus_id, "client_id": result.entry.client_id, **result.as_dict()} for result in results],
+    }
+    if not reserved and conflicts:
+        content["message"] = "No seats available"
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content=content)
+    return content
+
+@app.post("/reserve/{onibus_id}", response_model=ReserveResponse, status_code=status.HTTP_201_CREATED, dependencies=[Depends(admit)])
+async def create_reserve(onibus_id: str, request: ReserveRequest, db: AsyncSession = Depends(get_async_db)):
+    onibus = await db.scalar(select(models.Onibus.id).where(models.Onibus.id == onibus_id))
     if not onibus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
 
-    for seat in request.seats:
-        reservation = models.Reservation(
-            id=str(uuid.uuid4()),
-            client_id=request.client_id,
-            onibus_id=onibus_id,
-            seat_row=seat.row,
-            seat_column=seat.column,
-            timestamp=datetime.utcnow()
-        )
-        db.add(reservation)
+    booking = await db.run_sync(claim_seats, onibus_id, request.client_id, [(seat.row, seat.column) for seat in request.seats], request.all_or_nothing)
+    await db.commit()
+    seat_maps.reserve(onibus_id, booking.reserved_seats)
+    await invalidate_onibus_async(onibus_id)
 
-    onibus.vagas -= len(request.seats)
-    db.commit()
+    if not booking.reserved:
+        # Nothing was booked, tell the client which seats are gone
+        message = "No seats available" if booking.sold_out else "Seats already reserved"
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"message": message, **booking.as_dict()})
 
-    return {"message": "Reservation created successfully"}
+    message = "Reservation created successfully" if not booking.conflicts else "Reservation partially created"
+    return {"message": message, **booking.as_dict()}
 
 ################################UPDATE RESERVE###################
 @app.put("/reserve/{reservation_id}", status_code=status.HTTP_200_OK)
-def update_reserve(reservation_id: str, request: ReserveRequest, db: Session = Depends(get_db)):
-    reservation = db.query(models.Reservation).filter(models.Reservation.id == reservation_id).first()
+async def update_reserve(reservation_id: str, request: ReserveRequest, db: AsyncSession = Depends(get_async_db)):
+    reservation = await db.get(models.Reservation, reservation_id)
     if not reservation:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
 
+    old_seat = (reservation.seat_row, reservation.seat_column)
+    new_seat = (request.seats[0].row, request.seats[0].column)
+    if new_seat != old_seat and seat_holds.conflicts(reservation.onibus_id, [new_seat]):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Seat is held for another payment")
     reservation.client_id = request.client_id
     reservation.seat_row = request.seats[0].row
     reservation.seat_column = request.seats[0].column
 
-    db.commit()
-    db.refresh(reservation)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Seat already reserved")
+    await db.refresh(reservation)
+    seat_maps.move(reservation.onibus_id, old_seat, (reservation.seat_row, reservation.seat_column))
 
     return reservation
 
 
 ####################DELETE RESERVE##############################
 @app.delete("/reserve/{reservation_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_reserve(reservation_id: str, db: Session = Depends(get_db)):
-    reservation = db.query(models.Reservation).filter(models.Reservation.id == reservation_id).first()
+async def delete_reserve(reservation_id: str, db: AsyncSession = Depends(get_async_db)):
+    reservation = await db.get(models.Reservation, reservation_id)
     if not reservation:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
 
-    onibus = db.query(models.Onibus).filter(models.Onibus.id == reservation.onibus_id).first()
-    onibus.vagas += 1
+    # Give the seat back without a read-modify-write on vagas
+    await db.execute(update(models.Onibus).where(models.Onibus.id == reservation.onibus_id).values(vagas=models.Onibus.vagas + 1))
+    await db.run_sync(add_reservations, reservation.onibus_id, -1)
 
-    db.delete(reservation)
-    db.commit()
+    seat = (reservation.seat_row, reservation.seat_column)
+    await db.delete(reservation)
+    await db.commit()
+    seat_maps.release(reservation.onibus_id, [seat])
+    await invalidate_onibus_async(reservation.onibus_id)
     return {"message": "Reservation deleted successfully"}
 
 ################ GET RESERVE BY BUS ID #####################
 @app.get("/reserve/onibus/{onibus_id}/seats", response_model=List[Seat])
-def get_reserved_seats(onibus_id: str, db: Session = Depends(get_db)):
-    reservations = db.query(models.Reservation).filter(models.Reservation.onibus_id == onibus_id).all()
-    reserved_seats = [{"row": reservation.seat_row, "column": reservation.seat_column} for reservation in reservations]
-    return reserved_seats
+async def get_reserved_seats(onibus_id: str, db: AsyncSession = Depends(get_async_db)):
+    # Served from the in-memory seat map, the database is only read to (re)build it
+    return await db.run_sync(taken_seats, onibus_id)
+
+def taken_seats(db: Session, onibus_id: str) -> list:
+    # Reserved seats plus the ones held for pending payments
+    seats = seat_maps.seats(db, onibus_id)
+    held = seat_holds.held(onibus_id)
+    if not held:
+        return seats
+    reserved = {(seat["row"], seat["column"]) for seat in seats}
+    return seats + [{"row": row, "column": column} for row, column in held if (row, column) not in reserved]
+
+################ SEAT HOLDS #####################
+# Seats of pending PIX payments are held in memory and expired by the timing wheel thread
+@app.on_event("startup")
+def start_seat_holds():
+    seat_holds.start()
+
+@app.on_event("shutdown")
+def stop_seat_holds():
+    seat_holds.stop()
+
+@app.get("/seats/holds/stats")
+def get_seat_hold_stats():
+    return seat_holds.stats()
+
+################ SEAT MAP PUSH #####################
+# Open seat pickers subscribe instead of polling: a snapshot, then only the seats that changed.
+# Every seat map change (reserve, release, move, payment confirmation) goes through the hub.
+seat_maps.add_listener(seat_hub.publish)
+seat_holds.add_listener(seat_hub.publish)
+
+def seat_snapshot(onibus_id: str) -> list:
+    # Own session, the request's one is closed while the stream is open
+    db = SessionLocal()
+    try:
+        return taken_seats(db, onibus_id)
+    finally:
+        db.close()
+
+def refresh_seat_map(onibus_id: str):
+    db = SessionLocal()
+    try:
+        seat_maps.get(db, onibus_id)
+    finally:
+        db.close()
+
+seat_map_refresher = SeatMapRefresher(seat_hub, refresh_seat_map)
+
+@app.on_event("startup")
+async def start_seat_map_refresher():
+    seat_map_refresher.start()
+
+@app.on_event("shutdown")
+async def stop_seat_map_refresher():
+    await seat_map_refresher.stop()
+
+@app.get("/reserve/onibus/{onibus_id}/seats/stream")
+async def stream_reserved_seats(onibus_id: str, db: AsyncSession = Depends(get_async_db)):
+    # Server-Sent Events: "snapshot" with every reserved seat, then "delta" with reserved/released
+    if not await db.scalar(select(models.Onibus.id).where(models.Onibus.id == onibus_id)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Onibus not found")
+
+    async def events():
+        async for message in seat_hub.stream(onibus_id, lambda: run_in_threadpool(seat_snapshot, onibus_id)):
+            yield sse_event(message)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/reserve/onibus/{onibus_id}/seats/ws")
+async def websocket_reserved_seats(websocket: WebSocket, onibus_id: str):
+    # Same messages as the stream, as JSON text frames, keepalives are {"type": "keepalive"}
+    await websocket.accept()
+    try:
+        async for message in seat_hub.stream(onibus_id, lambda: run_in_threadpool(seat_snapshot, onibus_id)):
+            await websocket.send_text(message[1] if message is not None else '{"type": "keepalive"}')
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/seats/push/stats")
+def get_seat_push_stats():
+    return seat_hub.stats()
+
+################ CHECK SEAT MAP AGAINST RESERVATIONS #####################
+@app.get("/reserve/onibus/{onibus_id}/seats/consistency")
+async def check_seat_map(onibus_id: str, repair: bool = True, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(seat_maps.check_consistency, onibus_id, repair)
+
 ########################GET ALL RESERVES##########################
+# Only the columns ReservationResponse needs, read as tuples
+reservation_columns = [
+    models.Reservation.id, models.Reservation.client_id, models.Reservation.onibus_id,
+    models.Reservation.seat_row, models.Reservation.seat_column, models.Reservation.timestamp,
+]
+reservation_row = model_row(ReservationResponse)
+
 @app.get("/reserve/", response_model=List[ReservationResponse], status_code=status.HTTP_200_OK)
-def get_all_reservations(db: Session = Depends(get_db)):
-    reservations = db.query(models.Reservation).all()
-    # Convert timestamp to string before returning
-    response = []
-    for reservation in reservations:
-        reservation_dict = reservation.__dict__.copy()
-        reservation_dict['timestamp'] = reservation.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        response.append(ReservationResponse(**reservation_dict))
-    return response
+async def get_all_reservations(request: Request, response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False, db: AsyncSession = Depends(get_async_db)):
+    order = [models.Reservation.id]
+    if stream:
+        return ndjson_response(SessionLocal, lambda session: session.query(*reservation_columns), order, reservation_row)
+
+    reservations, next_cursor = await db.run_sync(lambda session: fetch_page(session.query(*reservation_columns), order, limit, cursor))
+    # Timestamps are formatted by the encoder, no model is built per row
+    return FastJSONResponse(column_rows(reservation_columns, reservations), headers=next_cursor_headers(request, next_cursor))
 
 
 ########################GET RESERVATION BY ID#####################
 @app.get("/reserve/{reservation_id}", response_model=ReservationResponse, status_code=status.HTTP_200_OK)
-def get_reserve_by_id(reservation_id: str, db: Session = Depends(get_db)):
-    reservation = db.query(models.Reservation).filter(models.Reservation.id == reservation_id).first()
+async def get_reserve_by_id(reservation_id: str, db: AsyncSession = Depends(get_async_db)):
+    reservation = (await db.execute(select(*reservation_columns).where(models.Reservation.id == reservation_id))).first()
     if not reservation:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
 
-    # Convert timestamp to string before returning
-    reservation_dict = reservation.__dict__.copy()
-    reservation_dict['timestamp'] = reservation.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    return FastJSONResponse(column_rows(reservation_columns, [reservation])[0])
+
+
+########################REPORTS#####################
+# Read from onibus_summary, one row per bus whatever the number of reservations and payments
+@app.get("/reports/occupancy")
+async def get_occupancy_report(db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(occupancy)
+
+@app.get("/reports/revenue")
+async def get_revenue_report(group_by: str = Query("onibus", pattern="^(onibus|evento)$"), db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(revenue, group_by)
+
+@app.get("/reports/payments")
+async def get_payment_counts(db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(payment_counts)
+
+
+########################DATABASE POOL#####################
+@app.get("/db/pool")
+def get_pool_stats():
+    # Checkout waits and saturation of the async connection pool
+    return pool_stats.snapshot()
+
+@app.get("/gateway/stats")
+def get_gateway_stats():
+    # Circuit breaker, status cache and poll coalescing of the Mercado Pago client
+    return {**gateway.stats(), "monitor_guard": monitor_guard.snapshot()}
+
+@app.get("/cache/onibus")
+def get_onibus_cache_stats():
+    return onibus_cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    # Prometheus text format
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return PlainTextResponse(exposition(), media_type="text/plain; version=0.0.4")
+
+@app.get("/startup")
+def get_startup_report():
+    # Import and init time of this worker, `python startup.py` breaks the imports down
+    return startup_report.snapshot()
+
+
+startup_report.imported("test.py")
 
-    return ReservationResponse(**reservation_dict)
+@app.on_event("startup")
+def report_startup():
+    # Registered last, runs after the other startup hooks
+    print(startup_report.summary())
 
 
 
@@ -0,0 +1,132 @@
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, selectinload
+
+import models
+from pagination import model_row
+from pydanticmodels import ClientBase, OnibusBase
+
+
+# Most clients one GET /clients?ids=... may ask for
+TRIPS_MAX_IDS = int(os.getenv("TRIPS_MAX_IDS", "100"))
+
+# Clients, their reservations with the bus, their payments with the bus: three queries
+# whatever the number of trips, the buses are joined into the selectin queries
+TRIP_OPTIONS = (
+    selectinload(models.Client.reservations).joinedload(models.Reservation.onibus),
+    selectinload(models.Client.payments).joinedload(models.Payment.onibus),
+)
+
+client_row = model_row(ClientBase)
+onibus_row = model_row(OnibusBase)
+
+
+def load_clients(db: Session, client_ids: Sequence[str]) -> List[models.Client]:
+    clients = db.query(models.Client).options(*TRIP_OPTIONS).filter(models.Client.id.in_(list(client_ids))).all()
+    # In the order asked for
+    by_id = {client.id: client for client in clients}
+    return [by_id[client_id] for client_id in dict.fromkeys(client_ids) if client_id in by_id]
+
+
+def client_trips(client: models.Client) -> dict:
+    # {client, trips: [{onibus, seats, payments}]}, one trip per bus the client booked or paid for
+    trips: Dict[str, dict] = {}
+
+    def trip(onibus_id: str, onibus) -> dict:
+        if onibus_id not in trips:
+            trips[onibus_id] = {
+                "onibus_id": onibus_id,
+                "onibus": onibus_row(onibus) if onibus is not None else None,
+                "seats": [],
+                "payments": [],
+            }
+        return trips[onibus_id]
+
+    for reservation in sorted(client.reservations, key=lambda reservation: (reservation.seat_row or 0, reservation.seat_column or 0)):
+        trip(reservation.onibus_id, reservation.onibus)["seats"].append({
+            "reservation_id": reservation.id,
+            "row": reservation.seat_row,
+            "column": reservation.seat_column,
+            "confirmed": bool(reservation.confirmed),
+            "timestamp": reservation.timestamp,
+        })
+    for payment in sorted(client.payments, key=lambda payment: (payment.timestamp is None, payment.timestamp)):
+        trip(payment.onibus_id, payment.onibus)["payments"].append({
+            "id": payment.id,
+            "payment_id": payment.payment_id,
+            "status": payment.status,
+            "amount": payment.transaction_amount,
+            "approved": bool(payment.approved),
+            "seats": payment.seats or [],
+            "timestamp": payment.timestamp,
+        })
+    return {"client": client_row(client), "trips": list(trips.values())}
+
+
+def trips_of(db: Session, client_ids: Sequence[str]) -> List[dict]:
+    return [client_trips(client) for client in load_clients(db, client_ids)]
+
+
+@contextmanager
+def count_queries(engine):
+    # Statements sent on the engine inside the block, collected in the yielded list
+    statements: List[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def check(trip_counts: Sequence[int] = (1, 5, 50)) -> Dict[int, int]:
+    # Loads clients with more and more trips on an in-memory database, the query count must not grow
+    import uuid
+    from datetime import datetime
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine, tables=[models.Client.__table__, models.Onibus.__table__, models.Reservation.__table__, models.Payment.__table__])
+    db = sessionmaker(engine)()
+    for count in trip_counts:
+        client_id = f"client-{count}"
+        db.add(models.Client(id=client_id, nome=client_id))
+        for i in range(count):
+            onibus_id = f"onibus-{count}-{i}"
+            db.add(models.Onibus(id=onibus_id, evento=f"evento {i}", vagas=40))
+            for seat in range(2):
+                db.add(models.Reservation(id=str(uuid.uuid4()), client_id=client_id, onibus_id=onibus_id, seat_row=seat, seat_column=0, timestamp=datetime.now()))
+            db.add(models.Payment(id=str(uuid.uuid4()), client_id=client_id, onibus_id=onibus_id, payment_id=str(uuid.uuid4()), status="approved", transaction_amount=100, approved=True, seats=[{"row": 0, "column": 0}], timestamp=datetime.now()))
+    db.commit()
+
+    counts = {}
+    for count in trip_counts:
+        db.expunge_all()
+        with count_queries(engine) as statements:
+            result = trips_of(db, [f"client-{count}"])
+        assert len(result[0]["trips"]) == count, result
+        counts[count] = len(statements)
+    db.expunge_all()
+    with count_queries(engine) as statements:
+        result = trips_of(db, [f"client-{count}" for count in trip_counts])
+    assert [len(client["trips"]) for client in result] == list(trip_counts), result
+    counts[sum(trip_counts)] = len(statements)
+    db.close()
+
+    assert len(set(counts.values())) == 1 and max(counts.values()) <= 3, f"query count grows with the trips: {counts}"
+    return counts
+
+
+if __name__ == "__main__":
+    # python trips.py: checks that a trip history costs the same few queries for any number of trips
+    counts = check()
+    for trips, queries in counts.items():
+        print(f"{trips} trips: {queries} queries")
+    print("ok")
@@ -0,0 +1,465 @@
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import models
+from holds import seat_holds
+from sales_summary import record_payment
+
+
+# Events claimed per consumer tick and threads asking Mercado Pago for their payment status
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+# Retries of an event whose payment is unknown yet or whose status could not be fetched
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_BACKOFF = int(os.getenv("WEBHOOK_BACKOFF", "10"))
+WEBHOOK_MAX_BACKOFF = int(os.getenv("WEBHOOK_MAX_BACKOFF", "600"))
+WEBHOOK_LEASE = int(os.getenv("WEBHOOK_LEASE", "120"))
+WEBHOOK_IDLE_POLL = int(os.getenv("WEBHOOK_IDLE_POLL", "10"))
+# Event ids remembered per process, retries of those are answered without touching the database
+WEBHOOK_RECENT_IDS = int(os.getenv("WEBHOOK_RECENT_IDS", "10000"))
+
+EVENT_STATUSES = ("pending", "processing", "done", "ignored", "failed")
+# A payment in one of these only moves on through a refund or a chargeback. denied is written
+# by /deny_payment, the others come from Mercado Pago.
+FINAL_STATUSES = {"approved", "denied", "rejected", "cancelled", "refunded", "charged_back"}
+# Statuses a payment may move to from each status, anything else is a late or replayed event.
+# A status missing here, set by hand through /edit_payment, only moves to a final one.
+TRANSITIONS = {
+    "pending": {"authorized", "in_process", "in_mediation"} | FINAL_STATUSES,
+    "authorized": {"in_process"} | FINAL_STATUSES,
+    "in_process": FINAL_STATUSES,
+    "approved": {"refunded", "charged_back", "in_mediation"},
+    "in_mediation": {"approved", "refunded", "charged_back"},
+}
+# Final without a sale, the seats held for the payment go back on sale
+FAILED_STATUSES = FINAL_STATUSES - {"approved"}
+
+
+def parse_notification(body: bytes, params: Mapping[str, str]) -> Tuple[str, str, Optional[str], Optional[str]]:
+    # (event id, topic, action, resource id) of a webhook or of an old style IPN
+    # (?topic=payment&id=...), a malformed body still gets stored and acknowledged
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    topic = str(data.get("type") or data.get("topic") or params.get("type") or params.get("topic") or "unknown")
+    action = data.get("action")
+    resource = (data.get("data") or {}).get("id") if isinstance(data.get("data"), dict) else None
+    resource = resource or params.get("data.id") or data.get("resource") or params.get("id")
+    if resource is not None:
+        resource = str(resource).rstrip("/").rsplit("/", 1)[-1]
+
+    if data.get("id") is not None:
+        event_id = str(data["id"])
+    else:
+        # No notification id (IPN), identical redeliveries still hash to the same key
+        raw = body + json.dumps(sorted(params.items())).encode()
+        event_id = hashlib.sha256(raw).hexdigest()
+    return event_id[:64], topic[:50], action[:50] if isinstance(action, str) else None, resource[:50] if resource else None
+
+
+class RecentIds:
+    # Bounded set of event ids this process already stored
+
+    def __init__(self, size: int = WEBHOOK_RECENT_IDS):
+        self.size = size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, event_id: str) -> bool:
+        with self._lock:
+            return event_id in self._ids
+
+    def add(self, event_id: str):
+        with self._lock:
+            self._ids[event_id] = None
+            self._ids.move_to_end(event_id)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+
+class WebhookStats:
+
+    def __init__(self):
+        self.received = 0
+        self.stored = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.ignored = 0
+        self.retried = 0
+
+    def snapshot(self) -> Dict:
+        return dict(self.__dict__)
+
+
+recent_events = RecentIds()
+webhook_stats = WebhookStats()
+
+
+async def ingest_notification(db: AsyncSession, body: bytes, params: Mapping[str, str]) -> bool:
+    # Stores the raw event and returns, the consumer does the work. False for a duplicate delivery.
+    webhook_stats.received += 1
+    event_id, topic, action, resource_id = parse_notification(body, params)
+    if event_id in recent_events:
+        webhook_stats.duplicates += 1
+        return False
+
+    now = datetime.now()
+    db.add(models.WebhookEvent(
+        id=event_id,
+        topic=topic,
+        action=action,
+        resource_id=resource_id,
+        payload=body.decode("utf-8", "replace"),
+        status="pending",
+        attempts=0,
+        next_attempt_at=now,
+        received_at=now,
+    ))
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Stored by an earlier delivery, maybe on another worker
+        await db.rollback()
+        recent_events.add(event_id)
+        webhook_stats.duplicates += 1
+        return False
+    recent_events.add(event_id)
+    webhook_stats.stored += 1
+    return True
+
+
+def transition_allowed(current: Optional[str], new: str) -> bool:
+    if current == new:
+        return False
+    if current is None:
+        return True
+    if current in TRANSITIONS:
+        return new in TRANSITIONS[current]
+    return current not in FINAL_STATUSES and new in FINAL_STATUSES
+
+
+class WebhookConsumer:
+    # Drains webhook_events with the same claiming scheme as the outbox. A claimed batch is
+    # grouped per payment in arrival order: the payments are loaded with one query, every
+    # payment's status is fetched once however many events it got, and the status is applied
+    # as a forward-only transition, so out of order or replayed events never move a payment back.
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        fetch_status: Callable[[str], Optional[str]],
+        on_approved: Callable[[models.Payment, Session], None],
+    ):
+        self.session_factory = session_factory
+        self.fetch_status = fetch_status
+        self.on_approved = on_approved
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+        self._thread = threading.Thread(target=self._run, name="webhook-consumer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                event_ids = self.claim_batch()
+                if event_ids:
+                    self.process_batch(event_ids)
+                    continue
+                delay = self.seconds_until_next_event()
+            except Exception as e:
+                print(f"Error in webhook consumer: {e}")
+                delay = WEBHOOK_IDLE_POLL
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def seconds_until_next_event(self) -> float:
+        db = self.session_factory()
+        try:
+            next_attempt_at = db.query(func.min(models.WebhookEvent.next_attempt_at)).filter(
+                models.WebhookEvent.status == "pending"
+            ).scalar()
+        finally:
+            db.close()
+        if next_attempt_at is None:
+            return WEBHOOK_IDLE_POLL
+        return min(max((next_attempt_at - datetime.now()).total_seconds(), 0), WEBHOOK_IDLE_POLL)
+
+    def claim_batch(self) -> List[str]:
+        db = self.session_factory()
+        try:
+            now = datetime.now()
+            Event = models.WebhookEvent
+            events = (
+                db.query(Event)
+                .filter(
+                    or_(
+                        (Event.status == "pending") & (Event.next_attempt_at <= now),
+                        (Event.status == "processing") & (Event.locked_until < now),
+                    )
+                )
+                .order_by(Event.received_at)
+                .limit(WEBHOOK_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            for event in events:
+                event.status = "processing"
+                event.locked_by = self.worker_id
+                event.locked_until = now + timedelta(seconds=WEBHOOK_LEASE)
+            db.commit()
+            return [event.id for event in events]
+        finally:
+            db.close()
+
+    def process_batch(self, event_ids: List[str]):
+        db = self.session_factory()
+        try:
+            events = (
+                db.query(models.WebhookEvent)
+                .filter(models.WebhookEvent.id.in_(event_ids), models.WebhookEvent.locked_by == self.worker_id)
+                .order_by(models.WebhookEvent.received_at)
+                .all()
+            )
+            groups: "OrderedDict[str, List[models.WebhookEvent]]" = OrderedDict()
+            for event in events:
+                if event.topic == "payment" and event.resource_id:
+                    groups.setdefault(event.resource_id, []).append(event)
+                else:
+                    self._finish(event, "ignored", error=f"Unhandled topic {event.topic}")
+            db.commit()
+            if not groups:
+                return
+
+            payments = {
+                payment.payment_id: payment
+                for payment in db.query(models.Payment).filter(models.Payment.payment_id.in_(list(groups)))
+            }
+            known = [payment_id for payment_id in groups if payment_id in payments]
+            statuses = dict(zip(known, self._executor.map(self._fetch_status, known)))
+
+            for payment_id, group in groups.items():
+                try:
+                    self._apply(db, payments.get(payment_id), statuses.get(payment_id), group)
+                    db.commit()
+                except Exception as e:
+                    print(f"Error processing webhook events of payment {payment_id}: {e}")
+                    db.rollback()
+                    self._release_after_error(db, [event.id for event in group], e)
+        finally:
+            db.close()
+
+    def _fetch_status(self, payment_id: str) -> Optional[str]:
+        try:
+            return self.fetch_status(payment_id)
+        except Exception as e:
+            print(f"Error fetching status of payment {payment_id}: {e}")
+            return None
+
+    def _apply(self, db: Session, payment: Optional[models.Payment], payment_status: Optional[str], events: List[models.WebhookEvent]):
+        if payment is None:
+            # The webhook can beat create_db_payment, try again a little later
+            self._retry(events, "Payment not found")
+            return
+        if payment_status is None:
+            self._retry(events, "Could not fetch payment status")
+            return
+
+        if payment_status == "approved" and not payment.reservations_created:
+            self.on_approved(payment, db)
+        elif transition_allowed(payment.status, payment_status):
+            # Compare and set, a status poll or another worker may have moved it meanwhile
+            updated = db.query(models.Payment).filter(
+                models.Payment.id == payment.id,
+                models.Payment.status == payment.status,
+            ).update({models.Payment.status: payment_status}, synchronize_session=False)
+            if updated:
+                record_payment(db, payment.onibus_id, payment.transaction_amount, payment.status, payment_status)
+        if payment_status in FAILED_STATUSES:
+            seat_holds.release(payment.payment_id)
+        for event in events:
+            event.last_status = payment_status
+            self._finish(event, "done")
+        webhook_stats.processed += len(events)
+
+    def _retry(self, events: List[models.WebhookEvent], error: str):
+        now = datetime.now()
+        for event in events:
+            event.attempts += 1
+            event.last_error = error
+            if event.attempts >= WEBHOOK_MAX_ATTEMPTS:
+                self._finish(event, "ignored", error=error)
+            else:
+                event.status = "pending"
+                event.next_attempt_at = now + timedelta(seconds=min(WEBHOOK_BACKOFF * 2 ** (event.attempts - 1), WEBHOOK_MAX_BACKOFF))
+                event.locked_by = None
+                event.locked_until = None
+                webhook_stats.retried += 1
+
+    def _finish(self, event: models.WebhookEvent, status: str, error: Optional[str] = None):
+        event.status = status
+        event.locked_by = None
+        event.locked_until = None
+        event.processed_at = datetime.now()
+        if error:
+            event.last_error = error[:255]
+        if status == "ignored":
+            webhook_stats.ignored += 1
+
+    def _release_after_error(self, db: Session, event_ids: List[str], error: Exception):
+        try:
+            events = db.query(models.WebhookEvent).filter(models.WebhookEvent.id.in_(event_ids)).all()
+            self._retry(events, str(error)[:255])
+            for event in events:
+                if event.status == "ignored":
+                    event.status = "failed"
+            db.commit()
+        except Exception as e:
+            print(f"Error releasing webhook events {event_ids}: {e}")
+            db.rollback()
+
+
+def replay(db: Session, statuses: List[str] = (), event_ids: List[str] = (), since: Optional[datetime] = None) -> int:
+    # Puts stored events back in the queue, processing is idempotent so replays are safe
+    query = db.query(models.WebhookEvent).filter(models.WebhookEvent.status != "processing")
+    if statuses:
+        query = query.filter(models.WebhookEvent.status.in_(statuses))
+    if event_ids:
+        query = query.filter(models.WebhookEvent.id.in_(event_ids))
+    if since:
+        query = query.filter(models.WebhookEvent.received_at >= since)
+    count = query.update({
+        models.WebhookEvent.status: "pending",
+        models.WebhookEvent.attempts: 0,
+        models.WebhookEvent.next_attempt_at: datetime.now(),
+        models.WebhookEvent.last_error: None,
+    }, synchronize_session=False)
+    db.commit()
+    return count
+
+
+def load_test(url: str = "http://localhost:8000/notification", deliveries: int = 5000, unique: int = 100, threads: int = 32):
+    # Fires `deliveries` webhooks drawn from `unique` notifications at a running server, like
+    # Mercado Pago retrying, then checks every notification was stored exactly once
+    import random
+    import requests
+    from database import SessionLocal
+
+    run = uuid.uuid4().hex[:8]
+    notifications = [
+        {
+            "id": f"loadtest-{run}-{i}",
+            "action": "payment.updated",
+            "api_version": "v1",
+            "data": {"id": f"loadtest-{run}-payment-{i % max(unique // 4, 1)}"},
+            "date_created": datetime.now().isoformat(),
+            "live_mode": False,
+            "type": "payment",
+            "user_id": "loadtest",
+        }
+        for i in range(unique)
+    ]
+    local = threading.local()
+
+    # Every notification is sent at least once, the rest are duplicates in random order
+    order = [i % unique for i in range(max(deliveries, unique))]
+    random.shuffle(order)
+
+    def deliver(i: int) -> Tuple[int, float]:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            status_code = local.session.post(url, json=notifications[i], timeout=10).status_code
+        except requests.RequestException:
+            status_code = 0
+        return status_code, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(deliver, order))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in results)
+    failures = sum(1 for status_code, _ in results if status_code != 200)
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+    print(f"deliveries={len(order)} unique={unique} failures={failures} rate={len(order) / elapsed:.0f}/s")
+    print(f"p50={percentile(0.5):.1f}ms p95={percentile(0.95):.1f}ms p99={percentile(0.99):.1f}ms")
+
+    db = SessionLocal()
+    try:
+        ids = [notification["id"] for notification in notifications]
+        stored = db.query(models.WebhookEvent).filter(models.WebhookEvent.id.in_(ids)).count()
+        print(f"stored={stored}")
+        assert failures == 0, "webhooks were not acknowledged"
+        assert stored == unique, "notifications were lost or stored twice"
+    finally:
+        db.query(models.WebhookEvent).filter(models.WebhookEvent.id.like(f"loadtest-{run}-%")).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    # python webhooks.py replay [status...] [event_id...] [--since=2024-01-31T00:00]
+    # python webhooks.py loadtest [url] [deliveries] [unique]
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("", [])
+    if command == "replay":
+        from database import SessionLocal
+
+        since = next((datetime.fromisoformat(arg.split("=", 1)[1]) for arg in args if arg.startswith("--since=")), None)
+        args = [arg for arg in args if not arg.startswith("--since=")]
+        session = SessionLocal()
+        try:
+            count = replay(
+                session,
+                statuses=[arg for arg in args if arg in EVENT_STATUSES],
+                event_ids=[arg for arg in args if arg not in EVENT_STATUSES],
+                since=since,
+            )
+        finally:
+            session.close()
+        print(f"{count} events queued again")
+    elif command == "loadtest":
+        load_test(*(args[:1]), *(int(arg) for arg in args[1:3]))
+    else:
+        print("usage: python webhooks.py replay [status...] [event_id...] [--since=ISO date]")
+        print("       python webhooks.py loadtest [url] [deliveries] [unique]")
+        sys.exit(2)